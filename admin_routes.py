@@ -0,0 +1,59 @@
+# admin_routes.py
+import os
+import time
+from functools import wraps
+
+from flask import Blueprint, Response, request, abort
+
+from config import ADMIN_USERS, PROFILE_MAX_SECONDS
+from identity import get_current_user
+from profiler import profiler, ProfilerBusy
+from request_log import slow_requests
+
+# Blueprint for operator tools, all routes under /admin
+admin_bp = Blueprint('admin', __name__)
+
+
+def admin_required(view):
+    """ Only let users listed in ADMIN_USERS through. Everyone else (and everyone when the list is empty) gets a 404. """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        user = get_current_user()
+        if user is None or user.username not in ADMIN_USERS:
+            abort(404)
+        return view(*args, **kwargs)
+    return wrapper
+
+
+@admin_bp.route('/profile')
+@admin_required
+def profile():
+    """
+    Sample every thread of this process (request threads, sync, apply workers, jobs) for ?seconds= (default 10)
+    and download the collapsed stacks, e.g. for 'flamegraph.pl profile.folded > profile.svg' or speedscope.
+    """
+    seconds = request.args.get('seconds', 10, type=float)
+    try:
+        stacks, samples = profiler.profile(min(seconds, PROFILE_MAX_SECONDS))
+    except ProfilerBusy as e:
+        return Response(str(e), status=409, mimetype='text/plain')
+    response = Response(stacks, mimetype='text/plain')
+    response.headers.set('Content-Disposition', 'attachment',
+                         filename=f"profile-{os.getpid()}-{time.strftime('%Y%m%d-%H%M%S')}.folded")
+    response.headers['X-Profile-Samples'] = str(samples)
+    return response
+
+
+@admin_bp.route('/slow-requests')
+@admin_required
+def slow_request_log():
+    """ The slowest recent requests of this process with their SQL counts and durations, as plain text. """
+    lines = [f"Requests slower than {slow_requests.threshold:g}s, slowest first (process {os.getpid()}; "
+             f"each worker process keeps its own log)", ""]
+    for e in slow_requests.slowest():
+        when = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(e['at']))
+        lines.append(f"{e['seconds'] * 1000:8.1f} ms  {when}  {e['method']} {e['path']}  ({e['endpoint']})"
+                     f"{'  ERROR ' + e['error'] if e['error'] else ''}")
+        lines.append(f"{'':13}sql: {e['sql_count']} statements, {e['sql_seconds'] * 1000:.1f} ms"
+                     f"; slowest {e['slowest_sql_seconds'] * 1000:.1f} ms: {' '.join(e['slowest_sql'].split())}")
+    return Response('\n'.join(lines) + '\n', mimetype='text/plain')
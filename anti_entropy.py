@@ -0,0 +1,528 @@
+# anti_entropy.py
+import json
+import uuid
+import hashlib
+import threading
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import event, select, text, literal_column
+
+from models import db, User, File, FriendRequest, Friendship, HomeUser, FileTombstone
+from config import ANTI_ENTROPY_TIMEOUT, ANTI_ENTROPY_MIN_AGE
+from sharding import SHARD_IDS, on_shard, write_lock
+
+# Tree shape: FANOUT children per node, DEPTH levels below the root -> FANOUT ** DEPTH leaf buckets per table
+FANOUT = 16
+DEPTH = 3
+LEAVES = FANOUT ** DEPTH
+
+# Rows are bucketed by their key modulo this prime (the largest below LEAVES, so the last leaves stay empty).
+# A prime spreads snowflake ids evenly, whose low bits are mostly a zero sequence number (see ids.py).
+BUCKETS = 4093
+
+# Replicated tables: model, the column naming the owning user, and the replicated columns that are compared.
+# password_hash is shipped with repaired users but not compared (every regional salts its own hash).
+TABLES = {
+    'user':           (User,          'id',           ('id', 'username', 'email')),
+    'file':           (File,          'user_id',      ('id', 'user_id', 'stored_filename', 'original_filename',
+                                                       'file_size', 'permissions', 'upload_date')),
+    'friend_request': (FriendRequest, 'from_user_id', ('id', 'from_user_id', 'to_user_id', 'status')),
+    'friendship':     (Friendship,    'user_id',      ('user_id', 'friend_id')),
+}
+
+# Leaf XORs of every table, per shard: each shard's rows are folded into its own leaves, in the same transaction
+# as the row change, so the trees survive restarts and web workers of other processes keep them current.
+# The 160-bit XORs are split into five 32-bit columns, so SQL can update them in place ((a | b) - (a & b) is a XOR b).
+CREATE_LEAVES_SQL = """
+CREATE TABLE merkle_leaf (
+    tbl TEXT NOT NULL,
+    bucket INTEGER NOT NULL,
+    h0 INTEGER NOT NULL, h1 INTEGER NOT NULL, h2 INTEGER NOT NULL, h3 INTEGER NOT NULL, h4 INTEGER NOT NULL,
+    PRIMARY KEY (tbl, bucket)
+)
+"""
+
+TOGGLE_LEAF_SQL = text("""
+INSERT INTO merkle_leaf (tbl, bucket, h0, h1, h2, h3, h4) VALUES (:tbl, :bucket, :h0, :h1, :h2, :h3, :h4)
+ON CONFLICT (tbl, bucket) DO UPDATE SET
+    h0 = (h0 | excluded.h0) - (h0 & excluded.h0), h1 = (h1 | excluded.h1) - (h1 & excluded.h1),
+    h2 = (h2 | excluded.h2) - (h2 & excluded.h2), h3 = (h3 | excluded.h3) - (h3 & excluded.h3),
+    h4 = (h4 | excluded.h4) - (h4 & excluded.h4)
+""")
+
+
+def _value(v):
+    """ JSON-friendly form of a column value. """
+    return v.isoformat() if isinstance(v, datetime) else v
+
+
+def row_values(table, row, overrides=None):
+    """ The compared column values of a row as a dict ('overrides' replaces some of them, e.g. pre-update values). """
+    values = {c: _value(getattr(row, c)) for c in TABLES[table][2]}
+    if overrides:
+        values.update({c: _value(v) for c, v in overrides.items()})
+    return values
+
+
+def row_key(table, values):
+    """ The identity of a row: its id, or the user pair for friendships. """
+    if table == 'friendship':
+        return [values['user_id'], values['friend_id']]
+    return values['id']
+
+
+def key_column(table):
+    """ The column a row is bucketed by: its id, or the first user of a friendship. """
+    return 'user_id' if table == 'friendship' else 'id'
+
+
+def bucket_of(key):
+    """ Leaf bucket of a row key. """
+    return (key[0] if isinstance(key, list) else key) % BUCKETS
+
+
+def bucket_expression(table):
+    """ SQL for the bucket of a row. The modulus is a literal, so queries use the expression index below. """
+    model = TABLES[table][0]
+    return model.__table__.c[key_column(table)].op('%')(literal_column(str(BUCKETS)))
+
+
+# Rows of a mismatching leaf are fetched through these (created with the other indexes by sharding.create_all)
+for _table in TABLES:
+    db.Index(f'ix_{_table}_merkle_bucket', bucket_expression(_table))
+db.Index('ix_file_tombstone_merkle_bucket', FileTombstone.__table__.c.id.op('%')(literal_column(str(BUCKETS))))
+
+
+def row_hash(values):
+    """ 160-bit hash of a row's compared values. Leaves XOR these, so a change is an O(1) update. """
+    return int.from_bytes(hashlib.sha1(json.dumps(values, sort_keys=True).encode('utf-8')).digest(), 'big')
+
+
+def _words(h):
+    """ A row hash as the five 32-bit leaf columns. """
+    return {f'h{i}': (h >> (32 * i)) & 0xffffffff for i in range(5)}
+
+
+class MerkleTree:
+    #Merkle tree over one table: leaves are XORs of row hashes, inner nodes hash their children.
+
+    def __init__(self):
+        self.leaves = [0] * LEAVES
+        self.levels = None  # cached hex hashes per level, rebuilt lazily after changes
+
+    def toggle(self, bucket, h):
+        """ Add or remove a row hash (XOR is its own inverse). """
+        self.leaves[bucket] ^= h
+        self.levels = None
+
+    def node(self, level, index):
+        """ Hash of a node; level 0 is the root, level DEPTH are the leaves. """
+        if self.levels is None:
+            levels = [[format(x, '040x') for x in self.leaves]]
+            for _ in range(DEPTH):
+                below = levels[0]
+                levels.insert(0, [hashlib.sha1(''.join(below[i:i + FANOUT]).encode()).hexdigest()
+                                  for i in range(0, len(below), FANOUT)])
+            self.levels = levels
+        return self.levels[level][index]
+
+    def children(self, level, index):
+        """ Hashes of a node's children. """
+        return [self.node(level + 1, index * FANOUT + k) for k in range(FANOUT)]
+
+
+class MerkleIndex:
+    #One tree per replicated table, read from the persisted leaves of all shards at the start of each round.
+
+    def __init__(self):
+        self.trees = {table: MerkleTree() for table in TABLES}
+        self.lock = threading.Lock()
+
+    def create(self):
+        """ Create the leaf table in every shard where it is missing and fill it from that shard's rows (once). Must run inside an application context. """
+        for shard_id in SHARD_IDS:
+            db.session.commit()
+            # Other processes start up too: the write lock makes one of them create and fill the table,
+            # and keeps rows from being written in between (they would be counted twice)
+            db.session.execute(text("BEGIN IMMEDIATE"), bind_arguments=on_shard(shard_id))
+            exists = db.session.execute(text(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'merkle_leaf'"
+            ), bind_arguments=on_shard(shard_id)).first() is not None
+            if exists:
+                db.session.commit()
+                continue
+            db.session.execute(text(CREATE_LEAVES_SQL), bind_arguments=on_shard(shard_id))
+            count = 0
+            for table, (model, _, _) in TABLES.items():
+                leaves = {}
+                for row in db.session.execute(select(model), bind_arguments=on_shard(shard_id)).scalars().yield_per(1000):
+                    values = row_values(table, row)
+                    bucket = bucket_of(row_key(table, values))
+                    leaves[bucket] = leaves.get(bucket, 0) ^ row_hash(values)
+                    count += 1
+                if leaves:
+                    db.session.execute(TOGGLE_LEAF_SQL, [dict(_words(h), tbl=table, bucket=bucket)
+                                                         for bucket, h in leaves.items()],
+                                       bind_arguments=on_shard(shard_id))
+            db.session.commit()
+            print(f"[AntiEntropy] Hashed {count} rows (shard {shard_id})", flush=True)
+
+    def load(self):
+        """ Read the current leaves of every shard (O(leaves), no row is read). Must run inside an application context. """
+        trees = {table: MerkleTree() for table in TABLES}
+        for shard_id in SHARD_IDS:
+            for tbl, bucket, *words in db.session.execute(text(
+                "SELECT tbl, bucket, h0, h1, h2, h3, h4 FROM merkle_leaf"
+            ), bind_arguments=on_shard(shard_id)):
+                if tbl in trees:
+                    # Shards hold disjoint rows, so a table's leaf is the XOR of its shards' leaves
+                    trees[tbl].toggle(bucket, sum(w << (32 * i) for i, w in enumerate(words)))
+        db.session.commit()
+        with self.lock:
+            self.trees = trees
+
+    def roots(self):
+        with self.lock:
+            return {table: tree.node(0, 0) for table, tree in self.trees.items()}
+
+    def children(self, table, nodes):
+        """ Children hashes for each requested (level, index) node. """
+        with self.lock:
+            return {f"{level}:{index}": self.trees[table].children(level, index) for level, index in nodes}
+
+
+merkle_index = MerkleIndex()
+
+
+# --- incremental maintenance -------------------------------------------------------------
+# Leaf updates run on the flush's own connection, so they commit or roll back together with the row change.
+
+# Set once the leaf table is known to exist (it is created in every shard at startup, possibly by another process)
+leaves_ready = False
+
+
+def _leaves_ready(connection):
+    global leaves_ready
+    if not leaves_ready:
+        leaves_ready = connection.execute(text(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'merkle_leaf'"
+        )).first() is not None
+    return leaves_ready
+
+
+def _toggle(connection, table, values):
+    """ Add a row version to its leaf, or remove it (XOR is its own inverse). """
+    connection.execute(TOGGLE_LEAF_SQL, dict(_words(row_hash(values)), tbl=table,
+                                             bucket=bucket_of(row_key(table, values))))
+
+
+def _listen(table, model):
+    def after_insert(mapper, connection, target):
+        if _leaves_ready(connection):
+            _toggle(connection, table, row_values(table, target))
+
+    def after_delete(mapper, connection, target):
+        if _leaves_ready(connection):
+            _toggle(connection, table, row_values(table, target))
+
+    def before_update(mapper, connection, target):
+        # Remove the old version of the row, add the new one. Attributes may have been expired by an
+        # earlier commit (no history), so read the old version from the DB before the UPDATE runs.
+        if not _leaves_ready(connection):
+            return
+        table_obj = mapper.local_table
+        old = connection.execute(table_obj.select().where(table_obj.c.id == target.id)).mappings().first()
+        if old is None:
+            return
+        old_values = row_values(table, target, {c: old[c] for c in TABLES[table][2]})
+        new_values = row_values(table, target)
+        if old_values == new_values:
+            return
+        _toggle(connection, table, old_values)
+        _toggle(connection, table, new_values)
+
+    event.listen(model, 'after_insert', after_insert)
+    event.listen(model, 'after_delete', after_delete)
+    event.listen(model, 'before_update', before_update)
+
+
+for _table, (_model, _, _) in TABLES.items():
+    _listen(_table, _model)
+
+
+@event.listens_for(File, 'after_delete')
+def _file_deleted(mapper, connection, target):
+    # Every delete (by the owner, from a sync event or a repair) leaves a tombstone in the file's shard
+    connection.execute(FileTombstone.__table__.insert().prefix_with('OR REPLACE').values(
+        id=target.id, user_id=target.user_id, deleted_at=datetime.now()))
+
+
+# --- exchange protocol -------------------------------------------------------------------
+# The initiating regional walks both trees top-down through the Grand Server, which relays its 'ae'
+# requests to one peer and the peer's 'ae_reply' answers back. Only the children of mismatching nodes
+# travel, and only the rows of mismatching leaves are read (through the bucket indexes), so a round costs
+# O(differences x log n) hashes plus the rows of those leaves instead of a full table comparison.
+#
+# Repair rules, per row of a mismatching leaf bucket:
+#  - only on one side: copied to the other side, except for files the other side has a tombstone for; that
+#    is a missed delete, so the stale copy is removed. Files younger than ANTI_ENTROPY_MIN_AGE are left to
+#    event replication (a fresh upload is missing elsewhere until its event arrives).
+#  - different on both sides: the side where the owner is home wins. Friend requests instead keep the
+#    answered status (a request only moves away from 'pending'). Otherwise the row is left alone.
+# Users, friend requests and friendships are never deleted: without tombstones a missing row there is
+# indistinguishable from a missed insert.
+
+# The round this regional is driving: {"session", "started", "pending", "repaired"} or None
+current_round = None
+round_lock = threading.Lock()
+
+
+def refresh():
+    """ Load the current leaves; they include the commits of every process, web workers in sidecar mode too. """
+    from app import app
+    with app.app_context():
+        merkle_index.load()
+
+
+def _send(sock, packet):
+    from sync import send_packet
+    send_packet(sock, packet)
+
+
+def _request(sock, session, packet):
+    """ Send one request of the current round and count it as outstanding. """
+    with round_lock:
+        current_round['pending'] += 1
+    _send(sock, dict(packet, type='ae', session=session))
+
+
+def start_round(sock):
+    """ Begin a comparison with some other regional, unless a recent round is still running. """
+    global current_round
+    with round_lock:
+        if current_round and time.time() - current_round['started'] < ANTI_ENTROPY_TIMEOUT:
+            return
+        current_round = {'session': uuid.uuid4().hex, 'started': time.time(), 'pending': 0, 'repaired': 0}
+        session = current_round['session']
+    refresh()
+    _request(sock, session, {'op': 'roots'})
+
+
+def _finish_request(sock, session):
+    """ One answer arrived; close the round once nothing is outstanding. """
+    global current_round
+    with round_lock:
+        if not current_round or current_round['session'] != session:
+            return
+        current_round['pending'] -= 1
+        if current_round['pending'] > 0:
+            return
+        finished, current_round = current_round, None
+    _send(sock, {'type': 'ae', 'session': session, 'op': 'done'})
+    print(f"[AntiEntropy] Round finished in {time.time() - finished['started']:.1f}s, "
+          f"{finished['repaired']} rows repaired", flush=True)
+
+
+def home_among(owners):
+    """ The users of 'owners' that are home on this regional. Needs an application context. """
+    owners = list(owners)
+    return {h.user_id for h in HomeUser.query.filter(HomeUser.user_id.in_(owners))} if owners else set()
+
+
+def rows_in_buckets(table, buckets):
+    """ Every row of 'table' that falls in one of 'buckets', as JSON key -> {"values", "home"[, "password_hash"]}. Needs an application context. """
+    model, owner, _ = TABLES[table]
+    records = model.query.filter(bucket_expression(table).in_(buckets)).all() if buckets else []
+    home = home_among({getattr(row, owner) for row in records})
+    rows = {}
+    for row in records:
+        values = row_values(table, row)
+        entry = {'values': values, 'home': values[owner] in home}
+        if table == 'user':
+            entry['password_hash'] = row.password_hash
+        rows[json.dumps(row_key(table, values))] = entry
+    return rows
+
+
+def tombstones_in_buckets(table, buckets):
+    """ Ids of the files deleted here that fall in 'buckets' (none for other tables). Needs an application context. """
+    if table != 'file' or not buckets:
+        return set()
+    bucket = FileTombstone.__table__.c.id.op('%')(literal_column(str(BUCKETS)))
+    return {i for (i,) in db.session.query(FileTombstone.id).filter(bucket.in_(buckets))}
+
+
+def settled(table, values):
+    """ Whether a one-sided row is old enough to repair (files only; other rows have no upload time). """
+    if table != 'file' or not values.get('upload_date'):
+        return True
+    return datetime.fromisoformat(values['upload_date']) < datetime.now() - timedelta(seconds=ANTI_ENTROPY_MIN_AGE)
+
+
+def answer(sock, message):
+    """ Peer side: answer a request relayed from another regional's round. """
+    op = message.get('op')
+    reply = {'type': 'ae_reply', 'session': message.get('session'), 'op': op}
+    if op == 'roots':
+        refresh()
+        reply['roots'] = merkle_index.roots()
+    elif op == 'children':
+        reply['table'] = message['table']
+        reply['nodes'] = merkle_index.children(message['table'], message['nodes'])
+    elif op == 'rows':
+        from app import app
+        with app.app_context():
+            reply['rows'] = rows_in_buckets(message['table'], message['buckets'])
+            reply['tombstones'] = sorted(tombstones_in_buckets(message['table'], message['buckets']))
+        reply['table'] = message['table']
+        reply['buckets'] = message['buckets']
+    elif op == 'push':
+        apply_repairs(message['table'], message.get('upserts', []), message.get('deletes', []))
+        return
+    else:
+        return  # 'done' needs no answer
+    _send(sock, reply)
+
+
+def handle_reply(sock, message):
+    """ Initiator side: descend into mismatching nodes, and repair both sides once the leaves are reached. """
+    session = message.get('session')
+    with round_lock:
+        if not current_round or session != current_round['session']:
+            return  # answer to a round that already timed out
+
+    op = message.get('op')
+    if op == 'roots':
+        mine = merkle_index.roots()
+        for table, root in message.get('roots', {}).items():
+            if table in mine and mine[table] != root:
+                _request(sock, session, {'op': 'children', 'table': table, 'nodes': [[0, 0]]})
+
+    elif op == 'children':
+        table = message['table']
+        nodes = [tuple(map(int, key.split(':'))) for key in message['nodes']]
+        mine = merkle_index.children(table, nodes)
+        differing = []
+        for key, theirs in message['nodes'].items():
+            level, index = map(int, key.split(':'))
+            differing += [(level + 1, index * FANOUT + k) for k, h in enumerate(theirs) if mine[key][k] != h]
+        if differing and differing[0][0] == DEPTH:
+            buckets = [index for _, index in differing]
+            _request(sock, session, {'op': 'rows', 'table': table, 'buckets': buckets})
+        elif differing:
+            _request(sock, session, {'op': 'children', 'table': table, 'nodes': differing})
+
+    elif op == 'rows':
+        repaired = reconcile(sock, session, message)
+        with round_lock:
+            if current_round and current_round['session'] == session:
+                current_round['repaired'] += repaired
+
+    elif op == 'abort':
+        print("[AntiEntropy] No peer available for this round", flush=True)
+
+    _finish_request(sock, session)
+
+
+def reconcile(sock, session, message):
+    """ Compare one table's mismatching buckets row by row, repair our side and push the peer's repairs. Returns the rows repaired. """
+    table = message['table']
+    theirs = message.get('rows', {})
+    their_tombstones = set(message.get('tombstones', []))
+
+    from app import app
+    with app.app_context():
+        mine = rows_in_buckets(table, message.get('buckets', []))
+        tombstones = tombstones_in_buckets(table, message.get('buckets', []))
+
+    local_upserts, local_deletes, remote_upserts, remote_deletes = [], [], [], []
+    for key in set(mine) | set(theirs):
+        m, t = mine.get(key), theirs.get(key)
+        if m and t:
+            if m['values'] == t['values']:
+                continue
+            if table == 'friend_request':
+                # Requests only move from 'pending' to an answer, so the answered copy is newer
+                if m['values']['status'] == 'pending' and t['values']['status'] != 'pending':
+                    local_upserts.append(t)
+                elif t['values']['status'] == 'pending' and m['values']['status'] != 'pending':
+                    remote_upserts.append(m)
+            elif t['home'] and not m['home']:
+                local_upserts.append(t)
+            elif m['home'] and not t['home']:
+                remote_upserts.append(m)
+        elif t:
+            if t['values'].get('id') in tombstones:
+                remote_deletes.append(t)
+            elif settled(table, t['values']):
+                local_upserts.append(t)
+        else:
+            if m['values'].get('id') in their_tombstones:
+                local_deletes.append(m)
+            elif settled(table, m['values']):
+                remote_upserts.append(m)
+
+    apply_repairs(table, local_upserts, local_deletes)
+    if remote_upserts or remote_deletes:
+        _send(sock, {'type': 'ae', 'session': session, 'op': 'push',
+                     'table': table, 'upserts': remote_upserts, 'deletes': remote_deletes})
+    return len(local_upserts) + len(local_deletes) + len(remote_upserts) + len(remote_deletes)
+
+
+def _upsert(table, entry):
+    """ Insert or overwrite one repaired row. """
+    v = entry['values']
+    if table == 'user':
+        user = db.session.get(User, v['id'])
+        if user is None:
+            db.session.add(User(id=v['id'], username=v['username'], email=v['email'],
+                                password_hash=entry['password_hash']))
+        else:
+            user.username, user.email = v['username'], v['email']
+    elif table == 'file':
+        db.session.merge(File(
+            id=v['id'],
+            user_id=v['user_id'],
+            stored_filename=v['stored_filename'],
+            original_filename=v['original_filename'],
+            file_size=v['file_size'],
+            permissions=v['permissions'],
+            upload_date=datetime.fromisoformat(v['upload_date']) if v['upload_date'] else None
+        ))  # bytes are fetched on first download
+    elif table == 'friend_request':
+        db.session.merge(FriendRequest(id=v['id'], from_user_id=v['from_user_id'],
+                                       to_user_id=v['to_user_id'], status=v['status']))
+    elif table == 'friendship':
+        if Friendship.query.filter_by(user_id=v['user_id'], friend_id=v['friend_id']).first() is None:
+            db.session.add(Friendship(user_id=v['user_id'], friend_id=v['friend_id']))
+
+
+def apply_repairs(table, upserts, deletes):
+    """ Apply repaired rows under the sync write locks of all shards. Only file rows are ever deleted (bytes included). """
+    if not upserts and not deletes:
+        return
+    from app import app
+    from file_management import FileManager
+    from config import UPLOAD_FOLDER
+
+    with app.app_context(), write_lock():
+        try:
+            for entry in upserts:
+                _upsert(table, entry)
+            db.session.commit()
+
+            if table == 'file' and deletes:
+                file_manager = FileManager(upload_folder=UPLOAD_FOLDER)
+                by_owner = {}
+                for entry in deletes:
+                    rec = db.session.get(File, entry['values']['id'])
+                    if rec:
+                        by_owner.setdefault(rec.user_id, []).append(rec)
+                for user_id, records in by_owner.items():
+                    file_manager.delete_files(records, db.session.get(User, user_id), enqueue=False)
+        except Exception as e:
+            db.session.rollback()
+            print(f"[AntiEntropy] Error repairing {table}: {e}", flush=True)
+            return
+    print(f"[AntiEntropy] Repaired {table}: {len(upserts)} upserted, {len(deletes)} deleted", flush=True)
@@ -1,4 +1,3 @@
-import os
 import threading
 from datetime import timedelta
 
@@ -9,8 +8,18 @@ from models import db
 from auth import auth_bp
 from file_management_routes import files_bp
 from friend_management_routes import friends_bp
-from config import certfile, keyfile, basedir, db_file, secret_key
-from sync import connect_to_server
+from admin_routes import admin_bp
+from live_routes import live_bp
+from config import certfile, keyfile, db_file, secret_key, UPLOAD_FOLDER, SYNC_MODE
+from sync import connect_to_server, anti_entropy_loop, evict_loop
+from blob_cache import blob_cache
+from search import search_index
+from anti_entropy import merkle_index
+from sharding import shard_binds, create_all
+from garbage_collector import gc_loop
+from jobs import job_loop
+from profiler import install_signal_handler
+import request_log
 
 app = Flask(__name__)
 
@@ -20,6 +29,8 @@ app.config['SECRET_KEY'] = secret_key
 # SQLite database URI (absolute path to file)
 app.config['SQLALCHEMY_DATABASE_URI'] = f"sqlite:///{db_file}"
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False  # disable event system to save memory
+# Extra metadata shards (empty with a single database)
+app.config['SQLALCHEMY_BINDS'] = shard_binds()
 
 app.config.update({
     # Only send session cookie over HTTPS
@@ -44,6 +55,13 @@ app.register_blueprint(auth_bp, url_prefix='/auth')
 app.register_blueprint(files_bp, url_prefix='/files')
 # Friend management routes: /friends/...
 app.register_blueprint(friends_bp, url_prefix='/friends')
+# Live-update stream for open pages: /live/...
+app.register_blueprint(live_bp, url_prefix='/live')
+# Profiler and slow-request log for ADMIN_USERS: /admin/...
+app.register_blueprint(admin_bp, url_prefix='/admin')
+
+# Time every request; slow ones are listed at /admin/slow-requests
+request_log.install(app)
 
 @app.route('/')
 def dashboard():
@@ -53,11 +71,12 @@ def dashboard():
         return redirect(url_for('auth.login'))
 
     # Lazy imports to avoid circular dependencies
-    from models import User
+    from identity import get_current_user
     from file_management import FileManager
+    from jobs import file_status
 
-    # 2) Load current user from DB using Session.get() to avoid legacy warning
-    user = db.session.get(User, uid)
+    # 2) Load current user (identity cache, no DB round trip on a hit)
+    user = get_current_user()
     if user is None:
         # Stale or invalid session → clear and force re-login
         session.clear()
@@ -65,24 +84,49 @@ def dashboard():
         return redirect(url_for('auth.login'))
 
     # 3) Instantiate FileManager and fetch the user's files
-    file_manager = FileManager(upload_folder=os.path.join(basedir, 'uploads'))
+    file_manager = FileManager(upload_folder=UPLOAD_FOLDER)
     files = file_manager.list_user_files(user)
+    # Files whose previews or indexing are still running (or failed)
+    processing = file_status(user)
 
     # 4) Render the dashboard template with user data
     return render_template(
         'dashboard.html',
         username=user.username,
         files=files,
+        processing=processing,
         current_user=user,
     )
-if __name__ == '__main__':
-    # Create database tables if they don't exist
+
+def prepare():
+    """ One-time startup work shared by app.py, wsgi.py and sync_sidecar.py. """
     with app.app_context():
-        db.create_all()
+        # Create database tables if they don't exist (in every shard)
+        create_all(db)
+        # Index the upload folder so replicas are evicted in LRU order
+        blob_cache.load()
+        # Full-text filename index (kept current incrementally afterwards)
+        search_index.create()
+        # Merkle leaves of the replicated tables (kept current by every commit afterwards)
+        merkle_index.create()
+        # Do not hand open SQLite connections to forked workers
+        for engine in db.engines.values():
+            engine.dispose()
 
-    # Launch the background sync thread exactly once
-    print("[Sync] Launching background sync thread…", flush=True)
-    threading.Thread(target=connect_to_server, daemon=True).start()
+
+if __name__ == '__main__':
+    prepare()
+    # 'kill -USR2 <pid>' writes a profile of every thread to PROFILE_DIR
+    install_signal_handler('app')
+
+    # Launch the background sync thread exactly once (in sidecar mode sync_sidecar.py owns the connection)
+    if SYNC_MODE == 'thread':
+        print("[Sync] Launching background sync thread…", flush=True)
+        threading.Thread(target=connect_to_server, daemon=True).start()
+        threading.Thread(target=anti_entropy_loop, daemon=True).start()
+        threading.Thread(target=gc_loop, daemon=True).start()
+        threading.Thread(target=evict_loop, daemon=True).start()
+        threading.Thread(target=job_loop, daemon=True).start()
 
     # Start the Flask HTTPS server (self-signed cert for dev)
     app.run(
@@ -1,7 +1,9 @@
 from flask import Blueprint, render_template, request, redirect, url_for, flash, session
 from werkzeug.security import generate_password_hash, check_password_hash
 from sqlalchemy import or_
-from models import db, User
+from models import db, User, File, HomeUser
+from sharding import lock_shard
+from blob_cache import blob_cache
 from config import changes_queue
 from datetime import datetime, timedelta
 
@@ -22,6 +24,15 @@ def _is_locked_out():
     session.pop('login_attempts', None)
     return False
 
+def _mark_home_user(user):
+    """ Remember that this user is active on this regional, so the grand server routes their file bytes here. """
+    if db.session.get(HomeUser, user.id) is None:
+        db.session.add(HomeUser(user_id=user.id))
+        db.session.commit()
+        # Replicas of this user's files become local data and must not be evicted
+        for f in File.query.filter_by(user_id=user.id).all():
+            blob_cache.pin(f.stored_filename)
+
 @auth_bp.route('/register', methods=['GET', 'POST'])
 def register():
     """ Handle user registration."""
@@ -37,11 +48,15 @@ def register():
             flash('Please fill in all fields!', 'error')
             return redirect(url_for('auth.register'))
 
+        # Users are spread over the shards, each enforcing uniqueness only for its own rows: check every shard
+        # and insert while holding the registration lock, so two processes cannot both pass the check
+        lock_shard(db.session)
         # Check for existing user by username OR email (safe ORM filter, avoids SQLi)
         existing = User.query.filter(
             or_(User.username == username, User.email == email)
         ).first()
         if existing:
+            db.session.rollback()
             flash('Username or Email already exists!', 'error')
             return redirect(url_for('auth.register'))
 
@@ -50,6 +65,7 @@ def register():
         new_user.set_password(password)
         db.session.add(new_user)
         db.session.commit()
+        _mark_home_user(new_user)
 
         # Notify other regional servers of the new user
         changes_queue.put({
@@ -97,6 +113,7 @@ def login():
             session['user_id']   = user.id
             session['username']  = user.username
             session.permanent    = remember  # honor “Remember Me”
+            _mark_home_user(user)
             return redirect(url_for('dashboard'))
 
         # Failed login: increment counter
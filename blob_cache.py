@@ -0,0 +1,209 @@
+# blob_cache.py
+import os
+import json
+import threading
+from itertools import islice
+from collections import OrderedDict
+
+from config import BLOB_CACHE_MAX_BYTES, BLOB_PINS_FILE, SYNC_MODE
+from hot_cache import hot_cache
+from storage import blob_store
+
+# Replicas asked about per round trip when evicting
+EVICT_BATCH = 100
+
+
+class BlobCache:
+    #Size-capped LRU cache over the replicated file bytes in the blob store.
+    #Files owned by this regional's home users are pinned: they are never evicted and do not count against the cap.
+    #So are the blobs stored before the cache first ran here (see load()). A replica is only deleted once another
+    #regional confirmed it keeps a pinned copy, so eviction never removes the last copy of a file.
+
+    def __init__(self, store, max_bytes, pins_file):
+        """ Create an empty cache for the blobs of 'store' that keeps at most 'max_bytes' of unpinned replicas. """
+        self.store = store
+        self.max_bytes = max_bytes
+        self.pins_file = pins_file
+        self.entries = OrderedDict()  # stored_filename -> size, least recently used first
+        self.pinned = set()           # stored_filenames of locally owned files and kept blobs
+        self.kept = set()             # stored_filenames of blobs stored before the cache first ran here
+        self.size = 0                 # total bytes of unpinned entries
+        self.wakeup = threading.Event()  # set when replicas were added (see sync.evict_loop)
+        self.lock = threading.Lock()
+
+    def load(self):
+        """ Rebuild the cache state from the store at startup. Must run inside an application context. """
+        from models import File, HomeUser
+
+        kept = self._load_kept()
+        home_ids = [h.user_id for h in HomeUser.query.all()]
+        pinned = set(kept)
+        if home_ids:
+            rows = File.query.filter(File.user_id.in_(home_ids)).with_entities(File.stored_filename).all()
+            pinned |= {r.stored_filename for r in rows}
+
+        # Oldest access first (touch() bumps the mtime), so the LRU order survives restarts
+        replicas = []
+        for name, size, mtime in self.store.scan():
+            if not name.endswith('.part') and name not in pinned:
+                replicas.append((mtime, name, size))
+        replicas.sort()
+
+        with self.lock:
+            self.kept = kept
+            self.pinned = pinned
+            self.entries = OrderedDict((name, size) for _, name, size in replicas)
+            self.size = sum(self.entries.values())
+        print(f"[BlobCache] {len(pinned)} pinned files ({len(kept)} kept from before the cache), "
+              f"{len(self.entries)} cached replicas ({self.size} bytes)", flush=True)
+
+    def _load_kept(self):
+        """
+        Names of the blobs stored before the cache first ran on this regional. On that first run every blob in the
+        store is recorded: under full replication any of them may be the only copy, and home users are not known yet.
+        """
+        try:
+            with open(self.pins_file) as f:
+                return set(json.load(f))
+        except FileNotFoundError:
+            pass
+        except ValueError:
+            print("[BlobCache] Unreadable pin list, keeping every stored blob", flush=True)
+        kept = sorted(name for name, _, _ in self.store.scan() if not name.endswith('.part'))
+        # Written atomically: an interrupted write would otherwise make these blobs evictable
+        tmp = self.pins_file + '.part'
+        with open(tmp, 'w') as f:
+            json.dump(kept, f)
+        os.replace(tmp, self.pins_file)
+        print(f"[BlobCache] Keeping the {len(kept)} blobs stored before the cache", flush=True)
+        return set(kept)
+
+    def pin(self, stored_filename):
+        """ Mark a file as locally owned, taking it out of the evictable set. """
+        with self.lock:
+            size = self.entries.pop(stored_filename, None)
+            if size is not None:
+                self.size -= size
+            self.pinned.add(stored_filename)
+
+    def add(self, stored_filename, size):
+        """ Record a replica that was just stored. Older replicas are evicted in the background if over budget. """
+        with self.lock:
+            if stored_filename in self.pinned:
+                return
+            self.size -= self.entries.pop(stored_filename, 0)
+            self.entries[stored_filename] = size
+            self.size += size
+            over_budget = self.size > self.max_bytes
+        if over_budget:
+            self.wakeup.set()
+
+    def touch(self, stored_filename):
+        """ Mark a replica as just used. The blob's mtime is bumped too (local store), so other processes see the access. """
+        with self.lock:
+            if stored_filename in self.entries:
+                self.entries.move_to_end(stored_filename)
+        self.store.touch(stored_filename)
+
+    def discard(self, stored_filename):
+        """ Forget a file whose bytes were deleted. """
+        with self.lock:
+            self.pinned.discard(stored_filename)
+            self.size -= self.entries.pop(stored_filename, 0)
+
+    def has_room(self, size=0):
+        """ Check whether 'size' more bytes fit without evicting anything (used for prefetch hints). """
+        with self.lock:
+            return self.size + size <= self.max_bytes
+
+    def refresh_order(self):
+        """ Re-sort replicas by mtime, picking up accesses made by other processes (web workers in sidecar mode). """
+        if not self.store.tracks_access:
+            return  # object stores keep no access time; the order is this process's own
+        with self.lock:
+            stamped = []
+            for name, size in self.entries.items():
+                stat = self.store.stat(name)
+                stamped.append((stat[1] if stat else 0, name, size))
+            stamped.sort()
+            self.entries = OrderedDict((name, size) for _, name, size in stamped)
+
+    def is_locally_owned(self, stored_filename):
+        """ Check for a pin made by another process: is the file kept, or owned by one of our home users? """
+        return stored_filename in self.kept or bool(self._owned([stored_filename]))
+
+    def _owned(self, names):
+        """ The given blobs whose files belong to our home users, according to the DB. """
+        from app import app
+        from models import File, HomeUser
+        with app.app_context():
+            rows = File.query.filter(File.stored_filename.in_(names)) \
+                .with_entities(File.stored_filename, File.user_id).all()
+            owners = {r.user_id for r in rows}
+            home = {h.user_id for h in HomeUser.query.filter(HomeUser.user_id.in_(owners)).all()} if owners else set()
+        return {r.stored_filename for r in rows if r.user_id in home}
+
+    def held_here(self, names):
+        """ The given blobs this regional stores and never evicts, so other regionals may drop their replicas of them. """
+        names = set(names)
+        with self.lock:
+            held = names & self.pinned
+        if names - held:
+            held |= self._owned(names - held)
+        return {name for name in held if self.store.exists(name)}
+
+    def evict(self, held_elsewhere):
+        """
+        Delete least recently used replicas until the cache fits its budget. 'held_elsewhere' returns which of a list
+        of blobs another regional keeps pinned; unconfirmed replicas stay, as they may be the last copy.
+        Returns True if the cache fits its budget afterwards.
+        """
+        with self.lock:
+            over_budget = self.size > self.max_bytes
+        if not over_budget:
+            return True
+        if SYNC_MODE == 'sidecar':
+            self.refresh_order()
+
+        refused = set()
+        while True:
+            with self.lock:
+                excess = self.size - self.max_bytes
+                if excess <= 0:
+                    return True
+                # The most recently used replica always stays, so a file over the whole budget can still be served
+                batch, freed = [], 0
+                for name, size in islice(self.entries.items(), max(0, len(self.entries) - 1)):
+                    if name in refused:
+                        continue
+                    batch.append(name)
+                    freed += size
+                    if freed >= excess or len(batch) >= EVICT_BATCH:
+                        break
+            if not batch:
+                print(f"[BlobCache] {excess} bytes over budget, no other regional holds the remaining replicas", flush=True)
+                return False
+
+            # Another process may have pinned some (e.g. their owner logged in through a web worker)
+            owned = self._owned(batch)
+            for name in owned:
+                self.pin(name)
+            batch = [name for name in batch if name not in owned]
+            held = held_elsewhere(batch) if batch else set()
+
+            for name in batch:
+                if name not in held:
+                    refused.add(name)
+                    continue
+                with self.lock:
+                    size = self.entries.pop(name, None)
+                    if size is None:
+                        continue
+                    self.size -= size
+                hot_cache.discard(name)
+                self.store.delete(name)
+                print(f"[BlobCache] Evicted {name} ({size} bytes)", flush=True)
+
+
+# Shared cache for the regional's blob store
+blob_cache = BlobCache(blob_store, BLOB_CACHE_MAX_BYTES, BLOB_PINS_FILE)
@@ -0,0 +1,289 @@
+# bulk.py
+import os
+import json
+import time
+import uuid
+import base64
+import threading
+from collections import deque
+
+from config import UPLOAD_FOLDER, SYNC_BULK_CONNECTIONS, SYNC_CHUNK_BYTES, SYNC_BULK_BYTES_PER_SEC, SYNC_BULK_BURST_BYTES
+from rate_limit import TokenBucket
+from storage import blob_store
+
+# Bandwidth budget for file bytes, shared by every bulk lane (and by large inline uploads when there are no lanes)
+bulk_budget = TokenBucket(SYNC_BULK_BYTES_PER_SEC, SYNC_BULK_BURST_BYTES)
+
+
+class Transfer:
+    #The bytes of one blob on their way through a bulk lane, read from the blob store one chunk at a time.
+    #'upload' transfers replicate a new file to interested regionals, 'blob' transfers answer an on-demand fetch.
+
+    def __init__(self, kind, stored_filename, user_id=None, encoding=None, on_drop=None):
+        """ Prepare a transfer of the blob 'stored_filename' (in its stored encoding). Nothing is read yet. 'on_drop()' is called if it is given up. """
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.stored_filename = stored_filename
+        self.user_id = user_id
+        self.encoding = encoding
+        self.on_drop = on_drop
+        self.file = None
+        self.size = 0
+        self.seq = 0
+
+    def remaining(self):
+        """ Bytes still to send (an estimate before the file is opened), for balancing lanes. """
+        if self.file is None:
+            stat = blob_store.stat(self.stored_filename)
+            return stat[0] if stat else 0
+        return self.size - self.file.tell()
+
+    def next_packet(self):
+        """ Read the next chunk as a 'chunk' packet; the first one carries the header. Returns None if the blob is gone. """
+        if self.file is None:
+            try:
+                # An open file keeps its bytes even if the cache evicts the blob meanwhile
+                self.file = blob_store.open(self.stored_filename)
+            except FileNotFoundError:
+                return None
+            self.size = self.file.seek(0, os.SEEK_END)
+            self.file.seek(0)
+
+        data = self.file.read(SYNC_CHUNK_BYTES)
+        last = self.file.tell() >= self.size
+        packet = {'type': 'chunk', 'transfer': self.id, 'seq': self.seq, 'last': last,
+                  'data': base64.b64encode(data).decode('utf-8')}
+        if self.seq == 0:
+            packet.update(kind=self.kind, stored_filename=self.stored_filename, user_id=self.user_id,
+                          encoding=self.encoding, size=self.size)
+        self.seq += 1
+        if last:
+            self.close()
+        return packet
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+
+    def drop(self):
+        """ Give the transfer up (blob gone, lane closed) and tell whoever waits for it, once. """
+        self.close()
+        on_drop, self.on_drop = self.on_drop, None
+        if on_drop is not None:
+            try:
+                on_drop()
+            except Exception as e:
+                print(f"[Bulk] Could not report the dropped transfer of {self.stored_filename}: {e}", flush=True)
+
+
+class BulkLane:
+    #One bulk connection to the Grand Server. Its transfers take turns chunk by chunk (round robin), so one big
+    #file cannot hold up the others; a transfer stays on its lane, so its chunks arrive in order.
+
+    def __init__(self, sock, receiver):
+        """ Wrap a connected socket that already introduced itself as a bulk lane. """
+        self.sock = sock
+        self.receiver = receiver
+        self.queue = deque()       # active transfers, the next one to send a chunk first
+        self.queued_bytes = 0      # rough amount of data still to send, to pick the least busy lane
+        self.cond = threading.Condition()
+        self.closed = False
+
+    def start(self):
+        threading.Thread(target=self.send_loop, daemon=True).start()
+        threading.Thread(target=self.read_loop, daemon=True).start()
+
+    def add(self, transfer):
+        """ Queue a transfer on this lane. """
+        with self.cond:
+            self.queue.append(transfer)
+            self.queued_bytes += transfer.remaining()
+            self.cond.notify()
+
+    def send_loop(self):
+        """ Send one chunk of the transfer at the head of the queue, then move it to the back. """
+        transfer = None
+        try:
+            while True:
+                transfer = None
+                with self.cond:
+                    while not self.queue and not self.closed:
+                        self.cond.wait()
+                    if self.closed:
+                        return
+                    transfer = self.queue.popleft()
+
+                packet = transfer.next_packet()
+                if packet is None:
+                    print(f"[Bulk] {transfer.stored_filename} is gone, transfer dropped", flush=True)
+                    transfer.drop()
+                    continue
+                data = (json.dumps(packet) + '\n').encode('utf-8')
+
+                # Pace the lanes together; TCP flow control then keeps each lane within what its path can carry
+                while True:
+                    wait = bulk_budget.consume(len(data))
+                    if not wait:
+                        break
+                    time.sleep(wait)
+                self.sock.sendall(data)  # only this thread writes to a bulk lane
+
+                with self.cond:
+                    self.queued_bytes = max(0, self.queued_bytes - len(data))
+                    if not packet['last']:
+                        self.queue.append(transfer)
+        except Exception as e:
+            print(f"[Bulk] Lane send error: {e}", flush=True)
+            if transfer is not None:
+                transfer.drop()  # it was off the queue, so close() would not see it
+        finally:
+            self.close()
+
+    def read_loop(self):
+        """ Hand the chunks the Grand Server relays to us to the receiver. """
+        try:
+            for line in self.sock.makefile('r'):
+                try:
+                    message = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if message.get('type') == 'chunk':
+                    self.receiver.receive(message, self)
+        except Exception as e:
+            if not self.closed:
+                print(f"[Bulk] Lane read error: {e}", flush=True)
+        finally:
+            self.close()
+
+    def close(self):
+        """
+        Shut the lane down. Unsent transfers are dropped: receivers of uploads fetch the bytes on demand instead,
+        fetch answers report a miss (on_drop), so the requester does not wait for bytes that will not come.
+        """
+        with self.cond:
+            if self.closed:
+                return
+            self.closed = True
+            dropped = list(self.queue)
+            self.queue.clear()
+            self.cond.notify_all()
+        for transfer in dropped:
+            transfer.drop()
+        self.receiver.lane_closed(self)
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+
+class BulkLinks:
+    #The bulk lanes of the current Grand Server link.
+
+    def __init__(self, receiver):
+        self.receiver = receiver
+        self.lanes = []
+        self.lock = threading.Lock()
+
+    def open(self, link_id, connect):
+        """ Open SYNC_BULK_CONNECTIONS lanes with 'connect()' and attach them to the control connection 'link_id'. """
+        lanes = []
+        for _ in range(SYNC_BULK_CONNECTIONS):
+            try:
+                sock = connect()
+                sock.sendall((json.dumps({'type': 'hello', 'lane': 'bulk', 'link': link_id}) + '\n').encode('utf-8'))
+            except Exception as e:
+                print(f"[Bulk] Could not open a bulk lane: {e}", flush=True)
+                continue
+            lane = BulkLane(sock, self.receiver)
+            lane.start()
+            lanes.append(lane)
+        with self.lock:
+            self.lanes = lanes
+        if lanes:
+            print(f"[Bulk] {len(lanes)} bulk lanes open", flush=True)
+
+    def close(self):
+        """ Close every lane (the control connection went away). """
+        with self.lock:
+            lanes, self.lanes = self.lanes, []
+        for lane in lanes:
+            lane.close()
+
+    def available(self):
+        """ True while at least one lane is open. """
+        with self.lock:
+            return any(not lane.closed for lane in self.lanes)
+
+    def submit(self, transfer):
+        """ Queue a transfer on the least busy open lane. Returns False if there is none. """
+        with self.lock:
+            lanes = [lane for lane in self.lanes if not lane.closed]
+        if not lanes:
+            transfer.close()
+            return False
+        min(lanes, key=lambda lane: lane.queued_bytes).add(transfer)
+        return True
+
+
+class BulkReceiver:
+    #Reassembles chunked transfers into blobs in the upload folder and reports each finished one.
+
+    def __init__(self, on_complete):
+        """ 'on_complete(stored_filename, size, encoding, user_id)' is called once a blob is complete on disk. """
+        self.on_complete = on_complete
+        self.incoming = {}  # transfer id -> {"header", "file", "path", "next", "size", "lane"}
+        self.lock = threading.Lock()
+
+    def receive(self, message, lane=None):
+        """ Take one chunk. Out-of-order or unknown chunks abandon the transfer (the bytes are fetched on demand later). """
+        tid = message.get('transfer')
+        if message.get('abort'):
+            self._discard(tid)
+            return
+
+        with self.lock:
+            entry = self.incoming.get(tid)
+        if entry is None:
+            stored_filename = os.path.basename(message.get('stored_filename') or '')
+            if message.get('seq') != 0 or not stored_filename:
+                return
+            # Each transfer writes its own temp file, so an upload and a fetch answer of the same blob do not mix
+            path = os.path.join(UPLOAD_FOLDER, f"{stored_filename}.{tid}.part")
+            entry = {"header": message, "file": open(path, 'wb'), "path": path, "next": 0, "size": 0, "lane": lane}
+            with self.lock:
+                self.incoming[tid] = entry
+
+        if message.get('seq') != entry["next"]:
+            self._discard(tid)
+            return
+        data = base64.b64decode(message.get('data') or '')
+        entry["file"].write(data)
+        entry["size"] += len(data)
+        entry["next"] += 1
+        if not message.get('last'):
+            return
+
+        with self.lock:
+            self.incoming.pop(tid, None)
+        entry["file"].close()
+        header = entry["header"]
+        stored_filename = os.path.basename(header['stored_filename'])
+        blob_store.put_file(stored_filename, entry["path"])  # atomic, readers never see a partial blob
+        self.on_complete(stored_filename, entry["size"], header.get('encoding'), header.get('user_id'))
+
+    def _discard(self, tid):
+        with self.lock:
+            entry = self.incoming.pop(tid, None)
+        if entry:
+            entry["file"].close()
+            try:
+                os.remove(entry["path"])
+            except OSError:
+                pass
+
+    def lane_closed(self, lane):
+        """ Abandon the transfers that were arriving on a lane that went away. """
+        with self.lock:
+            tids = [tid for tid, entry in self.incoming.items() if entry["lane"] is lane]
+        for tid in tids:
+            self._discard(tid)
@@ -0,0 +1,129 @@
+# compaction.py
+import threading
+
+# Running totals since startup, read with get_stats()
+stats = {
+    "batches":     0,  # batches compacted
+    "events_in":   0,  # events drained from changes_queue
+    "events_out":  0,  # events left after compaction
+    "bytes_saved": 0   # file bytes that never had to be shipped
+}
+stats_lock = threading.Lock()
+
+
+def compact_events(events):
+    """
+    Fold a batch of queued events into the minimal equivalent sequence, per entity key:
+    - file id:        upload + permission changes -> one upload with the final permission,
+                      (bulk files_deleted / permissions_changed events are folded per file id)
+                      upload (+ anything) + delete -> nothing, repeated permission changes -> the last one,
+                      permission changes + delete -> the delete
+    - request id:     request + accept -> one friend_added carrying both users,
+                      request + reject -> nothing
+    - friendship pair: friend_added (folded above) + friend_removed -> nothing
+    Events on different keys keep their relative order. Returns the compacted list.
+    """
+    out = list(events)       # slots are set to None when an event is folded away
+    uploads = {}             # file id -> slot of its file_upload
+    perms = {}               # file id -> slot of its latest permission_change
+    requests = {}            # request id -> slot of its friend_request
+    new_pairs = {}           # (user id, user id) -> slot of a friend_added whose request is in this batch
+    saved = 0
+
+    for i, event in enumerate(events):
+        etype = event.get('type')
+
+        if etype == 'file_upload':
+            uploads[event['payload']['id']] = i
+
+        elif etype in ('permission_change', 'permissions_changed'):
+            kept = []
+            for fid in _file_ids(event):
+                if fid in uploads:
+                    # Ship the upload with its final permission instead
+                    up = out[uploads[fid]]
+                    out[uploads[fid]] = dict(up, payload=dict(up['payload'], permissions=event['new_permissions']))
+                else:
+                    if fid in perms:
+                        _drop_file(out, perms[fid], fid)
+                    perms[fid] = i
+                    kept.append(fid)
+            out[i] = _with_file_ids(event, kept)
+
+        elif etype in ('file_delete', 'files_deleted'):
+            kept = []
+            for fid in _file_ids(event):
+                if fid in perms:
+                    _drop_file(out, perms.pop(fid), fid)
+                if fid in uploads:
+                    # The file never needs to exist remotely
+                    slot = uploads.pop(fid)
+                    saved += out[slot]['payload'].get('file_size') or 0
+                    out[slot] = None
+                else:
+                    kept.append(fid)
+            out[i] = _with_file_ids(event, kept)
+
+        elif etype == 'friend_request':
+            requests[event['request_id']] = i
+
+        elif etype == 'friend_added':
+            rid = event['request_id']
+            if rid in requests:
+                slot = requests.pop(rid)
+                req = out[slot]
+                out[slot] = None
+                out[i] = dict(event, from_user=req['from_user'], to_user=req['to_user'])
+                new_pairs[_pair(req['from_user'], req['to_user'])] = i
+
+        elif etype == 'friend_rejected':
+            rid = event['request_id']
+            if rid in requests:
+                out[requests.pop(rid)] = None
+                out[i] = None
+
+        elif etype == 'friend_removed':
+            pair = _pair(event['user_id'], event['friend_id'])
+            if pair in new_pairs:
+                out[new_pairs.pop(pair)] = None
+                out[i] = None
+
+    compacted = [e for e in out if e is not None]
+    with stats_lock:
+        stats["batches"] += 1
+        stats["events_in"] += len(events)
+        stats["events_out"] += len(compacted)
+        stats["bytes_saved"] += saved
+    return compacted
+
+
+def get_stats():
+    """ Return a snapshot of the compaction totals. """
+    with stats_lock:
+        return dict(stats)
+
+
+def _pair(a, b):
+    """ Order-independent key for a friendship between two users. """
+    return (a, b) if a <= b else (b, a)
+
+
+
+def _file_ids(event):
+    """ File ids touched by a single-file or bulk file event. """
+    return list(event['file_ids']) if 'file_ids' in event else [event['file_id']]
+
+
+def _with_file_ids(event, file_ids):
+    """ Return the event restricted to 'file_ids', or None if no file is left. """
+    if not file_ids:
+        return None
+    if 'file_ids' in event:
+        return dict(event, file_ids=file_ids)
+    return event
+
+
+def _drop_file(out, slot, fid):
+    """ Remove one file id from the event in 'slot' (dropping the event once it covers no file). """
+    if out[slot] is not None:
+        out[slot] = _with_file_ids(out[slot], [f for f in _file_ids(out[slot]) if f != fid])
@@ -0,0 +1,82 @@
+# compression.py
+import os
+import gzip
+import shutil
+
+from config import COMPRESSIBLE_EXTENSIONS, COMPRESSION_MIN_BYTES, COMPRESSION_MAX_RATIO
+from storage import blob_store
+
+# Read/write size when compressing or decompressing blobs
+CHUNK_SIZE = 256 * 1024
+
+# The only stored encoding so far; None means the blob is stored exactly as uploaded
+GZIP = 'gzip'
+
+
+def is_compressible_type(filename):
+    """ Whether uploads of this type are candidates for compression at all. """
+    ext = filename.rsplit('.', 1)[-1].lower() if '.' in filename else ''
+    return ext in COMPRESSIBLE_EXTENSIONS
+
+
+def is_compressible(filename, size):
+    """ Pre-selection by type and size: only text-like uploads big enough to be worth a try. """
+    return is_compressible_type(filename) and size >= COMPRESSION_MIN_BYTES
+
+
+def compress_in_place(path):
+    """
+    Gzip the file at 'path' and keep the compressed form only if it is at most COMPRESSION_MAX_RATIO of the
+    original. Returns (encoding, stored size): (GZIP, compressed size) or (None, original size).
+    """
+    original_size = os.path.getsize(path)
+    tmp = path + '.part'
+    with open(path, 'rb') as src, gzip.open(tmp, 'wb', compresslevel=6) as dest:
+        shutil.copyfileobj(src, dest, CHUNK_SIZE)
+
+    compressed_size = os.path.getsize(tmp)
+    if compressed_size > original_size * COMPRESSION_MAX_RATIO:
+        os.remove(tmp)
+        return None, original_size
+    os.replace(tmp, path)  # atomic, readers see either form but never a partial file
+    return GZIP, compressed_size
+
+
+def open_logical(stored_filename, encoding):
+    """ Open a stored blob for reading its original (uploaded) bytes. """
+    f = blob_store.open(stored_filename)
+    if encoding != GZIP:
+        return f
+    reader = gzip.GzipFile(fileobj=f, mode='rb')
+    reader.myfileobj = f  # closed together with the gzip reader
+    return reader
+
+
+def iter_logical(stored_filename, encoding, chunk_size=CHUNK_SIZE):
+    """ Yield the original bytes of a stored blob chunk by chunk, decompressing on the fly. """
+    with open_logical(stored_filename, encoding) as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            yield chunk
+
+
+def looks_gzipped(stored_filename):
+    """ Cheap check of the gzip magic number, for readers that have no DB access (e.g. inside a flush). """
+    try:
+        with blob_store.open(stored_filename) as f:
+            return f.read(2) == b'\x1f\x8b'
+    except OSError:
+        return False
+
+
+def get_encoding(stored_filename):
+    """ Stored encoding of a blob (None when stored as uploaded). Needs an application context. """
+    from models import db, BlobEncoding
+    row = db.session.get(BlobEncoding, stored_filename)
+    return row.encoding if row else None
+
+
+def set_encoding(stored_filename, encoding):
+    """ Record how a blob is stored (adds to the session; the caller commits). Needs an application context. """
+    from models import db, BlobEncoding
+    if encoding:
+        db.session.merge(BlobEncoding(stored_filename=stored_filename, encoding=encoding))
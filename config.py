@@ -1,12 +1,136 @@
 import os
 from queue import Queue
 
+from outbox import SqliteOutbox
+
 # Hostname or IP of the Grand Server
 GRAND_HOST = "100.100.100.100" #Change the ip.
 GRAND_PORT = 9000
 
 BIND_HOST = "0.0.0.0"
 
+# Numeric id of this regional server (0-1023). Every regional must use a different one.
+REGION_ID = int(os.environ.get('SYNCSPHERE_REGION_ID', '0'))
+
+# When True this regional also receives the file bytes of its home users' friends, so public files are served locally.
+SUBSCRIBE_FRIEND_FILES = True
+
+# How long (in seconds) a download waits for a file to be fetched from another regional.
+FETCH_TIMEOUT = 20
+
+# Lazy blob mode: only metadata is replicated eagerly, file bytes are fetched the first time they are downloaded.
+LAZY_BLOBS = os.environ.get('SYNCSPHERE_LAZY_BLOBS', '0') == '1'
+
+# Disk budget (bytes) for cached copies of files owned by users from other regionals. Local users' files are pinned and never evicted.
+# A copy is only evicted once another regional confirmed it keeps the file; otherwise eviction is retried every BLOB_CACHE_RETRY seconds.
+BLOB_CACHE_MAX_BYTES = int(os.environ.get('SYNCSPHERE_BLOB_CACHE_BYTES', str(2 * 1024 ** 3)))
+BLOB_CACHE_RETRY = 60
+
+# Hot-file cache for downloads (per process): a public file requested HOT_CACHE_MIN_HITS times among the last
+# HOT_CACHE_SAMPLE_SIZE downloads is served from memory. Files up to HOT_CACHE_SMALL_BYTES are held as bytes,
+# up to HOT_CACHE_MMAP_BYTES memory-mapped (local storage only); bigger ones always stream from disk. 0 bytes disables the cache.
+HOT_CACHE_MAX_BYTES = int(os.environ.get('SYNCSPHERE_HOT_CACHE_BYTES', str(256 * 1024 ** 2)))
+HOT_CACHE_SMALL_BYTES = 256 * 1024
+HOT_CACHE_MMAP_BYTES = 32 * 1024 ** 2
+HOT_CACHE_MIN_HITS = 3
+HOT_CACHE_SAMPLE_SIZE = 10000
+
+# Number of threads that apply incoming sync batches in parallel (one user's events always stay in order).
+SYNC_APPLY_WORKERS = os.cpu_count() or 4
+
+# Per-user limits for each route class: (requests per second, request burst, bytes per second, byte burst).
+# None disables that dimension. Requests over the limit get 429 with a Retry-After header.
+RATE_LIMITS = {
+    'upload':   (2,  10,  10 * 1024 ** 2, 200 * 1024 ** 2),
+    'download': (5,  20,  20 * 1024 ** 2, 200 * 1024 ** 2),
+    'bulk':     (1,  5,   None, None),
+    'preview':  (20, 100, None, None),
+    'search':   (5,  30,  None, None),
+}
+
+# Identity cache for logged-in users: how many user rows each process keeps, and for how many seconds.
+# Changes made by another process (worker or sync sidecar) are picked up at the latest after USER_CACHE_TTL.
+USER_CACHE_SIZE = 10000
+USER_CACHE_TTL = 30
+
+# Uploads/downloads a single user may run at the same time.
+MAX_CONCURRENT_TRANSFERS = 3
+
+# The sync link is one control connection (polls, metadata events, requests) plus SYNC_BULK_CONNECTIONS bulk connections
+# that carry file bytes in SYNC_CHUNK_BYTES chunks, taking turns between files. Small events never wait behind file data.
+# Use more bulk connections on links with a high bandwidth-delay product; 0 sends bytes inside the events (old behaviour).
+SYNC_BULK_CONNECTIONS = int(os.environ.get('SYNCSPHERE_BULK_CONNECTIONS', '2'))
+SYNC_CHUNK_BYTES = 256 * 1024
+
+# Bandwidth budget shared by the bulk connections. Without them, files at least LARGE_FILE_BYTES big
+# replicate under this budget instead, so they cannot crowd out small events.
+LARGE_FILE_BYTES = 4 * 1024 ** 2
+SYNC_BULK_BYTES_PER_SEC = 5 * 1024 ** 2
+SYNC_BULK_BURST_BYTES = 150 * 1024 ** 2
+
+# Every ANTI_ENTROPY_INTERVAL seconds a regional compares its metadata (Merkle trees) with another regional
+# and repairs rows that were missed by event replication. Rounds not finished after ANTI_ENTROPY_TIMEOUT are abandoned.
+ANTI_ENTROPY_INTERVAL = int(os.environ.get('SYNCSPHERE_ANTI_ENTROPY_INTERVAL', 600))
+ANTI_ENTROPY_TIMEOUT = 120
+# Files uploaded less than this many seconds ago are left out of repairs: their events may still be on the way
+ANTI_ENTROPY_MIN_AGE = 300
+
+# Garbage collection of the upload folder (garbage_collector.py): blobs no File row refers to are moved to a quarantine folder and
+# deleted after GC_QUARANTINE_SECONDS; rows about blobs that are gone are dropped. One pass walks everything in
+# batches of GC_BATCH_SIZE, checking at most GC_ENTRIES_PER_SEC entries per second, and the next one starts
+# GC_INTERVAL seconds later. Files younger than GC_MIN_AGE are never touched (uploads and sync merges in flight).
+GC_INTERVAL = int(os.environ.get('SYNCSPHERE_GC_INTERVAL', 3600))
+GC_BATCH_SIZE = 200
+GC_ENTRIES_PER_SEC = 500
+GC_MIN_AGE = 3600
+GC_QUARANTINE_SECONDS = 24 * 3600
+
+# Post-upload jobs (jobs.py): derived work such as previews and content indexing runs after the upload request returned,
+# on JOB_WORKERS threads with at most JOB_CONCURRENCY[type] jobs of one type at a time. A failing job is retried up to
+# JOB_MAX_ATTEMPTS times, waiting JOB_RETRY_DELAY * 2^(attempt-1) seconds in between. New jobs are picked up within
+# JOB_POLL_INTERVAL seconds; finished jobs are kept JOB_KEEP_SECONDS for their status to be shown.
+JOB_WORKERS = int(os.environ.get('SYNCSPHERE_JOB_WORKERS', '4'))
+JOB_CONCURRENCY = {'rendition': 2, 'index_contents': 2}
+JOB_MAX_ATTEMPTS = 5
+JOB_RETRY_DELAY = 10
+JOB_POLL_INTERVAL = 1
+JOB_KEEP_SECONDS = 7 * 24 * 3600
+
+# Every replicated event carries a trace id and the time it passed each hop (queued, sent, hub in/out, received, applied).
+# The last TRACE_BUFFER_SIZE trace records seen on a host are kept in its TRACE_DB.
+TRACE_BUFFER_SIZE = 100000
+
+# Operator tools under /admin (sampling profiler, slow-request log) are only open to these usernames.
+# Empty (the default) means the admin pages do not exist.
+ADMIN_USERS = {name.strip() for name in os.environ.get('SYNCSPHERE_ADMIN_USERS', '').split(',') if name.strip()}
+
+# Sampling profiler (profiler.py): PROFILE_HZ stack samples per second of every thread, at most PROFILE_MAX_SECONDS per run.
+# 'kill -USR2 <pid>' profiles any process (app.py, sync sidecar, gunicorn worker, Grand Server) for PROFILE_SIGNAL_SECONDS.
+PROFILE_HZ = 100
+PROFILE_MAX_SECONDS = 60
+PROFILE_SIGNAL_SECONDS = 30
+
+# Requests slower than SLOW_REQUEST_SECONDS are logged with their SQL counts and time (the last SLOW_REQUEST_LOG_SIZE per process).
+SLOW_REQUEST_SECONDS = 0.5
+SLOW_REQUEST_LOG_SIZE = 200
+
+# Live page updates (live.py, /live/stream): open pages get a comment every LIVE_HEARTBEAT_SECONDS so proxies keep the
+# stream open. A stream that falls LIVE_QUEUE_SIZE deltas behind is told to reload; a user may hold at most
+# LIVE_MAX_STREAMS_PER_USER streams per process. The last LIVE_REPLAY_SIZE deltas are replayed to reconnecting pages.
+# In sidecar mode web workers read the deltas from the outbox every LIVE_POLL_INTERVAL seconds; they are kept LIVE_KEEP_SECONDS.
+LIVE_HEARTBEAT_SECONDS = 25
+LIVE_QUEUE_SIZE = 100
+LIVE_MAX_STREAMS_PER_USER = 8
+# Streams one process holds at most (0: no cap). Thread workers spend a thread per stream, so gunicorn.conf.py sets
+# this below their thread count; the pages over the cap just do not update live.
+LIVE_MAX_STREAMS_PER_PROCESS = int(os.environ.get('SYNCSPHERE_LIVE_MAX_STREAMS', '0'))
+LIVE_REPLAY_SIZE = 1000
+LIVE_POLL_INTERVAL = 0.5
+LIVE_KEEP_SECONDS = 60
+
+# After this many on-demand fetches of a public file the Grand Server hints all regionals to prefetch it.
+PREFETCH_THRESHOLD = 3
+
 basedir = os.path.abspath(os.path.dirname(__file__))  #The location of the system.
 certfile = os.path.join(basedir, 'server.crt') #The location of the certificate.
 keyfile = os.path.join(basedir, 'server.key') #The location of the public key
@@ -14,8 +138,53 @@ secret_key = "dfcc0ab22a9913f9f19c758feabe1c2c56d0e5be670647ef4f131666c36f0572"
 
 
 db_file = os.path.join(basedir, 'database.db')
-UPLOAD_FOLDER = os.path.join(os.getcwd(), 'uploads')
+# Metadata is hash-partitioned by user id over this many SQLite files (database.db, database-shard1.db, ...),
+# so writes for different users do not queue behind one file lock. 1 keeps the single database.
+# Changing it requires moving existing rows to their new shard first.
+SHARD_COUNT = int(os.environ.get('SYNCSPHERE_SHARD_COUNT', '1'))
+UPLOAD_FOLDER = os.path.join(basedir, 'uploads') #Where file bytes are stored (local storage), plus temporary files and renditions.
+BLOB_PINS_FILE = os.path.join(basedir, 'blob_pins.json')  #Blobs stored before the blob cache first ran; never evicted.
+
+# Where blob bytes are stored (storage.py). 'local': the upload folder. 's3': an S3-compatible object store
+# (AWS S3, MinIO, Ceph, ...; needs boto3, credentials come from the usual AWS environment variables or files),
+# under S3_PREFIX in S3_BUCKET. The upload folder then only holds temporary files and renditions.
+STORAGE_BACKEND = os.environ.get('SYNCSPHERE_STORAGE', 'local')
+S3_BUCKET = os.environ.get('SYNCSPHERE_S3_BUCKET', 'syncsphere')
+S3_PREFIX = os.environ.get('SYNCSPHERE_S3_PREFIX', 'blobs/')
+S3_ENDPOINT_URL = os.environ.get('SYNCSPHERE_S3_ENDPOINT_URL') or None  #None means AWS itself.
+S3_REGION = os.environ.get('SYNCSPHERE_S3_REGION') or None
+# Blobs over S3_PART_BYTES are uploaded in parts of that size, S3_UPLOAD_CONCURRENCY parts at a time per process
+# (so an upload holds at most that many parts in memory). Reads stream ranged GETs in S3_READ_BYTES chunks.
+S3_PART_BYTES = 8 * 1024 * 1024
+S3_UPLOAD_CONCURRENCY = int(os.environ.get('SYNCSPHERE_S3_UPLOAD_CONCURRENCY', '4'))
+S3_READ_BYTES = 1024 * 1024
+
+# 'thread': single process, the sync client runs as a thread of app.py (development).
+# 'sidecar': several WSGI workers (wsgi.py) plus one sync_sidecar.py process sharing an outbox database.
+SYNC_MODE = os.environ.get('SYNCSPHERE_SYNC_MODE', 'thread')
+OUTBOX_DB = os.path.join(basedir, 'outbox.db')
+ID_SLOT_DIR = os.path.join(basedir, 'id_slots')  #Lock files giving each worker process its own id range.
+GC_STATE_FILE = os.path.join(basedir, 'gc_state.json')  #Cursor and totals of the garbage collector, kept across restarts.
+TRACE_DB = os.path.join(basedir, 'traces.db')  #Replication-lag trace records of this host (read with 'python tracing.py').
+PROFILE_DIR = os.path.join(basedir, 'profiles')  #Where profiles triggered with SIGUSR2 are written.
+
+# Pending sync events. In sidecar mode every worker writes to the same cross-process outbox.
+changes_queue = SqliteOutbox(OUTBOX_DB) if SYNC_MODE == 'sidecar' else Queue()
+
+ALLOWED_EXTENSIONS = {'txt', 'pdf', 'png', 'jpg', 'jpeg', 'gif'}
+
+# At-rest compression: uploads of these types are gzipped on disk when that saves enough space
+# (stored size at most COMPRESSION_MAX_RATIO of the original). Quotas always count the original size.
+COMPRESSIBLE_EXTENSIONS = {'txt'}
+COMPRESSION_MIN_BYTES = 1024
+COMPRESSION_MAX_RATIO = 0.9
+
+# Filename search also looks inside text files: the first SEARCH_CONTENT_BYTES of each one are indexed.
+SEARCH_FILE_CONTENTS = True
+SEARCH_CONTENT_BYTES = 64 * 1024
 
-changes_queue = Queue()
+# Bounding box (pixels) of generated thumbnails and PDF previews.
+THUMBNAIL_SIZE = (256, 256)
 
-ALLOWED_EXTENSIONS = {'txt', 'pdf', 'png', 'jpg', 'jpeg', 'gif'}
\ No newline at end of file
+# How long browsers may cache a rendition. Renditions are keyed by content, so they never change.
+RENDITION_MAX_AGE = 365 * 24 * 3600
\ No newline at end of file
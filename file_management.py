@@ -1,18 +1,33 @@
 # file_management.py
 import os
 import uuid
+import zipfile
 from werkzeug.utils import secure_filename
-from models import db, File
+from models import db, File, BlobInfo, BlobEncoding
 from config import changes_queue
+from blob_cache import blob_cache
+from hot_cache import hot_cache
+from storage import blob_store
+from renditions import RenditionManager
+from compression import is_compressible_type, is_compressible, compress_in_place, open_logical, set_encoding
+from jobs import enqueue
+from search import indexes_contents
 from datetime import datetime
 from config import ALLOWED_EXTENSIONS
 
+# Read size when copying files into a streamed ZIP archive
+ARCHIVE_CHUNK_SIZE = 256 * 1024
+
+# Entry listing the files an archive could not include (their bytes were on no reachable regional)
+MISSING_MANIFEST = 'MISSING-FILES.txt'
+
 class FileManager:
     #Encapsulates file operations.
     def __init__(self, upload_folder):
         """ Initialize FileManager with a directory to store uploaded files. Creates the directory if it doesn't exist. """
         self.upload_folder = upload_folder
         os.makedirs(self.upload_folder, exist_ok=True)
+        self.renditions = RenditionManager(upload_folder)
 
     def allowed_file(self, filename):
         """ Check if the file has an allowed extension. Returns True if extension is in ALLOWED_EXTENSIONS. """
@@ -30,60 +45,102 @@ class FileManager:
         # Validate file presence
         if not file_storage or file_storage.filename == '':
             raise ValueError("No file provided.")
-        # Validate extension
-        if not self.allowed_file(file_storage.filename):
-            raise ValueError("File type not allowed.")
-
-        # Secure the original filename and generate a unique stored name
-        original_filename = secure_filename(file_storage.filename)
-        unique_filename = self.generate_unique_filename(original_filename)
-        file_path = os.path.join(self.upload_folder, unique_filename)
-
-        # Save to disk and measure file size
-        file_storage.save(file_path)
-        file_size = os.path.getsize(file_path)
-
-        # Enforce user storage quota
-        if user.used_storage + file_size > user.storage_quota:
-            os.remove(file_path)
-            raise ValueError("Storage quota exceeded.")
-
-        # Create DB record for the file
-        file_record = File(
-            user_id=           user.id,
-            stored_filename=   unique_filename,
-            original_filename= original_filename,
-            file_size=         file_size,
-            permissions=       'private'
-        )
-        db.session.add(file_record)
-
-        # Update user's used storage and commit both changes
-        user.used_storage += file_size
-        db.session.add(user)
-        db.session.commit()
+        return self.save_files([file_storage], user)[0]
 
-        # Read file content for sync event
-        with open(file_path, 'rb') as f:
-            content = f.read()
-
-        # Enqueue a file_upload event for synchronization
-        changes_queue.put({
-            "type":    "file_upload",
-            "payload": {
-                "id":                 file_record.id,
-                "user_id":            file_record.user_id,
-                "stored_filename":    file_record.stored_filename,
-                "original_filename":  file_record.original_filename,
-                "upload_date":        file_record.upload_date.isoformat(),
-                "file_size":          file_record.file_size,
-                "permissions":        file_record.permissions,
-                "content":            content
-            },
-            "timestamp": datetime.now().isoformat()
-        })
+    def save_files(self, file_storages, user):
+        """ Save several uploaded files in a single transaction: either all of them are stored or none are. Enqueues one file_upload event per file. """
+        file_storages = [fs for fs in file_storages if fs and fs.filename]
+        if not file_storages:
+            raise ValueError("No file provided.")
+        # Validate every extension before touching the disk
+        for file_storage in file_storages:
+            if not self.allowed_file(file_storage.filename):
+                raise ValueError(f"File type not allowed: {file_storage.filename}")
 
-        return file_record
+        written = []   # blobs stored so far, deleted again if anything fails
+        records = []
+        encodings = {} # stored_filename -> stored encoding, for blobs that were compressed
+        total_size = 0
+        try:
+            for file_storage in file_storages:
+                # Secure the original filename and generate a unique stored name
+                original_filename = secure_filename(file_storage.filename)
+                unique_filename = self.generate_unique_filename(original_filename)
+
+                if is_compressible_type(original_filename):
+                    # Text is kept gzipped when that pays off; file_size (and the quota) stay the original size
+                    staged = os.path.join(self.upload_folder, unique_filename + '.part')
+                    file_storage.save(staged)
+                    file_size = os.path.getsize(staged)
+                    encoding = None
+                    if is_compressible(original_filename, file_size):
+                        encoding, _ = compress_in_place(staged)
+                    if encoding:
+                        encodings[unique_filename] = encoding
+                    blob_store.put_file(unique_filename, staged)
+                else:
+                    # Streamed into the store (in parallel parts for an object store)
+                    file_size = blob_store.put(unique_filename, file_storage.stream)
+                written.append(unique_filename)
+                total_size += file_size
+
+                # Create DB record for the file
+                records.append(File(
+                    user_id=           user.id,
+                    stored_filename=   unique_filename,
+                    original_filename= original_filename,
+                    file_size=         file_size,
+                    permissions=       'private'
+                ))
+
+            # Enforce user storage quota for the whole batch. The user may come from the identity cache,
+            # so re-read the row: used_storage is written back as an absolute value
+            db.session.refresh(user)
+            if user.used_storage + total_size > user.storage_quota:
+                raise ValueError("Storage quota exceeded.")
+
+            # Update user's used storage and commit everything at once
+            db.session.add_all(records)
+            for stored_filename, encoding in encodings.items():
+                set_encoding(stored_filename, encoding)
+            user.used_storage += total_size
+            db.session.add(user)
+
+            # Derived work (previews, content indexing) runs after the request; its jobs commit with the files
+            db.session.flush()
+            for file_record in records:
+                if self.renditions.can_render(file_record.original_filename):
+                    enqueue('rendition', file_record.id, user.id)
+                if indexes_contents(file_record.stored_filename):
+                    enqueue('index_contents', file_record.id, user.id)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            for stored_filename in written:
+                blob_store.delete(stored_filename)
+            raise
+
+        for file_record in records:
+            # The owner is local, so this blob is pinned in the regional cache
+            blob_cache.pin(file_record.stored_filename)
+
+            # Enqueue a file_upload event for synchronization (the bytes are attached by send_changes)
+            changes_queue.put({
+                "type":    "file_upload",
+                "payload": {
+                    "id":                 file_record.id,
+                    "user_id":            file_record.user_id,
+                    "stored_filename":    file_record.stored_filename,
+                    "original_filename":  file_record.original_filename,
+                    "upload_date":        file_record.upload_date.isoformat(),
+                    "file_size":          file_record.file_size,
+                    "permissions":        file_record.permissions,
+                    "encoding":           encodings.get(file_record.stored_filename)  # bytes ship in their stored form
+                },
+                "timestamp": datetime.now().isoformat()
+            })
+
+        return records
 
     def list_user_files(self, user):
         """ Return a list of File records belonging to the given user. """
@@ -94,48 +151,178 @@ class FileManager:
         """
         return File.query.get(file_id)
 
+    def has_blob(self, file_record):
+        """ Check whether the file's bytes are present on this regional (they may only be replicated as metadata). """
+        return blob_store.exists(file_record.stored_filename)
+
     def delete_file(self, file_record, user, enqueue=True):
         """ Delete a file from disk and remove its DB record. Only the file owner may delete. Enqueues a file_delete sync event. """
-        if file_record.user_id != user.id:
-            # Prevent unauthorized deletions
-            raise PermissionError("You are not authorized to delete this file.")
-        # Remove file from disk
-        file_path = os.path.join(self.upload_folder, file_record.stored_filename)
-        if os.path.exists(file_path):
-            os.remove(file_path)
-        # Remove DB record
-        db.session.delete(file_record)
+        return self.delete_files([file_record], user, enqueue=enqueue)
+
+    def delete_files(self, file_records, user, enqueue=True):
+        """ Delete several files in a single transaction. Only the owner may delete. Enqueues one file_delete (or files_deleted) sync event. """
+        for file_record in file_records:
+            if file_record.user_id != user.id:
+                # Prevent unauthorized deletions
+                raise PermissionError("You are not authorized to delete this file.")
+        if not file_records:
+            return True
+
+        for file_record in file_records:
+            # Remove the bytes
+            blob_store.delete(file_record.stored_filename)
+            blob_cache.discard(file_record.stored_filename)
+            hot_cache.discard(file_record.stored_filename)
+
+        # Remove DB records (renditions are shared by content and left for the garbage collector)
+        names = [f.stored_filename for f in file_records]
+        BlobInfo.query.filter(BlobInfo.stored_filename.in_(names)).delete(synchronize_session=False)
+        BlobEncoding.query.filter(BlobEncoding.stored_filename.in_(names)).delete(synchronize_session=False)
+        for file_record in file_records:
+            db.session.delete(file_record)
         db.session.commit()
 
         # Notify other servers of deletion
         if enqueue:
-            changes_queue.put({
-                "type":    "file_delete",
-                "file_id": file_record.id,
-                "timestamp": datetime.now().isoformat()
-            })
+            if len(file_records) == 1:
+                changes_queue.put({
+                    "type":    "file_delete",
+                    "file_id": file_records[0].id,
+                    "user_id": user.id,
+                    "timestamp": datetime.now().isoformat()
+                })
+            else:
+                changes_queue.put({
+                    "type":     "files_deleted",
+                    "file_ids": [f.id for f in file_records],
+                    "user_id":  user.id,
+                    "timestamp": datetime.now().isoformat()
+                })
         return True
 
     def update_permissions(self, file_record, new_permissions, user, enqueue=True):
         """ Change the permission of a file (private or public) Only the owner may change permissions. Enqueues a permission_change sync event. """
-        if file_record.user_id != user.id:
-            # Prevent unauthorized permission changes
-            raise PermissionError("You are not authorized to change permissions for this file.")
-        file_record.permissions = new_permissions
+        self.update_permissions_bulk([file_record], new_permissions, user, enqueue=enqueue)
+        return file_record
+
+    def update_permissions_bulk(self, file_records, new_permissions, user, enqueue=True):
+        """ Change the permission of several files in a single transaction. Only the owner may change permissions. Enqueues one sync event. """
+        for file_record in file_records:
+            if file_record.user_id != user.id:
+                # Prevent unauthorized permission changes
+                raise PermissionError("You are not authorized to change permissions for this file.")
+        if not file_records:
+            return file_records
+
+        for file_record in file_records:
+            file_record.permissions = new_permissions
         db.session.commit()
 
+        # The hot-file cache only holds public files
+        if new_permissions != 'public':
+            for file_record in file_records:
+                hot_cache.discard(file_record.stored_filename)
+
         # Notify other servers of permission change
         if enqueue:
-            changes_queue.put({
-                "type":            "permission_change",
-                "file_id":         file_record.id,
-                "new_permissions": file_record.permissions,
-                "timestamp":       datetime.now().isoformat()
-            })
-        return file_record
+            if len(file_records) == 1:
+                changes_queue.put({
+                    "type":            "permission_change",
+                    "file_id":         file_records[0].id,
+                    "user_id":         user.id,
+                    "new_permissions": new_permissions,
+                    "timestamp":       datetime.now().isoformat()
+                })
+            else:
+                changes_queue.put({
+                    "type":            "permissions_changed",
+                    "file_ids":        [f.id for f in file_records],
+                    "user_id":         user.id,
+                    "new_permissions": new_permissions,
+                    "timestamp":       datetime.now().isoformat()
+                })
+        return file_records
+
+    def blob_encodings(self, file_records):
+        """ Map stored_filename -> stored encoding for those of the given files that are not stored as uploaded. """
+        names = [f.stored_filename for f in file_records]
+        if not names:
+            return {}
+        rows = BlobEncoding.query.filter(BlobEncoding.stored_filename.in_(names)).all()
+        return {r.stored_filename: r.encoding for r in rows}
+
+    def stream_archive(self, file_records):
+        """ Return a generator of a ZIP archive of the given files, chunk by chunk, without temp files and with bounded memory. Files whose bytes are not here are listed in a MISSING_MANIFEST entry instead. """
+        # Look up the stored encodings now, while the request's app context is still active
+        return self._archive_chunks(file_records, self.blob_encodings(file_records))
+
+    def _archive_chunks(self, file_records, encodings):
+        sink = _ZipSink()
+        used_names = set()
+        missing = []
+        with zipfile.ZipFile(sink, 'w') as archive:
+            for file_record in file_records:
+                if not blob_store.exists(file_record.stored_filename):
+                    missing.append(file_record.original_filename)
+                    continue
+
+                # Already-compressed formats are stored, text is deflated
+                ext = file_record.original_filename.rsplit('.', 1)[-1].lower()
+                info = zipfile.ZipInfo(
+                    _unique_name(file_record.original_filename, used_names),
+                    date_time=file_record.upload_date.timetuple()[:6]
+                )
+                info.compress_type = zipfile.ZIP_DEFLATED if ext == 'txt' else zipfile.ZIP_STORED
+
+                with open_logical(file_record.stored_filename, encodings.get(file_record.stored_filename)) as src, \
+                        archive.open(info, 'w', force_zip64=True) as dest:
+                    for chunk in iter(lambda: src.read(ARCHIVE_CHUNK_SIZE), b''):
+                        dest.write(chunk)
+                        data = sink.drain()
+                        if data:
+                            yield data
+                yield sink.drain()
+            if missing:
+                info = zipfile.ZipInfo(_unique_name(MISSING_MANIFEST, used_names), date_time=datetime.now().timetuple()[:6])
+                archive.writestr(info, "These files could not be included, their contents are not available right now:\n"
+                                       + ''.join(f"{name}\n" for name in missing))
+        # The central directory is written when the archive closes
+        yield sink.drain()
 
     def is_access_allowed(self, file_record, user):
         """ Check if the given user may access the file. Owners always allowed, otherwise only public files. """
         if file_record.user_id == user.id:
             return True
         return file_record.permissions == 'public'
+
+
+class _ZipSink:
+    #Write-only file object for zipfile; the archive bytes are handed to the response as soon as they are written.
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        """ Return and forget everything written since the last drain. """
+        data = b''.join(self.chunks)
+        self.chunks.clear()
+        return data
+
+
+def _unique_name(name, used_names):
+    """ Make archive entry names unique ('a.txt', 'a (2).txt', ...). """
+    base, dot, ext = name.rpartition('.')
+    if not dot:
+        base, ext = name, ''
+    candidate, n = name, 1
+    while candidate in used_names:
+        n += 1
+        candidate = f"{base} ({n}).{ext}" if dot else f"{base} ({n})"
+    used_names.add(candidate)
+    return candidate
@@ -1,43 +1,52 @@
-from flask import Blueprint, request, flash, redirect, url_for, send_from_directory, session
-from models import User
+import mimetypes
+
+from flask import Blueprint, Response, render_template, request, flash, redirect, url_for, send_file, abort
+from werkzeug.wsgi import FileWrapper
+from models import User, File, HomeUser, db
 from file_management import FileManager
-import os
+from blob_cache import blob_cache
+from hot_cache import hot_cache, blob_etag
+from config import UPLOAD_FOLDER, RENDITION_MAX_AGE
+from identity import get_current_user
+from rate_limit import rate_limited, limiter, too_many_requests
+from search import search_index
+from compression import get_encoding, iter_logical
+from storage import blob_store, CHUNK_SIZE
 
 # Blueprint for file operations, all routes under /files
 files_bp = Blueprint('files', __name__)
 
-# Determine absolute path to the uploads directory
-basedir    = os.path.abspath(os.path.dirname(__file__))
-upload_dir = os.path.join(basedir, 'uploads')
-
 # Instantiate FileManager with the upload folder path
-file_manager = FileManager(upload_folder=upload_dir)
-
-
-def get_current_user():
-    """ Helper to retrieve the logged-in User from session. Returns None if no valid user_id in session. """
-    user_id = session.get('user_id')
-    return User.query.get(user_id) if user_id else None
+file_manager = FileManager(upload_folder=UPLOAD_FOLDER)
 
 
 @files_bp.route('/upload', methods=['POST'])
+@rate_limited('upload', transfer=True)
 def upload():
-    """ Handle file upload: """
+    """ Handle file upload (one or several files in the same request, stored in one transaction): """
     user = get_current_user()
     if not user:
         flash("Please log in first.", "error")
         return redirect(url_for('auth.login'))
 
-    # Get the FileStorage object from the form
-    file_storage = request.files.get('file')
-    if not file_storage or not file_storage.filename:
+    # Charge the body size against the user's upload bandwidth before reading it
+    wait = limiter.charge_bytes(user.id, 'upload', request.content_length or 0)
+    if wait:
+        return too_many_requests(wait)
+
+    # Get the FileStorage objects from the form
+    file_storages = [fs for fs in request.files.getlist('file') if fs and fs.filename]
+    if not file_storages:
         flash("No file selected for upload.", "error")
         return redirect(url_for('dashboard'))
 
     try:
-        # Attempt to save file; may flash quota or type errors internally
-        file_manager.save_file(file_storage, user)
-        flash("File uploaded successfully!", "success")
+        # Attempt to save the files; may raise quota or type errors
+        records = file_manager.save_files(file_storages, user)
+        if len(records) == 1:
+            flash("File uploaded successfully!", "success")
+        else:
+            flash(f"{len(records)} files uploaded successfully!", "success")
     except ValueError as e:
         # Known validation error from FileManager
         flash(str(e), "error")
@@ -49,6 +58,7 @@ def upload():
 
 
 @files_bp.route('/download/<int:file_id>')
+@rate_limited('download', transfer=True)
 def download(file_id):
     """ Serve a file download if the user has permission. """
     user = get_current_user()
@@ -62,15 +72,255 @@ def download(file_id):
         flash("Access not allowed.", "error")
         return redirect(url_for('dashboard'))
 
+    wait = limiter.charge_bytes(user.id, 'download', file_record.file_size)
+    if wait:
+        return too_many_requests(wait)
+
+    # Popular public files are served from memory, without touching the disk or the blob cache
+    hot = hot_cache.get(file_record.stored_filename) if file_record.permissions == 'public' else None
+    if hot is None:
+        # Bytes of users who are not local here are only replicated as metadata; fetch them on demand
+        if not file_manager.has_blob(file_record):
+            from sync import fetch_blob
+            if not fetch_blob(file_record.stored_filename):
+                flash("File is temporarily unavailable, please try again later.", "error")
+                return redirect(url_for('dashboard'))
+            if db.session.get(HomeUser, file_record.user_id) is not None:
+                blob_cache.pin(file_record.stored_filename)
+
+        # Keep recently downloaded replicas at the front of the cache
+        blob_cache.touch(file_record.stored_filename)
+
+        encoding = get_encoding(file_record.stored_filename)
+        if file_record.permissions == 'public':
+            hot = hot_cache.offer(file_record.stored_filename, encoding)
+    else:
+        encoding = hot.encoding
+
+    # Compressed entries are only sent as they are; clients that cannot take the encoding get it decoded from disk
+    if hot is not None and (not hot.encoding or hot.encoding in request.accept_encodings):
+        return send_hot(file_record, hot)
+    if encoding:
+        return send_encoded(file_record, encoding)
+
     # Send the stored file under its original filename
-    return send_from_directory(
-        file_manager.upload_folder,
-        file_record.stored_filename,
-        as_attachment=True,
-        download_name=file_record.original_filename
+    return send_blob(file_record)
+
+
+@files_bp.route('/search')
+@rate_limited('search')
+def search():
+    """ Search the names (and text contents) of the user's own files and their friends' public files. """
+    user = get_current_user()
+    if not user:
+        flash("Please log in first.", "error")
+        return redirect(url_for('auth.login'))
+
+    query = request.args.get('q', '')
+    results = search_index.search(user, query)
+    owner_ids = {f.user_id for f in results}
+    owners = {u.id: u for u in User.query.filter(User.id.in_(owner_ids)).all()} if owner_ids else {}
+    return render_template('search.html', query=query, files=results, owners=owners, current_user=user)
+
+
+def send_encoded(file_record, encoding):
+    """
+    Send a blob that is stored compressed: as-is with Content-Encoding when the client accepts the encoding,
+    otherwise decompressed on the fly.
+    """
+    mimetype = mimetypes.guess_type(file_record.original_filename)[0] or 'application/octet-stream'
+
+    if encoding in request.accept_encodings:
+        response = send_blob(file_record)
+        response.headers['Content-Encoding'] = encoding
+    else:
+        response = Response(iter_logical(file_record.stored_filename, encoding), mimetype=mimetype)
+        response.headers.set('Content-Disposition', 'attachment', filename=file_record.original_filename)
+        response.headers['Content-Length'] = str(file_record.file_size)
+    # Caches must not hand the compressed body to clients that did not ask for it
+    response.headers['Vary'] = 'Accept-Encoding'
+    return response
+
+
+def send_blob(file_record):
+    """
+    Send a blob as it is stored. Local files go through send_file; object-store blobs are streamed, a Range request
+    turning into a ranged GET, so the worker never holds the whole file.
+    """
+    mimetype = mimetypes.guess_type(file_record.original_filename)[0] or 'application/octet-stream'
+    path = blob_store.local_path(file_record.stored_filename)
+    if path is not None:
+        return send_file(path, mimetype=mimetype, as_attachment=True, download_name=file_record.original_filename)
+
+    stat = blob_store.stat(file_record.stored_filename)
+    if stat is None:
+        abort(404)
+    size, mtime = stat
+    # A seekable body: for a range, werkzeug seeks the reader to the start instead of reading up to it
+    body = FileWrapper(blob_store.open(file_record.stored_filename), CHUNK_SIZE)
+    response = Response(body, mimetype=mimetype, direct_passthrough=True)
+    response.headers.set('Content-Disposition', 'attachment', filename=file_record.original_filename)
+    response.content_length = size
+    response.last_modified = mtime
+    response.cache_control.no_cache = True
+    # Same ETag format as send_file and the hot-file cache
+    response.set_etag(blob_etag(blob_store.locator(file_record.stored_filename), size, mtime))
+    return response.make_conditional(request, accept_ranges=True, complete_length=size)
+
+
+def send_hot(file_record, entry):
+    """ Send a file held by the hot-file cache, with the headers (and range/conditional handling) send_file would give it. """
+    mimetype = mimetypes.guess_type(file_record.original_filename)[0] or 'application/octet-stream'
+    response = Response(entry.chunks(), mimetype=mimetype, direct_passthrough=True)
+    response.headers.set('Content-Disposition', 'attachment', filename=file_record.original_filename)
+    response.content_length = entry.size
+    response.last_modified = entry.mtime
+    response.cache_control.no_cache = True
+    response.set_etag(entry.etag)
+    if entry.encoding:
+        response.headers['Content-Encoding'] = entry.encoding
+        response.headers['Vary'] = 'Accept-Encoding'
+    return response.make_conditional(request, accept_ranges=True, complete_length=entry.size)
+
+
+def get_selected_files(user):
+    """ Load the files selected with the 'file_ids' form field, keeping only those the user owns. """
+    file_ids = request.values.getlist('file_ids', type=int)
+    if not file_ids:
+        return []
+    return File.query.filter(File.id.in_(file_ids), File.user_id == user.id).all()
+
+
+@files_bp.route('/bulk/delete', methods=['POST'])
+@rate_limited('bulk')
+def bulk_delete():
+    """ Delete all selected files in one transaction and one sync event. """
+    user = get_current_user()
+    if not user:
+        flash("Please log in first.", "error")
+        return redirect(url_for('auth.login'))
+
+    file_records = get_selected_files(user)
+    if not file_records:
+        flash("No files selected.", "error")
+        return redirect(url_for('dashboard'))
+
+    try:
+        file_manager.delete_files(file_records, user)
+        flash(f"{len(file_records)} files deleted.", "success")
+    except Exception as e:
+        flash(str(e), "error")
+    return redirect(url_for('dashboard'))
+
+
+@files_bp.route('/bulk/permissions', methods=['POST'])
+@rate_limited('bulk')
+def bulk_permissions():
+    """ Change the permissions of all selected files in one transaction and one sync event. """
+    user = get_current_user()
+    if not user:
+        flash("Please log in first.", "error")
+        return redirect(url_for('auth.login'))
+
+    new_perm = request.form.get('permissions')
+    if new_perm not in ('private', 'public'):
+        flash("Invalid permission.", "error")
+        return redirect(url_for('dashboard'))
+
+    file_records = get_selected_files(user)
+    if not file_records:
+        flash("No files selected.", "error")
+        return redirect(url_for('dashboard'))
+
+    try:
+        file_manager.update_permissions_bulk(file_records, new_perm, user)
+        flash(f"Permissions updated for {len(file_records)} files!", "success")
+    except Exception as e:
+        flash(str(e), "error")
+    return redirect(url_for('dashboard'))
+
+
+def archive_response(user, file_records, archive_name):
+    """
+    Stream the given files as a ZIP download, fetching bytes that are not on this regional first (all at once, so the
+    wait is one FETCH_TIMEOUT at most). Files that could not be fetched are listed in the archive; if none of them
+    is available the download is refused.
+    """
+    wait = limiter.charge_bytes(user.id, 'download', sum(f.file_size or 0 for f in file_records))
+    if wait:
+        return too_many_requests(wait)
+
+    missing = {f.stored_filename for f in file_records if not file_manager.has_blob(f)}
+    if missing:
+        from sync import fetch_blobs
+        unavailable = missing - fetch_blobs(sorted(missing))
+        if all(f.stored_filename in unavailable for f in file_records):
+            flash("None of the selected files are available right now, please try again later.", "error")
+            return redirect(request.referrer or url_for('dashboard'))
+
+    return Response(
+        file_manager.stream_archive(file_records),
+        mimetype='application/zip',
+        headers={'Content-Disposition': f'attachment; filename="{archive_name}"'}
     )
 
 
+@files_bp.route('/archive', methods=['GET', 'POST'])
+@rate_limited('download', transfer=True)
+def archive():
+    """ Download the selected files as one streamed ZIP archive. """
+    user = get_current_user()
+    if not user:
+        flash("Please log in first.", "error")
+        return redirect(url_for('auth.login'))
+
+    file_records = get_selected_files(user)
+    if not file_records:
+        flash("No files selected.", "error")
+        return redirect(url_for('dashboard'))
+    return archive_response(user, file_records, f"{user.username}-files.zip")
+
+
+@files_bp.route('/thumbnail/<int:file_id>')
+@rate_limited('preview')
+def thumbnail(file_id):
+    """ Serve a small preview of an image or PDF. Renditions are immutable, so browsers may cache them for a long time. """
+    user = get_current_user()
+    file_record = file_manager.get_file_record(file_id)
+    if not user or not file_record or not file_manager.is_access_allowed(file_record, user):
+        abort(404)
+    if not file_manager.renditions.can_render(file_record.original_filename):
+        abort(404)
+
+    path, content_hash = file_manager.renditions.get(file_record)
+    if path is None:
+        # Renditions are not replicated; regenerate from the blob, fetching it first if needed
+        if not file_manager.has_blob(file_record):
+            from sync import fetch_blob
+            if not fetch_blob(file_record.stored_filename):
+                abort(404)
+        try:
+            path = file_manager.renditions.generate(file_record)
+        except Exception as e:
+            # The page just shows no preview; the rendition job records and retries the error
+            print(f"[Renditions] Could not render {file_record.stored_filename}: {e}", flush=True)
+            path = None
+        if path is None:
+            abort(404)
+        content_hash = file_manager.renditions.content_hash(file_record)
+
+    response = send_file(path, mimetype='image/jpeg', etag=content_hash, conditional=True, max_age=RENDITION_MAX_AGE)
+    # Private: the preview is only visible to users allowed to see the file
+    response.headers['Cache-Control'] = f"private, max-age={RENDITION_MAX_AGE}, immutable"
+    return response
+
+
+@files_bp.app_template_filter('has_preview')
+def has_preview(file_record):
+    """ Template filter: whether a thumbnail can be shown for this file. """
+    return file_manager.renditions.can_render(file_record.original_filename)
+
+
 @files_bp.route('/delete/<int:file_id>', methods=['POST'])
 def delete(file_id):
     """ Delete a file record and its physical file. """
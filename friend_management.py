@@ -5,8 +5,8 @@ from datetime import datetime
 class FriendManager:
     #Encapsulates friend request and friendship operations, including sending requests, responding, listing, and removal.
 
-    def send_request(self, from_user, to_user, enqueue=True):
-        """ Send a friend request from 'from_user' to 'to_user'. """
+    def send_request(self, from_user, to_user, enqueue=True, request_id=None):
+        """ Send a friend request from 'from_user' to 'to_user'. Replicated requests pass the origin's 'request_id'. """
         # Prevent sending a request to oneself
         if from_user.id == to_user.id:
             raise ValueError("Cannot friend yourself.")
@@ -41,6 +41,7 @@ class FriendManager:
 
         # Create and persist the new friend request
         fr = FriendRequest(
+            id=request_id,  # None -> a new global id
             from_user_id=from_user.id,
             to_user_id=to_user.id
         )
@@ -92,6 +93,8 @@ class FriendManager:
                 changes_queue.put({
                     "type":      "friend_added",
                     "request_id": fr.id,
+                    "from_user":  fr.from_user_id,
+                    "to_user":    fr.to_user_id,
                     "timestamp": datetime.now().isoformat()
                 })
             else:
@@ -104,6 +107,22 @@ class FriendManager:
                 })
             return fr
 
+    def accept_between(self, from_user_id, to_user_id):
+        """ Apply a replicated acceptance identified by its two users: accept the pending request if we have it, otherwise create the friendship directly. Never enqueues. """
+        fr = FriendRequest.query.filter_by(
+            from_user_id=from_user_id,
+            to_user_id=to_user_id,
+            status='pending'
+        ).first()
+        if fr:
+            return self.respond_request(fr.id, accept=True, enqueue=False)
+
+        # The request was folded into this event by compaction, so it never reached us
+        if not Friendship.query.filter_by(user_id=from_user_id, friend_id=to_user_id).first():
+            db.session.add(Friendship(user_id=from_user_id, friend_id=to_user_id))
+            db.session.add(Friendship(user_id=to_user_id,   friend_id=from_user_id))
+            db.session.commit()
+
     def get_friends(self, user):
         """ List all users who are friends with 'user'. """
         # Query one direction, then load User for each friendship
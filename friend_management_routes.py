@@ -1,19 +1,17 @@
-from flask import Blueprint, render_template, request, redirect, url_for, flash, session
+from flask import Blueprint, render_template, request, redirect, url_for, flash
 from models import User
 from friend_management import FriendManager
 from file_management import FileManager
+from config import UPLOAD_FOLDER
+from file_management_routes import archive_response
+from identity import get_current_user
+from rate_limit import rate_limited
 
 # Blueprint for friend-related routes under /friends
 friends_bp = Blueprint('friends', __name__)
 # Manager instances for business logic
 friend_manager = FriendManager()
-file_manager   = FileManager(upload_folder='uploads')
-
-
-def get_current_user():
-    """ Retrieve the logged-in user from the session. Returns None if no user is logged in. """
-    user_id = session.get('user_id')
-    return User.query.get(user_id) if user_id else None
+file_manager   = FileManager(upload_folder=UPLOAD_FOLDER)
 
 
 @friends_bp.route('/requests', methods=['GET', 'POST'])
@@ -97,27 +95,52 @@ def remove(username):
     return redirect(url_for('friends.list_friends'))
 
 
-@friends_bp.route('/<username>/files')
-def view_friend_files(username):
-    """ View files shared by a specific friend. Only files with 'public' permission or owned by the friend are shown.
-    """
-    user = get_current_user()
-    if not user:
-        return redirect(url_for('auth.login'))
-
+def get_friend_files(user, username):
+    """ Return (friend, files the user may see) for a friend's username, or (None, None) after flashing an error. """
     friend = User.query.filter_by(username=username).first()
     if not friend:
         flash("User not found.", "error")
-        return redirect(url_for('friends.list_friends'))
+        return None, None
 
     friends_list = friend_manager.get_friends(user)
     if friend not in friends_list:
         flash("You may only view files of your friends.", "error")
-        return redirect(url_for('dashboard'))
+        return None, None
 
     all_files     = file_manager.list_user_files(friend)
     # Filter out files the current user isn't allowed to see
     allowed_files = [f for f in all_files if file_manager.is_access_allowed(f, user)]
+    return friend, allowed_files
+
+
+@friends_bp.route('/<username>/files/archive')
+@rate_limited('download', transfer=True)
+def friend_files_archive(username):
+    """ Download all of a friend's public files as one streamed ZIP archive. """
+    user = get_current_user()
+    if not user:
+        return redirect(url_for('auth.login'))
+
+    friend, allowed_files = get_friend_files(user, username)
+    if friend is None:
+        return redirect(url_for('friends.list_friends'))
+    if not allowed_files:
+        flash("No files available.", "error")
+        return redirect(url_for('friends.view_friend_files', username=username))
+    return archive_response(user, allowed_files, f"{friend.username}-files.zip")
+
+
+@friends_bp.route('/<username>/files')
+def view_friend_files(username):
+    """ View files shared by a specific friend. Only files with 'public' permission or owned by the friend are shown.
+    """
+    user = get_current_user()
+    if not user:
+        return redirect(url_for('auth.login'))
+
+    friend, allowed_files = get_friend_files(user, username)
+    if friend is None:
+        return redirect(url_for('friends.list_friends'))
 
     return render_template(
         'friends_files.html',
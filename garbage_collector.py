@@ -0,0 +1,345 @@
+# garbage_collector.py
+import os
+import json
+import time
+import bisect
+from datetime import datetime
+
+from config import (UPLOAD_FOLDER, GC_STATE_FILE, GC_INTERVAL, GC_BATCH_SIZE, GC_ENTRIES_PER_SEC,
+                    GC_MIN_AGE, GC_QUARANTINE_SECONDS)
+from blob_cache import blob_cache
+from storage import blob_store, LocalStore, QUARANTINE
+from rate_limit import TokenBucket
+from sharding import shard_of, write_lock
+
+# One pass walks these in order. Blob rows are checked before renditions, so renditions whose last
+# blob row was dropped in this pass are collected in the same pass.
+PHASES = ['blobs', 'quarantine', 'files', 'blob_info', 'blob_encoding', 'renditions']
+
+# Counters of one pass (and, summed up, of all passes)
+COUNTERS = [
+    'checked',            # entries (files on disk and rows) looked at
+    'quarantined',        # orphan blobs moved to quarantine
+    'quarantined_bytes',
+    'deleted',            # quarantined blobs deleted for good
+    'reclaimed_bytes',    # disk space freed (deleted blobs and renditions)
+    'restored',           # quarantined blobs that turned out to be referenced after all
+    'stale_rows',         # BlobInfo/BlobEncoding rows about blobs that no longer exist
+    'renditions',         # renditions no blob refers to any more
+    'missing',            # home users' files whose bytes are not on this regional
+]
+
+
+def _fresh_counters():
+    return {name: 0 for name in COUNTERS}
+
+
+class GarbageCollector:
+    #Reconciles the blob store with the File table in small, rate-limited batches:
+    #unreferenced blobs go to quarantine and are deleted later, blobs referenced again are restored,
+    #and rows describing blobs that are gone are dropped. The position is saved after every batch.
+
+    def __init__(self, store, folder, state_file):
+        """ Collect garbage in the blob store and in the renditions of 'folder'; the cursor and totals are kept in 'state_file'. """
+        self.store = store
+        # Renditions are derived data and always stay on this host
+        self.renditions = LocalStore(os.path.join(folder, 'renditions'))
+        self.state_file = state_file
+        self.bucket = TokenBucket(GC_ENTRIES_PER_SEC, GC_BATCH_SIZE)
+        self.listing = None  # (phase, sorted blob names) of the store walked right now
+        self.state = self._load()
+
+    # --- persisted state -----------------------------------------------------------------
+
+    def _load(self):
+        """ Read the saved cursor, or start a new pass if there is none. """
+        try:
+            with open(self.state_file) as f:
+                state = json.load(f)
+            if state.get('phase') in PHASES:
+                return state
+        except (OSError, ValueError):
+            pass
+        return {'phase': PHASES[0], 'cursor': None, 'pass': _fresh_counters(),
+                'totals': _fresh_counters(), 'last_pass': None}
+
+    def _save(self):
+        """ Write the state atomically, so a crash never leaves a half-written cursor. """
+        tmp = self.state_file + '.part'
+        with open(tmp, 'w') as f:
+            json.dump(self.state, f)
+        os.replace(tmp, self.state_file)
+
+    def _count(self, name, amount=1):
+        self.state['pass'][name] += amount
+
+    def get_stats(self):
+        """ Totals of all finished passes, plus the counters of the pass in progress. """
+        return {'totals': dict(self.state['totals']), 'current_pass': dict(self.state['pass']),
+                'phase': self.state['phase'], 'last_pass': self.state['last_pass']}
+
+    # --- walking ---------------------------------------------------------------------------
+
+    def _throttle(self, entries):
+        """ Keep to GC_ENTRIES_PER_SEC, so a pass never competes with requests for the disk or the database. """
+        while True:
+            wait = self.bucket.consume(entries)
+            if not wait:
+                return
+            time.sleep(wait)
+
+    def _next_names(self, store, prefix=''):
+        """ Next batch of blob names under 'prefix' after the cursor. The store is listed once per phase. """
+        phase = self.state['phase']
+        if self.listing is None or self.listing[0] != phase:
+            names = sorted(name for name, _, _ in store.scan(prefix))
+            self.listing = (phase, names)
+        names = self.listing[1]
+        start = bisect.bisect_right(names, self.state['cursor'] or '')
+        return names[start:start + GC_BATCH_SIZE]
+
+    def _old_files(self, store, prefix, names, min_age):
+        """ (name, size) of the given blobs under 'prefix' last modified at least 'min_age' seconds ago. """
+        now = time.time()
+        result = []
+        for name in names:
+            stat = store.stat(prefix + name)
+            if stat is not None and now - stat[1] >= min_age:
+                result.append((name, stat[0]))
+        return result
+
+    def step(self):
+        """ Process one batch of the current phase. Returns False once the pass is complete. """
+        from app import app
+
+        phase = self.state['phase']
+        with app.app_context():
+            cursor = getattr(self, f"_step_{phase}")()
+        if cursor is None:
+            # Phase finished; the next one starts from the beginning
+            self.listing = None
+            index = PHASES.index(phase) + 1
+            if index == len(PHASES):
+                self._finish_pass()
+                self._save()
+                return False
+            self.state['phase'] = PHASES[index]
+        self.state['cursor'] = cursor
+        self._save()
+        return True
+
+    def _finish_pass(self):
+        """ Report the pass, add it to the totals and rewind. """
+        counters = self.state['pass']
+        for name in COUNTERS:
+            self.state['totals'][name] += counters[name]
+        self.state.update({'phase': PHASES[0], 'cursor': None, 'pass': _fresh_counters(),
+                           'last_pass': datetime.now().isoformat()})
+        print(f"[GC] Pass complete: {counters['checked']} entries checked, {counters['quarantined']} blobs quarantined "
+              f"({counters['quarantined_bytes']} bytes), {counters['deleted']} deleted, {counters['restored']} restored, "
+              f"{counters['stale_rows']} stale rows, {counters['renditions']} renditions removed, "
+              f"{counters['reclaimed_bytes']} bytes reclaimed, {counters['missing']} home files without bytes", flush=True)
+
+    def run_pass(self):
+        """ Run (or resume) a pass to its end. """
+        while self.step():
+            pass
+
+    # --- phases ----------------------------------------------------------------------------
+    # Each returns the new cursor, or None when the phase has nothing left.
+
+    def _referenced(self, names):
+        """ The subset of stored filenames that some File row refers to. """
+        from models import File
+        if not names:
+            return set()
+        rows = File.query.filter(File.stored_filename.in_(names)).with_entities(File.stored_filename).all()
+        return {r.stored_filename for r in rows}
+
+    def _step_blobs(self):
+        """ Quarantine blobs that no File row refers to (including leftover .part files of the local store). """
+        names = self._next_names(self.store)
+        if not names:
+            return None
+        self._throttle(len(names))
+        self._count('checked', len(names))
+
+        candidates = self._old_files(self.store, '', names, GC_MIN_AGE)
+        referenced = self._referenced([name for name, _ in candidates])
+        for name, size in candidates:
+            if name not in referenced:
+                self._quarantine(name, size)
+        return names[-1]
+
+    def _step_quarantine(self):
+        """ Restore quarantined blobs that are referenced again; delete the others once their quarantine is over. """
+        names = self._next_names(self.store, QUARANTINE)
+        if not names:
+            return None
+        self._throttle(len(names))
+        self._count('checked', len(names))
+
+        referenced = self._referenced(names)
+        expired = []
+        for name, size in self._old_files(self.store, QUARANTINE, names, 0):
+            if name in referenced:
+                self._restore(name)
+                continue
+            stat = self.store.stat(QUARANTINE + name)
+            if stat is None or time.time() - stat[1] < GC_QUARANTINE_SECONDS:
+                continue
+            self.store.delete(QUARANTINE + name)
+            expired.append(name)
+            self._count('deleted')
+            self._count('reclaimed_bytes', size)
+            print(f"[GC] Deleted orphan blob {name} ({size} bytes)", flush=True)
+        self._drop_blob_rows(expired)
+        return names[-1]
+
+    def _step_files(self):
+        """ Check that file rows have their bytes: bring back quarantined ones, count home users' files whose bytes are gone. """
+        from models import File, HomeUser
+
+        cursor = self.state['cursor'] or 0
+        # Each shard returns its own first rows; merge them
+        records = File.query.filter(File.id > cursor).order_by(File.id).limit(GC_BATCH_SIZE).all()
+        records = sorted(records, key=lambda r: r.id)[:GC_BATCH_SIZE]
+        if not records:
+            return None
+        self._throttle(len(records))
+        self._count('checked', len(records))
+
+        missing = []
+        for rec in records:
+            if self.store.exists(rec.stored_filename):
+                continue
+            if self.store.exists(QUARANTINE + rec.stored_filename):
+                self._restore(rec.stored_filename)
+            else:
+                missing.append(rec)
+
+        # Other users' bytes may legitimately live only on other regionals (interest routing, lazy blobs)
+        owners = {rec.user_id for rec in missing}
+        home = {h.user_id for h in HomeUser.query.filter(HomeUser.user_id.in_(owners)).all()} if owners else set()
+        for rec in missing:
+            if rec.user_id in home:
+                self._count('missing')
+                print(f"[GC] File {rec.id} of home user {rec.user_id} has no bytes ({rec.stored_filename})", flush=True)
+        return records[-1].id
+
+    def _step_blob_info(self):
+        """ Drop content hashes of blobs that neither a File row nor the store knows any more. """
+        from models import BlobInfo
+        return self._step_blob_rows(BlobInfo)
+
+    def _step_blob_encoding(self):
+        """ Drop stored encodings of blobs that neither a File row nor the store knows any more. """
+        from models import BlobEncoding
+        return self._step_blob_rows(BlobEncoding)
+
+    def _step_blob_rows(self, model):
+        cursor = self.state['cursor'] or ''
+        rows = model.query.filter(model.stored_filename > cursor).order_by(model.stored_filename) \
+            .limit(GC_BATCH_SIZE).all()
+        names = sorted(r.stored_filename for r in rows)[:GC_BATCH_SIZE]
+        if not names:
+            return None
+        self._throttle(len(names))
+        self._count('checked', len(names))
+
+        # Rows of blobs still stored are left to the blob walk, which drops them with the blob
+        referenced = self._referenced(names)
+        stale = [n for n in names if n not in referenced and not self.store.exists(n)
+                 and not self.store.exists(QUARANTINE + n)]
+        self._drop_blob_rows(stale)
+        return names[-1]
+
+    def _step_renditions(self):
+        """ Remove renditions whose content no blob row refers to. They are derived data, so no quarantine. """
+        from models import BlobInfo
+
+        names = self._next_names(self.renditions)
+        if not names:
+            return None
+        self._throttle(len(names))
+        self._count('checked', len(names))
+
+        candidates = self._old_files(self.renditions, '', names, GC_MIN_AGE)
+        hashes = {name: name.split('.', 1)[0] for name, _ in candidates}
+        rows = BlobInfo.query.filter(BlobInfo.content_hash.in_(set(hashes.values()))) \
+            .with_entities(BlobInfo.content_hash).all() if hashes else []
+        used = {r.content_hash for r in rows}
+        for name, size in candidates:
+            # Finished renditions are '<hash>.jpg'; anything else here is a leftover of a failed render
+            if name == f"{hashes[name]}.jpg" and hashes[name] in used:
+                continue
+            if not self.renditions.exists(name):
+                continue
+            self.renditions.delete(name)
+            self._count('renditions')
+            self._count('reclaimed_bytes', size)
+        return names[-1]
+
+    # --- actions ---------------------------------------------------------------------------
+
+    def _quarantine(self, name, size):
+        """ Move an unreferenced blob into quarantine. Its mtime marks the start of the quarantine. """
+        try:
+            self.store.move(name, QUARANTINE + name)
+        except FileNotFoundError:
+            return
+        self.store.touch(QUARANTINE + name)
+        blob_cache.discard(name)
+        self._count('quarantined')
+        self._count('quarantined_bytes', size)
+        print(f"[GC] Quarantined orphan blob {name} ({size} bytes)", flush=True)
+
+    def _restore(self, name):
+        """ Put a quarantined blob back, e.g. because its File row was merged after the blob walk saw it. """
+        if self.store.exists(name):
+            # The bytes arrived again meanwhile; the quarantined copy is redundant
+            self.store.delete(QUARANTINE + name)
+            return
+        stat = self.store.stat(QUARANTINE + name)
+        if stat is None:
+            return
+        try:
+            self.store.move(QUARANTINE + name, name)
+        except FileNotFoundError:
+            return
+        size = stat[0]
+        if blob_cache.is_locally_owned(name):
+            blob_cache.pin(name)
+        else:
+            blob_cache.add(name, size)
+        self._count('restored')
+        print(f"[GC] Restored {name} from quarantine", flush=True)
+
+    def _drop_blob_rows(self, names):
+        """ Delete the BlobInfo/BlobEncoding rows of blobs that are gone. """
+        from models import db, BlobInfo, BlobEncoding
+        if not names:
+            return
+        with write_lock({shard_of(n) for n in names}):
+            try:
+                for model in (BlobInfo, BlobEncoding):
+                    self._count('stale_rows', model.query.filter(model.stored_filename.in_(names))
+                                .delete(synchronize_session=False))
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                raise
+
+
+# Collector of this regional's blobs
+garbage_collector = GarbageCollector(blob_store, UPLOAD_FOLDER, GC_STATE_FILE)
+
+
+def gc_loop():
+    """ Background loop: run a garbage collection pass every GC_INTERVAL seconds (resuming an interrupted one first). """
+    while True:
+        try:
+            garbage_collector.run_pass()
+        except Exception as e:
+            print(f"[GC] Pass interrupted: {e}", flush=True)
+        time.sleep(GC_INTERVAL)
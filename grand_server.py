@@ -5,8 +5,12 @@ import threading
 import json
 import time
 import ssl
+import random
+import itertools
 
-from config import BIND_HOST, GRAND_PORT, certfile, keyfile
+from config import BIND_HOST, GRAND_PORT, certfile, keyfile, PREFETCH_THRESHOLD, FETCH_TIMEOUT
+from tracing import stamp, trace_buffer
+from profiler import install_signal_handler
 
 # How often (in seconds) to prompt regionals for changes
 SYNC_INTERVAL = 30  # 1 sync every 30 seconds
@@ -21,6 +25,78 @@ history = []
 clients = []
 clients_lock = threading.Lock()  # ensure one thread at a time touches clients list
 
+# Routing index: regional socket -> {"region": id, "home": set(user ids), "friends": set(user ids), "lazy": bool}
+subscriptions = {}
+
+# Which regional uploaded each file, so on-demand fetches go straight to the origin
+blob_origins = {}
+
+# What we know about each file from the events we relayed, for prefetch hints
+blob_info = {}     # stored_filename -> {"file_size": int, "public": bool, "fetches": int}
+file_names = {}    # file id -> stored_filename
+
+# Fetches in flight: stored_filename -> {"waiters": [sockets], "peers": sockets still to answer, "started": time}.
+# Entries older than FETCH_TIMEOUT are given up (their waiters stopped waiting long ago) and asked again.
+pending_fetches = {}
+fetch_lock = threading.Lock()
+
+# Holder queries in flight: request id -> {"requester": socket, "peers": sockets still to answer, "held": set of names}
+pending_holders = {}
+
+# Anti-entropy rounds in flight: session id -> {"initiator": socket, "peer": socket}
+ae_sessions = {}
+ae_lock = threading.Lock()
+
+# Bulk lanes: extra connections of a regional that carry file bytes in chunks next to its control connection,
+# so metadata never waits behind file data. Each lane has its own write lock; control writes use clients_lock.
+links = {}        # link id -> control connection
+bulk_lanes = {}   # control connection -> [bulk connections]
+lane_locks = {}   # bulk connection -> lock serializing writes to it
+transfers = {}    # transfer id -> {"source": bulk connection, "targets": [(control connection, bulk connection or None)]}
+lanes_lock = threading.Lock()
+
+# How long a bulk lane may wait for its control connection to introduce itself
+LANE_ATTACH_TIMEOUT = 5
+
+
+def needs_content(event, interest):
+    """ Decide whether a regional needs the bytes of a file_upload event, based on its registered interest. """
+    if interest is None:
+        # Not subscribed (yet): fall back to full replication
+        return True
+    if interest.get('lazy'):
+        # Lazy regionals only want metadata; bytes are fetched on first download
+        return False
+    owner = event['payload'].get('user_id')
+    return owner in interest['home'] or owner in interest['friends']
+
+
+def route_events(events, interest):
+    """
+    Filter one batch for a single subscriber. Metadata always replicates everywhere;
+    file bytes only go to regionals that registered interest in the file's owner.
+    """
+    routed = []
+    for event in events:
+        if event.get('type') == 'file_upload' and not needs_content(event, interest):
+            payload = dict(event['payload'])
+            payload['content'] = None  # metadata-only, fetched on demand
+            event = dict(event, payload=payload)
+        routed.append(event)
+    return routed
+
+
+def send_routed(conn, events, cache):
+    """ Send a batch to one regional after routing it. Identical routed batches are serialized only once. """
+    routed = route_events(events, subscriptions.get(conn))
+    key = tuple(e.get('payload', {}).get('content') is not None for e in routed)
+    data = cache.get(key)
+    if data is None:
+        data = (json.dumps({'type': 'receive', 'events': routed}) + '\n').encode('utf-8')
+        cache[key] = data
+    conn.sendall(data)
+    return len(data)
+
 
 def send_history(conn):
     """
@@ -28,13 +104,12 @@ def send_history(conn):
     to this newly connected regional_server.
     """
     cutoff = time.time() - HISTORY_WINDOW
-    # send each batch whose timestamp is within the window
-    for entry in history:
+    # send each batch whose timestamp is within the window, routed by the regional's interest
+    for entry in list(history):
         if entry["ts"] < cutoff:
             continue
-        packet = json.dumps({'type': 'receive', 'events': entry["events"]}) + '\n'
         try:
-            conn.sendall(packet.encode('utf-8'))
+            send_routed(conn, entry["events"], {})
         except Exception as e:
             print(f"[GrandServer] Failed to replay history to {conn.getpeername()}: {e}", flush=True)
 
@@ -53,12 +128,8 @@ def accept_loop(server_sock, context):
                 raw_conn.close()
                 continue
 
-            # add to clients under lock
-            with clients_lock:
-                clients.append(conn)
-
-            # replay missed-history batches
-            send_history(conn)
+            # the handler adds control connections to clients once it has seen their first line;
+            # missed-history batches are replayed once the regional registers its interest
 
             # start handler thread
             threading.Thread(target=client_handler, args=(conn,), daemon=True).start()
@@ -73,7 +144,19 @@ def client_handler(conn):
     addr = conn.getpeername()
     f = conn.makefile('r')  # treat socket as file for line-based reading
     try:
-        for line in f:
+        first_line = f.readline()
+        hello = json.loads(first_line)
+    except Exception:
+        first_line, hello = '', {}
+    if hello.get('type') == 'hello' and hello.get('lane') == 'bulk':
+        bulk_handler(conn, f, hello)
+        return
+
+    # add to clients under lock
+    with clients_lock:
+        clients.append(conn)
+    try:
+        for line in itertools.chain([first_line], f):
             line = line.strip()
             if not line:
                 continue
@@ -85,20 +168,87 @@ def client_handler(conn):
                 continue
 
             mtype = msg.get('type')
-            if mtype == 'changes':
+            if mtype == 'hello':
+                # A control connection; its bulk lanes will present the same link id
+                with lanes_lock:
+                    links[msg.get('link')] = conn
+            elif mtype == 'changes':
                 events = msg.get('events', [])
+                arrived = time.time()
+                for event in events:
+                    stamp(event, 'hub_in', arrived)
                 print(f"[GrandServer] Received {len(events)} events from {addr}", flush=True)
+                track_files(events, conn)
                 broadcast(events, exclude=conn)
+            elif mtype == 'subscribe':
+                first = conn not in subscriptions
+                subscriptions[conn] = {
+                    'region':  msg.get('region'),
+                    'home':    set(msg.get('home', [])),
+                    'friends': set(msg.get('friends', [])),
+                    'lazy':    bool(msg.get('lazy'))
+                }
+                print(f"[GrandServer] Region {msg.get('region')} at {addr} subscribed to "
+                      f"{len(msg.get('home', []))} home users", flush=True)
+                if first:
+                    # replay missed-history batches, now that we know what this regional needs
+                    with clients_lock:
+                        send_history(conn)
+            elif mtype == 'fetch':
+                relay_fetch(conn, msg.get('stored_filename'))
+            elif mtype == 'blob':
+                relay_blob(conn, msg)
+            elif mtype == 'holders':
+                relay_holders(conn, msg)
+            elif mtype == 'holders_reply':
+                relay_holders_reply(conn, msg)
+            elif mtype == 'ae':
+                relay_anti_entropy(conn, msg)
+            elif mtype == 'ae_reply':
+                relay_anti_entropy_reply(msg)
+            elif mtype == 'chunk':
+                # A regional without bulk lanes sends chunks on its control connection
+                relay_chunk(conn, None, msg, line + '\n')
             else:
                 print(f"[GrandServer] Unknown message type from {addr}: {mtype}", flush=True)
 
     except Exception as e:
         print(f"[GrandServer] Connection error from {addr}: {e}", flush=True)
     finally:
-        # remove disconnected client
+        # remove disconnected client and everything routed through it
         with clients_lock:
             if conn in clients:
                 clients.remove(conn)
+            subscriptions.pop(conn, None)
+            for name in [n for n, origin in blob_origins.items() if origin is conn]:
+                del blob_origins[name]
+        with ae_lock:
+            for sid in [s for s, e in ae_sessions.items() if conn in (e["initiator"], e["peer"])]:
+                del ae_sessions[sid]
+        # A regional that went away holds nothing; queries waiting for it are answered without it
+        with fetch_lock:
+            for request_id in [r for r, e in pending_holders.items() if e["requester"] is conn]:
+                del pending_holders[request_id]
+            waiting = [r for r, e in pending_holders.items() if conn in e["peers"]]
+        for request_id in waiting:
+            relay_holders_reply(conn, {'request': request_id, 'stored_filenames': []})
+        with fetch_lock:
+            for name, entry in list(pending_fetches.items()):
+                entry["waiters"] = [w for w in entry["waiters"] if w is not conn]
+                if not entry["waiters"]:
+                    del pending_fetches[name]
+            missing = [n for n, e in pending_fetches.items() if conn in e["peers"]]
+        for name in missing:
+            relay_blob(conn, {'type': 'blob', 'stored_filename': name, 'content': None})
+        with lanes_lock:
+            for link in [l for l, c in links.items() if c is conn]:
+                del links[link]
+            lanes = bulk_lanes.pop(conn, [])
+        for lane in lanes:
+            try:
+                lane.close()
+            except:
+                pass
         try:
             conn.close()
         except:
@@ -106,6 +256,54 @@ def client_handler(conn):
         print(f"[GrandServer] Regional disconnected: {addr}", flush=True)
 
 
+def bulk_handler(conn, f, hello):
+    """ Serve one bulk lane: attach it to its regional's control connection, then relay the chunks sent on it. """
+    addr = conn.getpeername()
+    owner = None
+    deadline = time.time() + LANE_ATTACH_TIMEOUT
+    while owner is None and time.time() < deadline:
+        # The control connection's hello may still be on its way
+        with lanes_lock:
+            owner = links.get(hello.get('link'))
+        if owner is None:
+            time.sleep(0.05)
+    if owner is None:
+        print(f"[GrandServer] Bulk lane from {addr} has no control connection, closing", flush=True)
+        conn.close()
+        return
+
+    with lanes_lock:
+        bulk_lanes.setdefault(owner, []).append(conn)
+        lane_locks[conn] = threading.Lock()
+    print(f"[GrandServer] Bulk lane attached from {addr}", flush=True)
+    try:
+        for line in f:
+            try:
+                msg = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if msg.get('type') == 'chunk':
+                relay_chunk(owner, conn, msg, line)
+    except Exception as e:
+        print(f"[GrandServer] Bulk lane error from {addr}: {e}", flush=True)
+    finally:
+        with lanes_lock:
+            if conn in bulk_lanes.get(owner, []):
+                bulk_lanes[owner].remove(conn)
+            lane_locks.pop(conn, None)
+            # Receivers of transfers cut off mid-way drop their partial data
+            cut = [tid for tid, t in transfers.items() if t["source"] is conn]
+            aborted = [(tid, transfers.pop(tid)["targets"]) for tid in cut]
+        for tid, targets in aborted:
+            data = (json.dumps({'type': 'chunk', 'transfer': tid, 'abort': True}) + '\n').encode('utf-8')
+            for target, lane in targets:
+                send_chunk(target, lane, data)
+        try:
+            conn.close()
+        except:
+            pass
+
+
 def sync_loop():
     """Every SYNC_INTERVAL seconds, send 'send' to all live regionals."""
     while True:
@@ -127,6 +325,7 @@ def sync_loop():
                             pass
                         print(f"[GrandServer] Error sending sync request to {addr}: {e}", flush=True)
                         clients.remove(conn)
+                        subscriptions.pop(conn, None)
                         try:
                             conn.close()
                         except:
@@ -137,10 +336,235 @@ def sync_loop():
             time.sleep(1)
 
 
+def track_files(events, origin):
+    """ Remember each file's origin regional, size and visibility from the events passing through the hub. """
+    for event in events:
+        etype = event.get('type')
+        if etype == 'file_upload':
+            payload = event['payload']
+            name = payload['stored_filename']
+            blob_origins[name] = origin
+            file_names[payload['id']] = name
+            blob_info[name] = {
+                "file_size": payload.get('file_size', 0),
+                "public":    payload.get('permissions') == 'public',
+                "fetches":   0
+            }
+        elif etype in ('permission_change', 'permissions_changed'):
+            for fid in event.get('file_ids', [event.get('file_id')]):
+                info = blob_info.get(file_names.get(fid))
+                if info:
+                    info["public"] = event.get('new_permissions') == 'public'
+        elif etype in ('file_delete', 'files_deleted'):
+            for fid in event.get('file_ids', [event.get('file_id')]):
+                name = file_names.pop(fid, None)
+                blob_info.pop(name, None)
+                blob_origins.pop(name, None)
+
+
+def hint_prefetch(requester, stored_filename):
+    """ Count a fetch; once a public file has been fetched PREFETCH_THRESHOLD times, hint every other regional to prefetch it. """
+    info = blob_info.get(stored_filename)
+    if not info:
+        return
+    info["fetches"] += 1
+    if not info["public"] or info["fetches"] != PREFETCH_THRESHOLD:
+        return
+
+    data = (json.dumps({
+        'type': 'prefetch',
+        'stored_filename': stored_filename,
+        'file_size': info["file_size"]
+    }) + '\n').encode('utf-8')
+    with clients_lock:
+        for conn in clients:
+            if conn is requester or conn is blob_origins.get(stored_filename):
+                continue
+            try:
+                conn.sendall(data)
+            except Exception as e:
+                print(f"[GrandServer] Prefetch hint error: {e}", flush=True)
+
+
+def relay_fetch(requester, stored_filename):
+    """ Forward an on-demand fetch to the file's origin regional, or to every other regional if the origin is unknown. """
+    hint_prefetch(requester, stored_filename)
+    with clients_lock:
+        origin = blob_origins.get(stored_filename)
+        if origin in clients and origin is not requester:
+            peers = [origin]
+        else:
+            peers = [c for c in clients if c is not requester]
+
+    if not peers:
+        send_blob(requester, {'type': 'blob', 'stored_filename': stored_filename, 'content': None})
+        return
+
+    with fetch_lock:
+        entry = pending_fetches.get(stored_filename)
+        if entry and time.time() - entry["started"] <= FETCH_TIMEOUT:
+            # Someone already asked for this file; share the answer
+            if requester not in entry["waiters"]:
+                entry["waiters"].append(requester)
+            return
+        pending_fetches[stored_filename] = {"waiters": [requester], "peers": set(peers), "started": time.time()}
+    if entry:
+        print(f"[GrandServer] Fetch of {stored_filename} got no answer, asking again", flush=True)
+
+    data = (json.dumps({'type': 'fetch', 'stored_filename': stored_filename}) + '\n').encode('utf-8')
+    for peer in peers:
+        try:
+            with clients_lock:
+                peer.sendall(data)
+        except Exception as e:
+            print(f"[GrandServer] Fetch relay error: {e}", flush=True)
+            relay_blob(peer, {'type': 'blob', 'stored_filename': stored_filename, 'content': None})
+
+
+def relay_blob(peer, msg):
+    """ Pass a peer's fetch answer to the waiting regionals. A miss is only reported once every asked peer has missed. """
+    stored_filename = msg.get('stored_filename')
+    with fetch_lock:
+        entry = pending_fetches.get(stored_filename)
+        if entry is None or peer not in entry["peers"]:
+            return
+        entry["peers"].discard(peer)
+        if msg.get('content') is None and entry["peers"]:
+            return
+        del pending_fetches[stored_filename]
+
+    for waiter in entry["waiters"]:
+        send_blob(waiter, msg)
+
+
+def relay_holders(requester, msg):
+    """ Ask every other regional which of the named blobs it keeps pinned, so the requester can evict its replicas of those. """
+    request_id = msg.get('request')
+    with clients_lock:
+        peers = [c for c in clients if c is not requester]
+    if not peers:
+        send_blob(requester, {'type': 'holders_reply', 'request': request_id, 'stored_filenames': []})
+        return
+
+    with fetch_lock:
+        pending_holders[request_id] = {"requester": requester, "peers": set(peers), "held": set()}
+    data = (json.dumps({'type': 'holders', 'request': request_id,
+                        'stored_filenames': msg.get('stored_filenames', [])}) + '\n').encode('utf-8')
+    for peer in peers:
+        try:
+            with clients_lock:
+                peer.sendall(data)
+        except Exception as e:
+            print(f"[GrandServer] Holder query relay error: {e}", flush=True)
+            relay_holders_reply(peer, {'request': request_id, 'stored_filenames': []})
+
+
+def relay_holders_reply(peer, msg):
+    """ Collect one regional's answer to a holder query. The requester gets the union once every asked regional answered. """
+    request_id = msg.get('request')
+    with fetch_lock:
+        entry = pending_holders.get(request_id)
+        if entry is None or peer not in entry["peers"]:
+            return
+        entry["peers"].discard(peer)
+        entry["held"].update(msg.get('stored_filenames', []))
+        if entry["peers"]:
+            return
+        del pending_holders[request_id]
+
+    send_blob(entry["requester"], {'type': 'holders_reply', 'request': request_id,
+                                   'stored_filenames': sorted(entry["held"])})
+
+
+def send_blob(conn, msg):
+    """ Send a fetch answer to one regional, ignoring regionals that went away meanwhile. """
+    try:
+        with clients_lock:
+            conn.sendall((json.dumps(msg) + '\n').encode('utf-8'))
+    except Exception as e:
+        print(f"[GrandServer] Blob delivery error: {e}", flush=True)
+
+
+def chunk_targets(origin, msg):
+    """ Regionals that get a transfer, decided on its first chunk: fetch answers go to the waiting regionals, uploads to interested ones. """
+    if msg.get('kind') == 'blob':
+        with fetch_lock:
+            entry = pending_fetches.pop(msg.get('stored_filename'), None)
+        return entry["waiters"] if entry else []
+    upload = {'payload': {'user_id': msg.get('user_id')}}
+    with clients_lock:
+        return [c for c in clients if c is not origin and needs_content(upload, subscriptions.get(c))]
+
+
+def relay_chunk(origin, source, msg, line):
+    """ Forward one chunk of a transfer. All chunks of a transfer use the same lane per receiver, so they stay in order. """
+    tid = msg.get('transfer')
+    if msg.get('seq') == 0:
+        targets = chunk_targets(origin, msg)
+        with lanes_lock:
+            routed = []
+            for target in targets:
+                lanes = bulk_lanes.get(target)
+                routed.append((target, lanes[hash(tid) % len(lanes)] if lanes else None))
+            transfers[tid] = {"source": source, "targets": routed}
+
+    with lanes_lock:
+        entry = transfers.get(tid)
+        if entry is not None and msg.get('last'):
+            del transfers[tid]
+    if entry is None:
+        return
+
+    data = line.encode('utf-8')
+    for target, lane in entry["targets"]:
+        send_chunk(target, lane, data)
+
+
+def send_chunk(target, lane, data):
+    """ Write a chunk to a regional's bulk lane (or its control connection if it has none), skipping lanes that closed. """
+    try:
+        if lane is None:
+            with clients_lock:
+                target.sendall(data)
+            return
+        lock = lane_locks.get(lane)
+        if lock is None:
+            return
+        with lock:
+            lane.sendall(data)
+    except Exception as e:
+        print(f"[GrandServer] Chunk delivery error: {e}", flush=True)
+
+
+def relay_anti_entropy(initiator, msg):
+    """ Forward an anti-entropy request to the round's peer. The first request of a round picks a random other regional. """
+    sid = msg.get('session')
+    with ae_lock:
+        entry = ae_sessions.get(sid)
+        if entry is None:
+            with clients_lock:
+                peers = [c for c in clients if c is not initiator]
+            if not peers:
+                send_blob(initiator, {'type': 'ae_reply', 'session': sid, 'op': 'abort'})
+                return
+            entry = ae_sessions[sid] = {"initiator": initiator, "peer": random.choice(peers)}
+        if msg.get('op') == 'done':
+            del ae_sessions[sid]
+    send_blob(entry["peer"], msg)
+
+
+def relay_anti_entropy_reply(msg):
+    """ Pass a peer's anti-entropy answer back to the regional running the round. """
+    with ae_lock:
+        entry = ae_sessions.get(msg.get('session'))
+    if entry:
+        send_blob(entry["initiator"], msg)
+
+
 def broadcast(events, exclude=None):
     """
-    Broadcast received events to every regional except the sender,
-    and record each batch with a timestamp for history-window replay.
+    Broadcast received events to every regional except the sender, routed per
+    subscriber, and record each batch with a timestamp for history-window replay.
     """
     # record this batch with the current time
     history.append({
@@ -151,15 +575,20 @@ def broadcast(events, exclude=None):
     cutoff = time.time() - HISTORY_WINDOW
     history[:] = [h for h in history if h["ts"] >= cutoff]
 
-    packet = json.dumps({'type': 'receive', 'events': events}) + '\n'
-    data = packet.encode('utf-8')
+    # Stamped before the routed copies are built, so every subscriber sees the same hub times
+    now = time.time()
+    for event in events:
+        stamp(event, 'hub_out', now)
+    trace_buffer.record('hub', events, region=None)
 
+    cache = {}  # routed batches shared between subscribers with the same needs
+    sent = 0
     with clients_lock:
         for conn in list(clients):
             if conn is exclude:
                 continue
             try:
-                conn.sendall(data)
+                sent += send_routed(conn, events, cache)
             except Exception as e:
                 addr = None
                 try:
@@ -168,13 +597,18 @@ def broadcast(events, exclude=None):
                     pass
                 print(f"[GrandServer] Broadcast error to {addr}: {e}", flush=True)
                 clients.remove(conn)
+                subscriptions.pop(conn, None)
                 try:
                     conn.close()
                 except:
                     pass
+    print(f"[GrandServer] Fanned out {sent} bytes", flush=True)
 
 
 def main():
+    # 'kill -USR2 <pid>' writes a profile of the handler threads to PROFILE_DIR
+    install_signal_handler('grand_server')
+
     # Create TCP listening socket
     server_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     # allow quick reuse after restart
@@ -0,0 +1,44 @@
+# gunicorn.conf.py
+import multiprocessing
+import os
+
+# One worker per core; each worker also runs a few threads for slow transfers
+workers = int(os.environ.get('SYNCSPHERE_WORKERS', multiprocessing.cpu_count()))
+threads = int(os.environ.get('SYNCSPHERE_THREADS', 4))
+# Every open page holds a /live/stream connection. With gevent installed the workers default to it, and an idle
+# stream costs a greenlet (worker_connections caps the streams per worker). Thread workers spend a thread per stream,
+# so they hold at most half of SYNCSPHERE_THREADS streams and keep the rest for requests; pages over that limit
+# do not update live. Raise SYNCSPHERE_THREADS for more, or pip install gevent.
+try:
+    import gevent
+    default_worker_class = 'gevent'
+except ImportError:
+    default_worker_class = 'gthread'
+worker_class = os.environ.get('SYNCSPHERE_WORKER_CLASS', default_worker_class)
+worker_connections = 10000
+if worker_class == 'gthread':
+    # Read by config.py, so it must be set before config is imported (the workers are forked with it loaded)
+    os.environ.setdefault('SYNCSPHERE_LIVE_MAX_STREAMS', str(threads // 2))
+
+import config
+
+bind = "0.0.0.0:5000"
+
+# Same self-signed certificate as the development server
+certfile = config.certfile
+keyfile = config.keyfile
+
+# Uploads and ZIP streams can take a while
+timeout = 120
+
+
+def on_starting(server):
+    """ Create tables once in the master process, before any worker starts. """
+    from app import prepare
+    prepare()
+
+
+def post_worker_init(worker):
+    """ Let 'kill -USR2 <worker pid>' profile a single worker (the master keeps USR2 for binary upgrades). """
+    from profiler import install_signal_handler
+    install_signal_handler('worker')
@@ -0,0 +1,143 @@
+# hot_cache.py
+import mmap
+import threading
+from zlib import adler32
+from collections import OrderedDict
+
+from storage import blob_store
+from config import HOT_CACHE_MAX_BYTES, HOT_CACHE_SMALL_BYTES, HOT_CACHE_MMAP_BYTES, HOT_CACHE_MIN_HITS, HOT_CACHE_SAMPLE_SIZE
+
+# Slices of a memory-mapped file handed to the WSGI server at a time
+MMAP_CHUNK_BYTES = 256 * 1024
+
+
+def blob_etag(locator, size, mtime):
+    """ The ETag send_file gives a file on disk, computed from the blob's location (path or object URL). """
+    return f"{mtime}-{size}-{adler32(locator.encode()) & 0xFFFFFFFF}"
+
+
+class HotEntry:
+    #The stored bytes of one hot file: a bytes object for small files, a read-only memory map for medium ones.
+
+    def __init__(self, locator, data, size, mtime, encoding):
+        self.data = data
+        self.size = size
+        self.mtime = mtime
+        self.encoding = encoding
+        # Same ETag as the uncached download, so conditional requests work across both paths
+        self.etag = blob_etag(locator, size, mtime)
+
+    def chunks(self):
+        """ Body iterable for a response. A map is sliced lazily, so a download never copies the whole file. """
+        if isinstance(self.data, bytes):
+            return [self.data]
+        return (self.data[i:i + MMAP_CHUNK_BYTES] for i in range(0, self.size, MMAP_CHUNK_BYTES))
+
+
+class HotFileCache:
+    #Per-process cache of frequently downloaded public files, so repeated downloads skip the disk.
+    #A file is admitted once it was requested HOT_CACHE_MIN_HITS times in the recent sample, and only if it is
+    #wanted at least as often as the least recently used entries it would push out (frequency-based admission).
+    #Stored blobs never change under the same name, so entries only go away on eviction, delete or permission change.
+
+    def __init__(self, max_bytes, small_bytes, mmap_bytes, min_hits, sample_size):
+        self.max_bytes = max_bytes
+        self.small_bytes = small_bytes
+        self.mmap_bytes = mmap_bytes
+        self.min_hits = min_hits
+        self.sample_size = sample_size
+        self.entries = OrderedDict()  # stored_filename -> HotEntry, least recently used first
+        self.size = 0                 # total bytes held (bytes objects and maps)
+        self.hits = {}                # stored_filename -> recent request count
+        self.requests = 0             # requests counted since the last aging
+        self.stats = {'hits': 0, 'misses': 0, 'admitted': 0, 'rejected': 0, 'evicted': 0}
+        self.lock = threading.Lock()
+
+    def get(self, stored_filename):
+        """ Count a download request and return the cached entry, or None on a miss. """
+        with self.lock:
+            self.hits[stored_filename] = self.hits.get(stored_filename, 0) + 1
+            self.requests += 1
+            if self.requests >= self.sample_size:
+                # Halve every count, so files that stopped being popular lose their claim
+                self.hits = {name: count // 2 for name, count in self.hits.items() if count > 1}
+                self.requests = 0
+            entry = self.entries.get(stored_filename)
+            if entry is None:
+                self.stats['misses'] += 1
+                return None
+            self.entries.move_to_end(stored_filename)
+            self.stats['hits'] += 1
+            return entry
+
+    def offer(self, stored_filename, encoding):
+        """ Admit a file after a miss if it is popular enough. Returns the new entry, or None if it was not admitted. """
+        with self.lock:
+            count = self.hits.get(stored_filename, 0)
+            if count < self.min_hits or stored_filename in self.entries:
+                return self.entries.get(stored_filename)
+        stat = blob_store.stat(stored_filename)
+        if stat is None:
+            return None
+        size, mtime = stat
+        path = blob_store.local_path(stored_filename)
+        # Object-store blobs cannot be mapped: only small ones are admitted, so a worker never reads a whole big file into memory
+        limit = self.mmap_bytes if path is not None else self.small_bytes
+        if size == 0 or size > limit or size > self.max_bytes:
+            return None
+
+        with self.lock:
+            # Only push out entries that are wanted less than the newcomer
+            victims, freed = [], 0
+            for name, entry in self.entries.items():
+                if self.size - freed + size <= self.max_bytes:
+                    break
+                if self.hits.get(name, 0) > count:
+                    self.stats['rejected'] += 1
+                    return None
+                victims.append(name)
+                freed += entry.size
+
+        try:
+            with blob_store.open(stored_filename) as f:
+                if size <= self.small_bytes or path is None:
+                    data = f.read()
+                else:
+                    # The map stays valid after the file is closed (or deleted)
+                    data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return None
+        entry = HotEntry(blob_store.locator(stored_filename), data, len(data), mtime, encoding)
+
+        with self.lock:
+            for name in victims:
+                self._drop(name)
+                self.stats['evicted'] += 1
+            if stored_filename in self.entries or self.size + entry.size > self.max_bytes:
+                # Another thread got here first
+                return self.entries.get(stored_filename)
+            self.entries[stored_filename] = entry
+            self.size += entry.size
+            self.stats['admitted'] += 1
+        return entry
+
+    def discard(self, stored_filename):
+        """ Forget a file (deleted, made private or evicted from disk). Responses still streaming from it finish normally. """
+        with self.lock:
+            self._drop(stored_filename)
+
+    def _drop(self, stored_filename):
+        # Maps are not closed here: in-flight downloads may still read them, they are unmapped once unreferenced
+        entry = self.entries.pop(stored_filename, None)
+        if entry is not None:
+            self.size -= entry.size
+
+    def get_stats(self):
+        """ Counters since start plus the current number of entries and bytes held. """
+        with self.lock:
+            return dict(self.stats, entries=len(self.entries), bytes=self.size)
+
+
+# Hot-file cache of this process
+hot_cache = HotFileCache(HOT_CACHE_MAX_BYTES, HOT_CACHE_SMALL_BYTES, HOT_CACHE_MMAP_BYTES,
+                         HOT_CACHE_MIN_HITS, HOT_CACHE_SAMPLE_SIZE)
@@ -0,0 +1,117 @@
+# identity.py
+import time
+import threading
+from collections import OrderedDict
+
+from flask import g, session
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session, make_transient_to_detached, object_session
+
+from models import db, User
+from config import USER_CACHE_SIZE, USER_CACHE_TTL, SHARD_COUNT
+from sharding import shard_of
+
+# Columns copied into the cache; together they rebuild a complete User without touching the DB
+USER_COLUMNS = [c.key for c in User.__table__.columns]
+
+
+class UserCache:
+    #Bounded LRU of user rows (plain column dicts) with a time-to-live, shared by all requests of a process.
+    #Entries are dropped when a user row changes in this process; changes made by other processes
+    #(other WSGI workers, the sync sidecar) show up once the entry expires.
+
+    def __init__(self, max_entries, ttl):
+        """ Keep at most 'max_entries' users, each for at most 'ttl' seconds. """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()  # user id -> (expires at, column dict), least recently used first
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_id):
+        """ Return the cached column dict of a user, or None on a miss or an expired entry. """
+        with self.lock:
+            entry = self.entries.get(user_id)
+            if entry is None or entry[0] < time.monotonic():
+                self.entries.pop(user_id, None)
+                self.misses += 1
+                return None
+            self.entries.move_to_end(user_id)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, user):
+        """ Remember a freshly loaded user. """
+        columns = {c: getattr(user, c) for c in USER_COLUMNS}
+        with self.lock:
+            self.entries[user.id] = (time.monotonic() + self.ttl, columns)
+            self.entries.move_to_end(user.id)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def discard(self, user_id):
+        """ Forget a user whose row changed. """
+        with self.lock:
+            self.entries.pop(user_id, None)
+
+
+# Shared cache for the web routes
+user_cache = UserCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+
+
+def load_user(user_id):
+    """
+    Return the User with 'user_id' attached to the current DB session, or None if it does not exist.
+    A cache hit is attached with merge(load=False), so no query is issued; the object still behaves like
+    a loaded row (changes to it are flushed as usual, and invalidate the cache on commit).
+    """
+    columns = user_cache.get(user_id)
+    if columns is None:
+        user = db.session.get(User, user_id)
+        if user is not None:
+            user_cache.put(user)
+        return user
+
+    user = User(**columns)
+    make_transient_to_detached(user)
+    if SHARD_COUNT > 1:
+        # A sharded session keys identities by shard as well
+        state = inspect(user)
+        state.key = state.key[:2] + (shard_of(user.id),)
+    return db.session.merge(user, load=False)
+
+
+def get_current_user():
+    """ The logged-in User, or None. Looked up once per request (memoised in flask.g) and cached across requests. """
+    if '_current_user' not in g:
+        user_id = session.get('user_id')
+        g._current_user = load_user(user_id) if user_id else None
+    return g._current_user
+
+
+# --- invalidation --------------------------------------------------------------------------
+# Any committed change to a user row (registration, quota/used storage updates, users created or
+# repaired by sync) drops its cache entry. Ids are collected at flush time and dropped after commit.
+
+def _changed(mapper, connection, target):
+    session = object_session(target)
+    if session is not None:
+        session.info.setdefault('changed_users', set()).add(target.id)
+
+
+for _event in ('after_insert', 'after_update', 'after_delete'):
+    event.listen(User, _event, _changed)
+
+
+@event.listens_for(Session, 'after_commit')
+def _after_commit(session):
+    for user_id in session.info.pop('changed_users', ()):
+        user_cache.discard(user_id)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _after_rollback(session):
+    # The rolled-back objects are expired; drop their entries too, in case they were re-cached meanwhile
+    for user_id in session.info.pop('changed_users', ()):
+        user_cache.discard(user_id)
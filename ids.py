@@ -0,0 +1,90 @@
+# ids.py
+import os
+import time
+import threading
+
+from config import REGION_ID, SYNC_MODE, ID_SLOT_DIR
+
+# Snowflake-style layout of a 63-bit id (fits SQLite's signed 64-bit INTEGER):
+#   41 bits milliseconds since ID_EPOCH_MS | 10 bits region | 4 bits process slot | 8 bits sequence
+# Ids from different regionals (and from different worker processes of one regional) never collide,
+# and they sort by creation time.
+ID_EPOCH_MS = 1704067200000  # 2024-01-01 00:00:00 UTC
+REGION_BITS = 10
+SLOT_BITS = 4
+SEQUENCE_BITS = 8
+
+MAX_REGION = (1 << REGION_BITS) - 1
+MAX_SLOT = (1 << SLOT_BITS) - 1
+MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+
+
+class IdGenerator:
+    #Hands out unique, time-ordered ids without asking anyone else: (time, region, process slot, sequence).
+
+    def __init__(self, region_id):
+        """ Create a generator for one regional. The process slot is claimed on first use (after any fork). """
+        if not 0 <= region_id <= MAX_REGION:
+            raise ValueError(f"SYNCSPHERE_REGION_ID must be between 0 and {MAX_REGION}")
+        self.region_id = region_id
+        self.slot = None
+        self.pid = None
+        self.slot_file = None
+        self.last_ms = -1
+        self.sequence = 0
+        self.lock = threading.Lock()
+
+    def _claim_slot(self):
+        """
+        Pick this process's slot. A single process (thread mode) always uses slot 0; worker processes
+        sharing a region lock one slot file each, and the lock dies with the process.
+        """
+        if SYNC_MODE != 'sidecar':
+            return 0
+        import fcntl
+
+        os.makedirs(ID_SLOT_DIR, exist_ok=True)
+        for slot in range(MAX_SLOT + 1):
+            f = open(os.path.join(ID_SLOT_DIR, f"slot-{slot}.lock"), 'w')
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                f.close()
+                continue
+            self.slot_file = f  # keep the file (and its lock) open for the life of the process
+            return slot
+        raise RuntimeError(f"More than {MAX_SLOT + 1} processes are generating ids for region {self.region_id}")
+
+    def next_id(self):
+        """ Return a new id. Up to 256 ids per millisecond per process; beyond that we wait for the next millisecond. """
+        with self.lock:
+            if self.pid != os.getpid():
+                # Forked workers must not share the parent's slot
+                self.slot = self._claim_slot()
+                self.pid = os.getpid()
+                self.last_ms = -1
+
+            now = int(time.time() * 1000) - ID_EPOCH_MS
+            if now < self.last_ms:
+                # The clock went backwards: keep counting in the last millisecond we used
+                now = self.last_ms
+            if now == self.last_ms:
+                self.sequence = (self.sequence + 1) & MAX_SEQUENCE
+                if self.sequence == 0:
+                    while now <= self.last_ms:
+                        time.sleep(0.0001)
+                        now = int(time.time() * 1000) - ID_EPOCH_MS
+            else:
+                self.sequence = 0
+            self.last_ms = now
+
+            return (((now << REGION_BITS | self.region_id) << SLOT_BITS | self.slot) << SEQUENCE_BITS) | self.sequence
+
+
+# Shared generator, used as the primary key default of every replicated table
+id_generator = IdGenerator(REGION_ID)
+
+
+def next_id():
+    """ Column default: a new globally unique id. """
+    return id_generator.next_id()
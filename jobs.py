@@ -0,0 +1,177 @@
+# jobs.py
+import time
+import threading
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+
+from config import (UPLOAD_FOLDER, JOB_WORKERS, JOB_CONCURRENCY, JOB_MAX_ATTEMPTS, JOB_RETRY_DELAY,
+                    JOB_POLL_INTERVAL, JOB_KEEP_SECONDS)
+
+# Job type -> function(file_record) doing the work. Registered with @job_handler below.
+HANDLERS = {}
+
+# How often (in seconds) finished jobs older than JOB_KEEP_SECONDS are deleted
+PRUNE_INTERVAL = 3600
+
+
+def job_handler(job_type):
+    """ Register the function that runs jobs of 'job_type'. It gets the File row and raises to have the job retried. """
+    def register(func):
+        HANDLERS[job_type] = func
+        return func
+    return register
+
+
+def enqueue(job_type, file_id, user_id):
+    """ Queue a job on a file (adds it to the session; the caller commits, so the job is stored with the change that needs it). """
+    from models import db, Job
+    db.session.add(Job(job_type=job_type, file_id=file_id, user_id=user_id))
+    job_runner.wake()
+
+
+def file_status(user):
+    """ Map file id -> 'processing' or 'failed' for the user's files that have unfinished or failed jobs. """
+    from models import Job
+    status = {}
+    for job in Job.query.filter(Job.user_id == user.id, Job.status != 'done').all():
+        if job.status == 'failed' or job.file_id not in status:
+            status[job.file_id] = 'failed' if job.status == 'failed' else 'processing'
+    return status
+
+
+class JobRunner:
+    #Runs queued jobs on a thread pool. One process per regional runs it (app.py in thread mode, sync_sidecar.py otherwise);
+    #web workers only insert Job rows. Each job type has its own limit of jobs in flight, so a slow type cannot starve the others.
+
+    def __init__(self, workers, concurrency):
+        """ 'concurrency' maps a job type to the most jobs of that type running at once (1 for unlisted types). """
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='jobs')
+        self.concurrency = concurrency
+        self.running = {}  # job type -> jobs in flight
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+
+    def wake(self):
+        """ Look for new jobs now instead of at the next poll (only helps when the job was queued in this process). """
+        self.wakeup.set()
+
+    def free_slots(self):
+        """ Job type -> how many more jobs of that type may start now. """
+        with self.lock:
+            return {t: self.concurrency.get(t, 1) - self.running.get(t, 0) for t in HANDLERS}
+
+    def recover(self):
+        """ Requeue jobs left 'running' by a crash; they count as an attempt. Must run inside an application context. """
+        from models import db, Job
+        count = Job.query.filter(Job.status == 'running').update({'status': 'queued'}, synchronize_session=False)
+        db.session.commit()
+        if count:
+            print(f"[Jobs] Requeued {count} interrupted jobs", flush=True)
+
+    def dispatch(self):
+        """ Claim due jobs for the types with free slots and hand them to the pool. Must run inside an application context. """
+        from models import db, Job
+
+        for job_type, free in self.free_slots().items():
+            if free <= 0:
+                continue
+            due = (Job.query.filter(Job.status == 'queued', Job.job_type == job_type, Job.run_after <= datetime.now())
+                   .order_by(Job.run_after).limit(free).all())
+            # Each shard answers with up to 'free' jobs, so merge and cut again
+            for job in sorted(due, key=lambda j: j.run_after)[:free]:
+                # Claim with a conditional update, so a job is never started twice
+                claimed = Job.query.filter_by(id=job.id, user_id=job.user_id, status='queued').update(
+                    {'status': 'running', 'attempts': Job.attempts + 1}, synchronize_session=False)
+                db.session.commit()
+                if not claimed:
+                    continue
+                with self.lock:
+                    self.running[job_type] = self.running.get(job_type, 0) + 1
+                self.pool.submit(self.run, job.id, job.user_id, job_type)
+
+    def run(self, job_id, user_id, job_type):
+        """ Run one claimed job on a pool thread and record the outcome: done, retried later, or failed for good. """
+        from app import app
+        from models import db, File, Job
+        try:
+            with app.app_context():
+                job = Job.query.filter_by(id=job_id, user_id=user_id).first()
+                if job is None:
+                    return
+                try:
+                    file_record = File.query.filter_by(id=job.file_id, user_id=job.user_id).first()
+                    # Nothing to do for a file deleted in the meantime
+                    if file_record is not None:
+                        HANDLERS[job_type](file_record)
+                    job.status = 'done'
+                    job.error = None
+                    job.finished_at = datetime.now()
+                except Exception as e:
+                    db.session.rollback()
+                    job.error = f"{type(e).__name__}: {e}"
+                    if job.attempts < JOB_MAX_ATTEMPTS:
+                        # Back off exponentially before the next attempt
+                        job.status = 'queued'
+                        job.run_after = datetime.now() + timedelta(seconds=JOB_RETRY_DELAY * 2 ** (job.attempts - 1))
+                        print(f"[Jobs] {job_type} of file {job.file_id} failed (attempt {job.attempts}), retrying: {e}", flush=True)
+                    else:
+                        job.status = 'failed'
+                        job.finished_at = datetime.now()
+                        print(f"[Jobs] {job_type} of file {job.file_id} failed for good: {e}", flush=True)
+                db.session.commit()
+        except Exception as e:
+            print(f"[Jobs] Could not record the outcome of job {job_id}: {e}", flush=True)
+        finally:
+            with self.lock:
+                self.running[job_type] -= 1
+            self.wake()
+
+    def prune(self):
+        """ Delete finished jobs older than JOB_KEEP_SECONDS. Must run inside an application context. """
+        from models import db, Job
+        cutoff = datetime.now() - timedelta(seconds=JOB_KEEP_SECONDS)
+        Job.query.filter(Job.status.in_(['done', 'failed']), Job.finished_at < cutoff).delete(synchronize_session=False)
+        db.session.commit()
+
+    def loop(self):
+        """ Background loop: start due jobs whenever a slot frees up, a job is queued here, or every JOB_POLL_INTERVAL seconds. """
+        from app import app
+        with app.app_context():
+            self.recover()
+        last_prune = 0
+        while True:
+            self.wakeup.clear()
+            try:
+                with app.app_context():
+                    self.dispatch()
+                    if time.time() - last_prune >= PRUNE_INTERVAL:
+                        self.prune()
+                        last_prune = time.time()
+            except Exception as e:
+                print(f"[Jobs] Dispatch error: {e}", flush=True)
+            self.wakeup.wait(JOB_POLL_INTERVAL)
+
+
+# --- job types -----------------------------------------------------------------------------
+
+@job_handler('rendition')
+def _render(file_record):
+    """ Hash the file's bytes and create its thumbnail or PDF preview. """
+    from renditions import RenditionManager
+    RenditionManager(UPLOAD_FOLDER).generate(file_record)
+
+
+@job_handler('index_contents')
+def _index_contents(file_record):
+    """ Add the file's text to the search index (its name is indexed when the row is inserted). """
+    from search import search_index
+    search_index.index_contents(file_record)
+
+
+# Job runner of this process (only started by the process that runs background work)
+job_runner = JobRunner(JOB_WORKERS, JOB_CONCURRENCY)
+
+
+def job_loop():
+    """ Background loop running post-upload jobs. """
+    job_runner.loop()
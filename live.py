@@ -0,0 +1,250 @@
+# live.py
+# Live page updates. Committed changes to files, friend requests and storage usage become small JSON deltas
+# for the users they concern, whether the change was made here (manager calls) or applied from another regional
+# (receive_changes, anti-entropy). Open pages hold a Server-Sent Events stream (live_routes.py) and apply the deltas in place.
+import time
+import uuid
+import threading
+from collections import deque
+
+from sqlalchemy import event, select, func
+from sqlalchemy.orm import Session, object_session
+
+from models import User, File, FriendRequest, Job
+from renditions import RenditionManager
+from config import (changes_queue, SYNC_MODE, UPLOAD_FOLDER, LIVE_QUEUE_SIZE, LIVE_MAX_STREAMS_PER_USER, LIVE_REPLAY_SIZE,
+                    LIVE_POLL_INTERVAL, LIVE_KEEP_SECONDS, LIVE_MAX_STREAMS_PER_PROCESS)
+
+
+class Subscriber:
+    #One open event stream. Idle streams only wait on their condition; nothing is polled per stream.
+
+    def __init__(self, user_id, queue_size):
+        self.user_id = user_id
+        self.queue_size = queue_size
+        self.items = deque()     # (event id, delta) not sent yet
+        self.overflow = False    # fell too far behind: the page must reload instead
+        self.cond = threading.Condition()
+
+    def push(self, item):
+        with self.cond:
+            if len(self.items) >= self.queue_size:
+                self.overflow = True
+                self.items.clear()
+            elif not self.overflow:
+                self.items.append(item)
+            self.cond.notify()
+
+    def wait(self, timeout):
+        """ Block until there is something to send or 'timeout' passed. Returns (items, overflow). """
+        with self.cond:
+            if not self.items and not self.overflow:
+                self.cond.wait(timeout)
+            items, overflow = list(self.items), self.overflow
+            self.items.clear()
+            self.overflow = False
+            return items, overflow
+
+
+class LiveHub:
+    #Fans deltas out to the streams of this process. In thread mode deltas are delivered directly; in sidecar mode
+    #every process publishes into the shared outbox and one poller thread per web worker reads them back (one query
+    #per LIVE_POLL_INTERVAL, however many streams are open).
+
+    def __init__(self, queue_size, max_streams, replay_size, max_total=0):
+        """ 'max_streams' caps the streams of one user, 'max_total' those of the process (0: no cap). """
+        self.queue_size = queue_size
+        self.max_streams = max_streams
+        self.max_total = max_total
+        self.subscribers = {}                     # user id -> set of Subscribers
+        self.recent = deque(maxlen=replay_size)   # (event id, user id, delta) for streams that reconnect
+        self.next_id = 1                          # event ids of thread mode
+        self.poller = None
+        self.lock = threading.Lock()
+        # Stream event ids are "<epoch>-<id>": ids only mean something to the process that numbered them
+        self.epoch = uuid.uuid4().hex[:8]
+
+    def publish(self, user_ids, delta):
+        """ Send a delta to the open pages of the given users, in every process of this regional. """
+        user_ids = sorted(set(user_ids))
+        if not user_ids:
+            return
+        if SYNC_MODE == 'sidecar':
+            changes_queue.put_live(user_ids, delta)
+            return
+        with self.lock:
+            items = [(self.next_id + i, user_id, delta) for i, user_id in enumerate(user_ids)]
+            self.next_id += len(items)
+        self.deliver(items)
+
+    def deliver(self, items):
+        """ Hand (event id, user id, delta) items to the matching streams of this process. """
+        with self.lock:
+            self.recent.extend(items)
+            targets = [(sub, (event_id, delta)) for event_id, user_id, delta in items
+                       for sub in self.subscribers.get(user_id, ())]
+        for sub, item in targets:
+            sub.push(item)
+
+    def subscribe(self, user_id, last_event_id=None):
+        """
+        Open a stream for a user, or return None if the user already has max_streams here (or the process max_total).
+        A reconnecting page passes
+        the id of the last delta it saw ("<epoch>-<id>"); newer ones are queued again, or a reload is asked for unless
+        the replay buffer of this process provably still holds every delta after it.
+        """
+        if SYNC_MODE == 'sidecar':
+            self._start_poller()
+        sub = Subscriber(user_id, self.queue_size)
+        with self.lock:
+            if self.max_total and sum(len(s) for s in self.subscribers.values()) >= self.max_total:
+                return None
+            streams = self.subscribers.setdefault(user_id, set())
+            if len(streams) >= self.max_streams:
+                return None
+            streams.add(sub)
+            if last_event_id is not None:
+                epoch, _, seen = last_event_id.partition('-')
+                if epoch != self.epoch or not seen.isdigit() or not self.recent or self.recent[0][0] > int(seen) + 1:
+                    # Another process or an earlier run numbered it, or deltas since then were dropped
+                    sub.overflow = True
+                else:
+                    sub.items.extend((event_id, delta) for event_id, uid, delta in self.recent
+                                     if uid == user_id and event_id > int(seen))
+        return sub
+
+    def unsubscribe(self, sub):
+        with self.lock:
+            streams = self.subscribers.get(sub.user_id)
+            if streams is not None:
+                streams.discard(sub)
+                if not streams:
+                    del self.subscribers[sub.user_id]
+
+    def stream_count(self):
+        with self.lock:
+            return sum(len(s) for s in self.subscribers.values())
+
+    def _start_poller(self):
+        with self.lock:
+            if self.poller is not None:
+                return
+            self.poller = threading.Thread(target=self._poll_loop, name='live-poller', daemon=True)
+        self.poller.start()
+
+    def _poll_loop(self):
+        """ Sidecar mode: read the deltas every process published into the outbox and deliver ours. """
+        last_id = changes_queue.live_last_id()
+        last_prune = 0
+        while True:
+            try:
+                items = changes_queue.live_after(last_id)
+                if items:
+                    last_id = items[-1][0]
+                    self.deliver(items)
+                if time.time() - last_prune >= LIVE_KEEP_SECONDS:
+                    changes_queue.prune_live(time.time() - LIVE_KEEP_SECONDS)
+                    last_prune = time.time()
+            except Exception as e:
+                print(f"[Live] Poll error: {e}", flush=True)
+            if not items:
+                time.sleep(LIVE_POLL_INTERVAL)
+
+
+# Streams of this process
+live_hub = LiveHub(LIVE_QUEUE_SIZE, LIVE_MAX_STREAMS_PER_USER, LIVE_REPLAY_SIZE, LIVE_MAX_STREAMS_PER_PROCESS)
+
+
+# --- change capture ------------------------------------------------------------------------
+# Deltas are collected at flush time and published after the commit, so rolled-back changes are never shown.
+
+# Only asked whether a file type gets a thumbnail
+renditions = RenditionManager(UPLOAD_FOLDER)
+
+def _collect(target, user_ids, delta):
+    session = object_session(target)
+    if session is not None:
+        session.info.setdefault('live_deltas', []).append((user_ids, delta))
+
+
+def _file_delta(rec):
+    # Ids are sent as strings: snowflake ids do not fit in a JavaScript number
+    return {'id': str(rec.id), 'name': rec.original_filename, 'size': rec.file_size, 'permissions': rec.permissions,
+            'uploaded': rec.upload_date.strftime("%Y-%m-%d %H:%M") if rec.upload_date else '',
+            'preview': renditions.can_render(rec.original_filename)}
+
+
+@event.listens_for(File, 'after_insert')
+def _file_inserted(mapper, connection, target):
+    _collect(target, [target.user_id], {'type': 'file_added', 'file': _file_delta(target)})
+
+
+@event.listens_for(File, 'after_update')
+def _file_updated(mapper, connection, target):
+    _collect(target, [target.user_id], {'type': 'file_updated', 'file': _file_delta(target)})
+
+
+@event.listens_for(File, 'after_delete')
+def _file_deleted(mapper, connection, target):
+    _collect(target, [target.user_id], {'type': 'file_removed', 'id': str(target.id)})
+
+
+@event.listens_for(User, 'after_update')
+def _user_updated(mapper, connection, target):
+    _collect(target, [target.id], {'type': 'storage', 'used': target.used_storage, 'quota': target.storage_quota})
+
+
+@event.listens_for(FriendRequest, 'after_insert')
+def _request_inserted(mapper, connection, target):
+    if target.status not in (None, 'pending'):
+        return
+    # Requests live in their sender's shard, next to the sender's user row
+    sender = connection.execute(select(User.username).where(User.id == target.from_user_id)).scalar()
+    _collect(target, [target.to_user_id], {'type': 'friend_request', 'request_id': str(target.id),
+                                           'from_user_id': str(target.from_user_id), 'from_username': sender})
+
+
+@event.listens_for(FriendRequest, 'after_update')
+def _request_updated(mapper, connection, target):
+    if target.status != 'pending':
+        _collect(target, [target.from_user_id, target.to_user_id],
+                 {'type': 'friend_request_closed', 'request_id': str(target.id), 'status': target.status})
+
+
+@event.listens_for(Job, 'after_insert')
+def _job_inserted(mapper, connection, target):
+    _collect(target, [target.user_id], {'type': 'file_status', 'id': str(target.file_id), 'status': 'processing'})
+
+
+@event.listens_for(Job, 'after_update')
+def _job_updated(mapper, connection, target):
+    if target.status not in ('done', 'failed'):
+        return
+    # The badge of a file stays until its last job finished (jobs live in the shard of their user, like this one)
+    unfinished = connection.execute(
+        select(func.count()).select_from(Job.__table__).where(
+            Job.user_id == target.user_id, Job.file_id == target.file_id, Job.id != target.id,
+            Job.status.in_(['queued', 'running', 'failed']))
+    ).scalar()
+    if target.status == 'failed':
+        status = 'failed'
+    elif unfinished:
+        return
+    else:
+        status = None
+    _collect(target, [target.user_id], {'type': 'file_status', 'id': str(target.file_id), 'status': status})
+
+
+@event.listens_for(Session, 'after_commit')
+def _after_commit(session):
+    for user_ids, delta in session.info.pop('live_deltas', ()):
+        try:
+            live_hub.publish(user_ids, delta)
+        except Exception as e:
+            # A lost delta only means a stale page until the next reload
+            print(f"[Live] Could not publish {delta.get('type')}: {e}", flush=True)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _after_rollback(session):
+    session.info.pop('live_deltas', None)
@@ -0,0 +1,53 @@
+# live_routes.py
+import json
+
+from flask import Blueprint, Response, request, redirect, url_for
+
+from config import LIVE_HEARTBEAT_SECONDS
+from identity import get_current_user
+from live import live_hub
+
+# Blueprint for the live-update stream, all routes under /live
+live_bp = Blueprint('live', __name__)
+
+
+def _frame(event_id, delta):
+    """ One Server-Sent Events message. """
+    return f"id: {live_hub.epoch}-{event_id}\nevent: {delta['type']}\ndata: {json.dumps(delta, separators=(',', ':'))}\n\n"
+
+
+@live_bp.route('/stream')
+def stream():
+    """ Server-Sent Events stream of the current user's changes (files, storage, friend requests) for open pages to apply in place. """
+    user = get_current_user()
+    if user is None:
+        return redirect(url_for('auth.login'))
+
+    # The browser sends the last id it saw when it reconnects
+    last_event_id = request.headers.get('Last-Event-ID')
+    sub = live_hub.subscribe(user.id, last_event_id)
+    if sub is None:
+        return Response("Too many open pages.", status=429, mimetype='text/plain')
+
+    def generate():
+        # Holds no request or app context: an idle stream is a waiting thread (or greenlet) and a small queue
+        try:
+            yield "retry: 3000\n\n"
+            while True:
+                items, overflow = sub.wait(LIVE_HEARTBEAT_SECONDS)
+                if overflow:
+                    # Deltas were dropped: the page has to load the full state again
+                    yield "event: reload\ndata: {}\n\n"
+                elif items:
+                    yield ''.join(_frame(event_id, delta) for event_id, delta in items)
+                else:
+                    # Keeps proxies from closing an idle stream and notices closed connections
+                    yield ": keepalive\n\n"
+        finally:
+            live_hub.unsubscribe(sub)
+
+    response = Response(generate(), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    # Ask nginx not to buffer the stream
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
@@ -1,12 +1,16 @@
 from flask_sqlalchemy import SQLAlchemy
 from datetime import datetime
 from werkzeug.security import generate_password_hash, check_password_hash
+from ids import next_id
+from config import SHARD_COUNT
+from sharding import RoutedSession
 
-db = SQLAlchemy()
+# With several shards the session routes each row and query to its shard file(s)
+db = SQLAlchemy(session_options={'class_': RoutedSession} if SHARD_COUNT > 1 else {})
 
 class User(db.Model):
     #A class that represents a user in the system.
-    id = db.Column(db.Integer, primary_key=True) #The id of the user.
+    id = db.Column(db.Integer, primary_key=True, default=next_id) #The id of the user (globally unique, see ids.py).
     username = db.Column(db.String(80), unique=True, nullable=False) #The username.
     email = db.Column(db.String(120), unique=True, nullable=False) #The email of the user.
     password_hash = db.Column(db.String(128), nullable=False) #The hashed password of the user.
@@ -24,8 +28,8 @@ class User(db.Model):
 
 class File(db.Model):
     #Represents the metadata of a file in the system.
-    id = db.Column(db.Integer, primary_key=True) #The id of the file
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False) #The id of the file's owner.
+    id = db.Column(db.Integer, primary_key=True, default=next_id) #The id of the file (globally unique, see ids.py)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True) #The id of the file's owner.
     stored_filename = db.Column(db.String(128), nullable=False) #The name of the file in the file system.
     original_filename = db.Column(db.String(128), nullable=False) #The original name of the file.
     upload_date = db.Column(db.DateTime, default=datetime.now) #The creation date of the file.
@@ -34,7 +38,7 @@ class File(db.Model):
 
 class FriendRequest(db.Model):
     #Represents a friend request in the system.
-    id = db.Column(db.Integer, primary_key=True) #The id of the request.
+    id = db.Column(db.Integer, primary_key=True, default=next_id) #The id of the request (globally unique, see ids.py).
     from_user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False) #The id of the sender.
     to_user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False) #The id of the receiver.
     status = db.Column(db.String(16), default='pending')  #The status of the friend request('pending', 'accepted', 'rejected')
@@ -42,7 +46,46 @@ class FriendRequest(db.Model):
 
 class Friendship(db.Model):
     #Represents a friendship in the system.
-    id = db.Column(db.Integer, primary_key=True) #The id of the friendship.
+    id = db.Column(db.Integer, primary_key=True, default=next_id) #The id of the friendship (globally unique, see ids.py).
     user_id  = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False) #The id of one of the user.
     friend_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False) #The id of the other user.
-    created_at = db.Column(db.DateTime, default=datetime.now) #The creation date of the friendship.
\ No newline at end of file
+    created_at = db.Column(db.DateTime, default=datetime.now) #The creation date of the friendship.
+
+class HomeUser(db.Model):
+    #Marks a user that registered or logged in on this regional server (local only, never synced).
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True) #The id of the local user.
+    since = db.Column(db.DateTime, default=datetime.now) #When the user first became active here.
+
+class FileTombstone(db.Model):
+    #Records a file deleted on this regional (local only, never synced), so anti-entropy can tell a delete from a missed upload.
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False) #The id of the deleted file.
+    user_id = db.Column(db.Integer, nullable=False) #The id of the file's owner.
+    deleted_at = db.Column(db.DateTime, default=datetime.now) #When the file was deleted here.
+
+
+class BlobInfo(db.Model):
+    #Local facts about a file's bytes (never synced, recomputed from the bytes when missing).
+    stored_filename = db.Column(db.String(128), primary_key=True) #The name of the file in the file system.
+    content_hash = db.Column(db.String(64), nullable=False) #SHA-256 of the file's bytes, the key of its renditions.
+
+
+class BlobEncoding(db.Model):
+    #How a blob is stored on disk when it is not stored as uploaded (e.g. gzip-compressed text). Replicated inside file_upload events.
+    stored_filename = db.Column(db.String(128), primary_key=True) #The name of the file in the file system.
+    encoding = db.Column(db.String(16), nullable=False) #The stored encoding ('gzip').
+
+
+class Job(db.Model):
+    #Derived work on a file that runs after the upload request returned (local only, never synced). See jobs.py.
+    id = db.Column(db.Integer, primary_key=True, default=next_id) #The id of the job.
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False) #The owner of the file, who can see the job's status.
+    file_id = db.Column(db.Integer, nullable=False, index=True) #The file to work on (the job is skipped if the file is gone).
+    job_type = db.Column(db.String(32), nullable=False) #What to do ('rendition', 'index_contents').
+    status = db.Column(db.String(16), nullable=False, default='queued') #'queued', 'running', 'done' or 'failed'.
+    attempts = db.Column(db.Integer, nullable=False, default=0) #How many times the job was started.
+    run_after = db.Column(db.DateTime, nullable=False, default=datetime.now) #Not started before this time (retry backoff).
+    error = db.Column(db.Text) #The error of the last failed attempt.
+    created_at = db.Column(db.DateTime, default=datetime.now) #When the job was queued.
+    finished_at = db.Column(db.DateTime) #When the job succeeded or gave up.
+
+    __table_args__ = (db.Index('ix_job_status_run_after', 'status', 'run_after'),)
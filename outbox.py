@@ -0,0 +1,108 @@
+# outbox.py
+import os
+import json
+import sqlite3
+import time
+import threading
+from queue import Empty
+
+
+class SqliteOutbox:
+    #Cross-process replacement for the in-memory changes_queue, backed by its own SQLite file.
+    #Every web worker puts events into it; the single sync sidecar drains it. Same put/get_nowait API as queue.Queue,
+    #plus peek/ack so the sidecar removes events only after they were sent.
+
+    def __init__(self, path):
+        """ Open (and create if needed) the outbox database at 'path'. Connections are opened per thread. """
+        self.path = path
+        self.local = threading.local()
+        with self._connect() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS outbox (id INTEGER PRIMARY KEY AUTOINCREMENT, event TEXT NOT NULL)")
+            conn.execute("CREATE TABLE IF NOT EXISTS fetch_request (stored_filename TEXT PRIMARY KEY)")
+            conn.execute("CREATE TABLE IF NOT EXISTS live_event (id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                         "user_id INTEGER NOT NULL, delta TEXT NOT NULL, created REAL NOT NULL)")
+
+    def _connect(self):
+        """ Return this thread's connection (sqlite3 connections must not be shared between threads or forked processes). """
+        conn = getattr(self.local, 'conn', None)
+        if conn is None or self.local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")  # writers do not block the sidecar's reads
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.local.conn = conn
+            self.local.pid = os.getpid()
+        return conn
+
+    def put(self, event):
+        """ Append an event. Events must be JSON-serializable (file bytes are attached later by send_changes). """
+        self._connect().execute("INSERT INTO outbox (event) VALUES (?)", (json.dumps(event),))
+
+    def get_nowait(self):
+        """ Remove and return the oldest event, or raise queue.Empty. """
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT id, event FROM outbox ORDER BY id LIMIT 1").fetchone()
+            if row is None:
+                raise Empty
+            conn.execute("DELETE FROM outbox WHERE id = ?", (row[0],))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return json.loads(row[1])
+
+    def peek(self):
+        """ (id of the newest, events oldest first) of every queued event, without removing them (0, [] if none). """
+        rows = self._connect().execute("SELECT id, event FROM outbox ORDER BY id").fetchall()
+        return (rows[-1][0] if rows else 0), [json.loads(event) for _, event in rows]
+
+    def ack(self, last_id):
+        """ Remove the events up to 'last_id' once they were sent (see peek). """
+        self._connect().execute("DELETE FROM outbox WHERE id <= ?", (last_id,))
+
+    def empty(self):
+        """ Check whether there are no queued events. """
+        return self._connect().execute("SELECT 1 FROM outbox LIMIT 1").fetchone() is None
+
+    def request_fetch(self, stored_filename):
+        """ Ask the sidecar to fetch a file's bytes from another regional (used by web workers, which have no sync socket). """
+        self._connect().execute("INSERT OR IGNORE INTO fetch_request (stored_filename) VALUES (?)", (stored_filename,))
+
+    def take_fetch_requests(self):
+        """ Remove and return all pending fetch requests (used by the sidecar). """
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            names = [r[0] for r in conn.execute("SELECT stored_filename FROM fetch_request")]
+            conn.execute("DELETE FROM fetch_request")
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return names
+
+    def put_live(self, user_ids, delta):
+        """ Publish a live-update delta for some users to the web workers (see live.py). """
+        now = time.time()
+        data = json.dumps(delta)
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        conn.executemany("INSERT INTO live_event (user_id, delta, created) VALUES (?, ?, ?)",
+                         [(user_id, data, now) for user_id in user_ids])
+        conn.execute("COMMIT")
+
+    def live_after(self, last_id, limit=1000):
+        """ (id, user id, delta) of the live deltas published after 'last_id', oldest first. """
+        rows = self._connect().execute(
+            "SELECT id, user_id, delta FROM live_event WHERE id > ? ORDER BY id LIMIT ?", (last_id, limit)
+        ).fetchall()
+        return [(row_id, user_id, json.loads(delta)) for row_id, user_id, delta in rows]
+
+    def live_last_id(self):
+        """ Id of the newest live delta (0 if there is none), where a new reader starts. """
+        return self._connect().execute("SELECT COALESCE(MAX(id), 0) FROM live_event").fetchone()[0]
+
+    def prune_live(self, before):
+        """ Drop live deltas published before the timestamp 'before'; every reader has seen them by then. """
+        self._connect().execute("DELETE FROM live_event WHERE created < ?", (before,))
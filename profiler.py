@@ -0,0 +1,100 @@
+# profiler.py
+# Sampling profiler for any SyncSphere process (web server, sync sidecar, Grand Server). While it runs, a background
+# thread records the stack of every other thread PROFILE_HZ times per second; the result is in the "collapsed stacks"
+# format that flamegraph.pl, speedscope and inferno read (one line per distinct stack: "frame;frame;frame count").
+import os
+import re
+import sys
+import time
+import signal
+import threading
+from collections import Counter
+
+from config import PROFILE_HZ, PROFILE_MAX_SECONDS, PROFILE_SIGNAL_SECONDS, PROFILE_DIR
+
+# Numbered thread names ("Thread-12 (client_handler)", "sync-apply_3") are merged, so one flame shows all threads of a kind
+THREAD_NUMBER = re.compile(r'[-_]\d+')
+
+
+class ProfilerBusy(Exception):
+    #Raised when a profile is requested while another one is running in this process.
+    pass
+
+
+class SamplingProfiler:
+    #Samples all threads of this process from one extra thread. Nothing is hooked into the profiled code,
+    #so the cost is one stack walk per thread per sample, and nothing at all while no profile runs.
+
+    def __init__(self, hz):
+        self.interval = 1.0 / hz
+        self.lock = threading.Lock()  # one profile at a time
+
+    def profile(self, seconds):
+        """ Sample for 'seconds' (at most PROFILE_MAX_SECONDS) and return (collapsed stacks text, samples taken). Raises ProfilerBusy. """
+        seconds = max(0.1, min(float(seconds), PROFILE_MAX_SECONDS))
+        if not self.lock.acquire(blocking=False):
+            raise ProfilerBusy("A profile is already running in this process.")
+        try:
+            stacks = Counter()
+            samples = 0
+            me = threading.get_ident()
+            deadline = time.monotonic() + seconds
+            next_sample = time.monotonic()
+            while next_sample < deadline:
+                names = {t.ident: THREAD_NUMBER.sub('', t.name) for t in threading.enumerate()}
+                for ident, frame in sys._current_frames().items():
+                    if ident != me:
+                        stacks[self._collapse(names.get(ident, 'unknown'), frame)] += 1
+                samples += 1
+                next_sample += self.interval
+                time.sleep(max(0.0, next_sample - time.monotonic()))
+            return ''.join(f"{stack} {count}\n" for stack, count in stacks.most_common()), samples
+        finally:
+            self.lock.release()
+
+    @staticmethod
+    def _collapse(thread_name, frame):
+        """ One sample as 'thread;outermost frame;...;innermost frame'. """
+        frames = []
+        while frame is not None:
+            code = frame.f_code
+            frames.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+            frame = frame.f_back
+        frames.append(thread_name)
+        # ';' separates frames in the collapsed format
+        return ';'.join(f.replace(';', ':') for f in reversed(frames))
+
+    def profile_to_file(self, seconds, label):
+        """ Profile and write the result to PROFILE_DIR/{label}-{pid}-{time}.folded. Returns the path. """
+        stacks, samples = self.profile(seconds)
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        path = os.path.join(PROFILE_DIR, f"{label}-{os.getpid()}-{time.strftime('%Y%m%d-%H%M%S')}.folded")
+        with open(path, 'w') as f:
+            f.write(stacks)
+        print(f"[Profiler] {samples} samples written to {path}", flush=True)
+        return path
+
+
+# Profiler of this process
+profiler = SamplingProfiler(PROFILE_HZ)
+
+
+def install_signal_handler(label):
+    """
+    Let 'kill -USR2 <pid>' profile this process for PROFILE_SIGNAL_SECONDS into PROFILE_DIR.
+    Must be called from the main thread. Works for processes without HTTP, like the Grand Server and the sync sidecar.
+    """
+    if not hasattr(signal, 'SIGUSR2'):
+        return
+
+    def run():
+        try:
+            profiler.profile_to_file(PROFILE_SIGNAL_SECONDS, label)
+        except ProfilerBusy as e:
+            print(f"[Profiler] {e}", flush=True)
+
+    def handle(signum, frame):
+        # Signal handlers run on the main thread between bytecodes: hand the work to a thread right away
+        threading.Thread(target=run, name='profiler', daemon=True).start()
+
+    signal.signal(signal.SIGUSR2, handle)
@@ -0,0 +1,151 @@
+# rate_limit.py
+import math
+import time
+import threading
+from collections import OrderedDict
+from functools import wraps
+
+from flask import Response, session, make_response
+from werkzeug.wsgi import ClosingIterator
+
+from config import RATE_LIMITS, MAX_CONCURRENT_TRANSFERS
+
+
+class TokenBucket:
+    #Classic token bucket: 'rate' tokens per second, holding at most 'capacity'.
+
+    def __init__(self, rate, capacity):
+        """ Start with a full bucket. """
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, amount):
+        """
+        Take 'amount' tokens. Returns 0 when allowed, otherwise the seconds to wait.
+        Amounts bigger than the capacity are allowed once the bucket is full and leave it in debt,
+        so one large file is never refused forever.
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+
+            needed = min(amount, self.capacity)
+            if self.tokens >= needed:
+                self.tokens -= amount
+                return 0
+            return (needed - self.tokens) / self.rate
+
+
+class RateLimiter:
+    #Per-user token buckets for every route class (requests and bytes) plus a cap on concurrent transfers.
+    #State is per process: with several workers each one enforces the limits on its own share of the traffic.
+
+    def __init__(self, limits, max_transfers, max_users=10000):
+        """ 'limits' maps a route class to (requests/s, request burst, bytes/s, byte burst); None disables a dimension. """
+        self.limits = limits
+        self.max_transfers = max_transfers
+        self.max_users = max_users
+        self.buckets = OrderedDict()   # (user id, route class, 'requests' | 'bytes') -> TokenBucket, least recently used first
+        self.transfers = {}            # user id -> transfers in progress
+        self.lock = threading.Lock()
+
+    def _bucket(self, user_id, route_class, kind):
+        """ Return (creating if needed) one bucket, forgetting the least recently used ones beyond max_users. """
+        req_rate, req_burst, byte_rate, byte_burst = self.limits[route_class]
+        rate, burst = (req_rate, req_burst) if kind == 'requests' else (byte_rate, byte_burst)
+        if rate is None:
+            return None
+
+        key = (user_id, route_class, kind)
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                bucket = self.buckets[key] = TokenBucket(rate, burst)
+                while len(self.buckets) > self.max_users * 2:
+                    self.buckets.popitem(last=False)
+            else:
+                self.buckets.move_to_end(key)
+            return bucket
+
+    def check_request(self, user_id, route_class):
+        """ Count one request. Returns 0 when allowed, otherwise the seconds to wait. """
+        bucket = self._bucket(user_id, route_class, 'requests')
+        return bucket.consume(1) if bucket else 0
+
+    def charge_bytes(self, user_id, route_class, nbytes):
+        """ Count transferred bytes. Returns 0 when allowed, otherwise the seconds to wait. """
+        bucket = self._bucket(user_id, route_class, 'bytes')
+        return bucket.consume(nbytes) if bucket and nbytes else 0
+
+    def acquire_transfer(self, user_id):
+        """ Take one of the user's concurrent-transfer slots. Returns False if all are in use. """
+        with self.lock:
+            if self.transfers.get(user_id, 0) >= self.max_transfers:
+                return False
+            self.transfers[user_id] = self.transfers.get(user_id, 0) + 1
+            return True
+
+    def release_transfer(self, user_id):
+        """ Give a transfer slot back. """
+        with self.lock:
+            left = self.transfers.get(user_id, 0) - 1
+            if left > 0:
+                self.transfers[user_id] = left
+            else:
+                self.transfers.pop(user_id, None)
+
+
+def too_many_requests(retry_after):
+    """ Build a 429 response telling the client when to retry. """
+    seconds = max(1, math.ceil(retry_after))
+    return Response(
+        f"Too many requests, please retry in {seconds} seconds.\n",
+        status=429,
+        mimetype='text/plain',
+        headers={'Retry-After': str(seconds)}
+    )
+
+
+def rate_limited(route_class, transfer=False):
+    """
+    View decorator: apply the per-user request limit of 'route_class'. With transfer=True the view also
+    holds one of the user's concurrent-transfer slots until the response (including streamed bodies) is closed.
+    Anonymous requests pass through; the views themselves redirect them to the login page.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            user_id = session.get('user_id')
+            if not user_id:
+                return view(*args, **kwargs)
+
+            wait = limiter.check_request(user_id, route_class)
+            if wait:
+                return too_many_requests(wait)
+            if not transfer:
+                return view(*args, **kwargs)
+
+            if not limiter.acquire_transfer(user_id):
+                return too_many_requests(1)
+            try:
+                response = make_response(view(*args, **kwargs))
+            except BaseException:
+                limiter.release_transfer(user_id)
+                raise
+            release = lambda: limiter.release_transfer(user_id)
+            if response.direct_passthrough:
+                # send_file bodies bypass Response.close, so release when the body iterator is closed
+                response.response = ClosingIterator(response.response, release)
+            else:
+                response.call_on_close(release)
+            return response
+        return wrapper
+    return decorator
+
+
+# Shared limiter for the web routes
+limiter = RateLimiter(RATE_LIMITS, MAX_CONCURRENT_TRANSFERS)
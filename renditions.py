@@ -0,0 +1,119 @@
+# renditions.py
+import os
+import hashlib
+
+from models import db, BlobInfo
+from storage import blob_store
+from config import THUMBNAIL_SIZE
+
+# Pillow and PyMuPDF are optional: without them the matching previews are simply not offered
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+try:
+    import fitz  # PyMuPDF
+except ImportError:
+    fitz = None
+
+IMAGE_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
+PDF_EXTENSIONS = {'pdf'}
+
+
+class RenditionManager:
+    #Creates and locates small renditions of files: thumbnails for images, first-page previews for PDFs.
+    #Renditions live in a 'renditions' folder next to the blobs and are keyed by the SHA-256 of the file's bytes.
+
+    def __init__(self, upload_folder):
+        """ Initialize with the upload folder; renditions are stored in its 'renditions' subfolder. """
+        self.upload_folder = upload_folder
+        self.folder = os.path.join(upload_folder, 'renditions')
+        os.makedirs(self.folder, exist_ok=True)
+
+    def kind_of(self, filename):
+        """ Return 'image', 'pdf' or None depending on the file's extension. """
+        ext = filename.rsplit('.', 1)[1].lower() if '.' in filename else ''
+        if ext in IMAGE_EXTENSIONS:
+            return 'image'
+        if ext in PDF_EXTENSIONS:
+            return 'pdf'
+        return None
+
+    def can_render(self, filename):
+        """ Check whether a preview can be produced for this file type with the installed libraries. """
+        kind = self.kind_of(filename)
+        return (kind == 'image' and Image is not None) or (kind == 'pdf' and fitz is not None and Image is not None)
+
+    def content_hash(self, file_record):
+        """ Return the SHA-256 of a file's bytes, hashing the blob once and remembering the result. Returns None if the bytes are not here. """
+        info = db.session.get(BlobInfo, file_record.stored_filename)
+        if info:
+            return info.content_hash
+
+        digest = hashlib.sha256()
+        try:
+            with blob_store.open(file_record.stored_filename) as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                    digest.update(chunk)
+        except FileNotFoundError:
+            return None
+
+        info = BlobInfo(stored_filename=file_record.stored_filename, content_hash=digest.hexdigest())
+        db.session.merge(info)
+        db.session.commit()
+        return info.content_hash
+
+    def path_for(self, content_hash):
+        """ Location of the rendition for the given content. """
+        return os.path.join(self.folder, f"{content_hash}.jpg")
+
+    def get(self, file_record):
+        """ Return (path, content_hash) of an existing rendition, or (None, hash) if it still has to be generated. """
+        content_hash = self.content_hash(file_record)
+        if content_hash is None:
+            return None, None
+        path = self.path_for(content_hash)
+        return (path if os.path.isfile(path) else None), content_hash
+
+    def generate(self, file_record):
+        """
+        Create the rendition for a file if it does not exist yet. Returns its path, or None if no preview can be made
+        here (type not renderable, bytes not on this regional). Errors while rendering are raised, so the job is retried.
+        """
+        if not self.can_render(file_record.original_filename):
+            return None
+        path, content_hash = self.get(file_record)
+        if path or content_hash is None:
+            return path
+
+        dest = self.path_for(content_hash)
+        tmp = dest + '.part'
+        try:
+            with blob_store.open(file_record.stored_filename) as src:
+                if self.kind_of(file_record.original_filename) == 'pdf':
+                    self._render_pdf(blob_store.local_path(file_record.stored_filename) or src, tmp)
+                else:
+                    self._render_image(src, tmp)
+            os.replace(tmp, dest)  # atomic, concurrent renders of the same content just overwrite each other
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        return dest
+
+    def _render_image(self, src, dest):
+        """ Downscale an image (first frame for GIFs) read from the open blob 'src' into a JPEG thumbnail. """
+        with Image.open(src) as img:
+            img.thumbnail(THUMBNAIL_SIZE)
+            img.convert('RGB').save(dest, 'JPEG', quality=80, optimize=True)
+
+    def _render_pdf(self, src, dest):
+        """ Render the first page of a PDF (a local path, or an open blob that is read whole) into a JPEG preview. """
+        with (fitz.open(src) if isinstance(src, str) else fitz.open(stream=src.read(), filetype='pdf')) as doc:
+            page = doc[0]
+            # Scale so the longer side of the page matches the thumbnail box
+            zoom = max(THUMBNAIL_SIZE) / max(page.rect.width, page.rect.height)
+            pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom))
+            img = Image.frombytes('RGB', (pix.width, pix.height), pix.samples)
+            img.save(dest, 'JPEG', quality=80, optimize=True)
@@ -0,0 +1,104 @@
+# request_log.py
+import os
+import time
+import threading
+from collections import deque
+
+from flask import g, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from config import SLOW_REQUEST_SECONDS, SLOW_REQUEST_LOG_SIZE
+
+# SQL statements are cut to this many characters in the log
+SQL_TEXT_CHARS = 300
+
+# SQL counters of the current thread: every engine (all shards) reports into the thread that ran the statement
+sql_stats = threading.local()
+
+
+class SlowRequestLog:
+    #The last SLOW_REQUEST_LOG_SIZE requests of this process that took longer than SLOW_REQUEST_SECONDS,
+    #with how many SQL statements they ran, how long those took and which one was the slowest.
+
+    def __init__(self, threshold, size):
+        self.threshold = threshold
+        self.entries = deque(maxlen=size)
+        self.lock = threading.Lock()
+
+    def record(self, entry):
+        with self.lock:
+            self.entries.append(entry)
+
+    def slowest(self):
+        """ The logged requests, slowest first. """
+        with self.lock:
+            entries = list(self.entries)
+        return sorted(entries, key=lambda e: e['seconds'], reverse=True)
+
+
+# Slow requests of this process
+slow_requests = SlowRequestLog(SLOW_REQUEST_SECONDS, SLOW_REQUEST_LOG_SIZE)
+
+
+def _reset_sql_stats():
+    sql_stats.count = 0
+    sql_stats.seconds = 0.0
+    sql_stats.slowest = (0.0, None)
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info['query_started'].pop()
+    if not hasattr(sql_stats, 'count'):
+        return  # not inside a request
+    elapsed = time.perf_counter() - started
+    sql_stats.count += 1
+    sql_stats.seconds += elapsed
+    if elapsed > sql_stats.slowest[0]:
+        sql_stats.slowest = (elapsed, statement)
+
+
+@event.listens_for(Engine, 'handle_error')
+def _failed_execute(context):
+    # A failed statement never reaches after_cursor_execute
+    started = context.connection.info.get('query_started') if context.connection is not None else None
+    if started:
+        started.pop()
+
+
+def install(app):
+    """ Time every request of 'app' and log the slow ones. """
+
+    @app.before_request
+    def _start_timer():
+        g.request_started = time.perf_counter()
+        _reset_sql_stats()
+
+    @app.teardown_request
+    def _log_if_slow(exc):
+        started = g.pop('request_started', None)
+        if started is None:
+            return
+        seconds = time.perf_counter() - started
+        if seconds >= slow_requests.threshold:
+            slowest_seconds, slowest_sql = sql_stats.slowest
+            slow_requests.record({
+                'at':           time.time(),
+                'pid':          os.getpid(),
+                'method':       request.method,
+                'path':         request.path,
+                'endpoint':     request.endpoint,
+                'seconds':      seconds,
+                'sql_count':    sql_stats.count,
+                'sql_seconds':  sql_stats.seconds,
+                'slowest_sql':  (slowest_sql or '')[:SQL_TEXT_CHARS],
+                'slowest_sql_seconds': slowest_seconds,
+                'error':        repr(exc) if exc else None,
+            })
+        del sql_stats.count
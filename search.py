@@ -0,0 +1,257 @@
+# search.py
+from sqlalchemy import event, select, text
+
+from models import db, File, Friendship
+from config import SEARCH_FILE_CONTENTS, SEARCH_CONTENT_BYTES
+from compression import GZIP, looks_gzipped, open_logical
+from sharding import SHARD_IDS, on_shard, shard_of
+
+# Extensions whose bytes are indexed as text when SEARCH_FILE_CONTENTS is on
+TEXT_EXTENSIONS = {'txt'}
+
+# FTS5 index over file names (and optionally text contents), scoped inside the index: each trigram is stored as a
+# token prefixed with the file's owner and visibility (see scope_key), so a query only reads the posting lists of the
+# users it may see, however many other files the shard holds. Names are indexed without their extension, whose
+# trigrams ('pdf', 'txt') would match most files. The rowid is the file id; 'filename' is the whole lowercased name,
+# used to check matches that cross into the extension.
+CREATE_INDEX_SQL = """
+CREATE VIRTUAL TABLE IF NOT EXISTS file_search USING fts5(
+    name, content, filename UNINDEXED, tokenize = 'unicode61'
+)
+"""
+
+# Matches below this similarity (share of the query's trigrams found in the name) are not shown
+FUZZY_MIN_SIMILARITY = 0.3
+
+
+def trigrams(value):
+    """ The set of lowercase 3-character substrings of a string. """
+    value = value.lower()
+    return {value[i:i + 3] for i in range(len(value) - 2)}
+
+
+def stem(filename):
+    """ A file name without its extension (names like '.bashrc' are kept whole). """
+    head, dot, tail = filename.rpartition('.')
+    return head or filename
+
+
+def scope_key(user_id, public):
+    """ Token prefix of a file's trigrams: its owner, and whether the owner's friends may see it. """
+    return f"{user_id}{'p' if public else 'x'}"
+
+
+def gram_tokens(key, value):
+    """ The trigrams of a string in order, as index tokens under 'key' (hex-encoded, so any character can be matched). """
+    value = value.lower()
+    return ' '.join(key + value[i:i + 3].encode('utf-8').hex() for i in range(len(value) - 2))
+
+
+def like_pattern(value):
+    """ LIKE pattern for a substring, with the wildcards in it taken literally (ESCAPE '\\'). """
+    return '%' + value.replace('\\', '\\\\').replace('%', r'\%').replace('_', r'\_') + '%'
+
+
+def indexes_contents(stored_filename):
+    """ Whether the text contents of this file are searchable (they are added by an 'index_contents' job). """
+    return SEARCH_FILE_CONTENTS and stored_filename.rsplit('.', 1)[-1].lower() in TEXT_EXTENSIONS
+
+
+def read_text(stored_filename):
+    """ First SEARCH_CONTENT_BYTES of a text file's bytes, or '' when not indexed or not on this regional. """
+    if not indexes_contents(stored_filename):
+        return ''
+    try:
+        # The stored encoding is sniffed, so no session is needed
+        with open_logical(stored_filename, GZIP if looks_gzipped(stored_filename) else None) as f:
+            return f.read(SEARCH_CONTENT_BYTES).decode('utf-8', errors='ignore')
+    except (OSError, EOFError):
+        return ''
+
+
+class SearchIndex:
+    #Filename search over the files a user may see: their own files and their friends' public files.
+
+    def __init__(self, limit=50):
+        """ 'limit' caps the number of results of one query. """
+        self.limit = limit
+
+    def create(self):
+        """ Create the index in every shard where it is missing (or has an older layout) and fill it from that shard's File rows. Must run inside an application context. """
+        for shard_id in SHARD_IDS:
+            schema = db.session.execute(text(
+                "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'file_search'"
+            ), bind_arguments=on_shard(shard_id)).scalar()
+            if schema is not None and 'filename' in schema:
+                continue
+            if schema is not None:
+                # The first layout filtered the scope after matching; it is rebuilt with scoped tokens
+                db.session.execute(text("DROP TABLE file_search"), bind_arguments=on_shard(shard_id))
+            db.session.execute(text(CREATE_INDEX_SQL), bind_arguments=on_shard(shard_id))
+            count = 0
+            for rec in db.session.execute(select(File), bind_arguments=on_shard(shard_id)).scalars().yield_per(1000):
+                self._insert(db.session, rec, shard_id, read_text(rec.stored_filename))
+                count += 1
+            db.session.commit()
+            print(f"[Search] Indexed {count} files (shard {shard_id})", flush=True)
+
+    def _insert(self, conn, rec, shard_id=None, content=''):
+        # 'conn' is a flush connection (already on the right shard) or the session plus the shard to write to
+        key = scope_key(rec.user_id, rec.permissions == 'public')
+        conn.execute(text(
+            "INSERT INTO file_search (rowid, name, content, filename) VALUES (:id, :name, :content, :filename)"
+        ), {'id': rec.id, 'name': gram_tokens(key, stem(rec.original_filename)), 'content': gram_tokens(key, content),
+            'filename': rec.original_filename.lower()},
+            **({'bind_arguments': on_shard(shard_id)} if shard_id is not None else {}))
+
+    def index_contents(self, rec):
+        """ Fill in the text contents of an indexed file from its bytes (run as a job, outside the insert's transaction). """
+        content = read_text(rec.stored_filename)
+        if not content:
+            return
+        key = scope_key(rec.user_id, rec.permissions == 'public')
+        db.session.execute(text("UPDATE file_search SET content = :content WHERE rowid = :id"),
+                           {'id': rec.id, 'content': gram_tokens(key, content)},
+                           bind_arguments=on_shard(shard_of(rec.user_id)))
+        db.session.commit()
+
+    def _update(self, conn, rec):
+        # A permission change moves every token to the other key; the hex trigrams never contain 'p' or 'x'
+        public = rec.permissions == 'public'
+        conn.execute(text(
+            "UPDATE file_search SET name = :name, filename = :filename, content = replace(content, :old, :new) "
+            "WHERE rowid = :id"
+        ), {'id': rec.id, 'name': gram_tokens(scope_key(rec.user_id, public), stem(rec.original_filename)),
+            'filename': rec.original_filename.lower(),
+            'old': scope_key(rec.user_id, not public), 'new': scope_key(rec.user_id, public)})
+
+    def _delete(self, conn, file_id):
+        conn.execute(text("DELETE FROM file_search WHERE rowid = :id"), {'id': file_id})
+
+    def scope(self, user):
+        """ Owner ids whose files 'user' may search: (own id, friend ids). """
+        friends = [f.friend_id for f in Friendship.query.filter_by(user_id=user.id).all()]
+        return user.id, friends
+
+    def _scope_keys(self, scope):
+        """ Token prefixes a user may match: all of their own files, their friends' public ones. """
+        own, friends = scope
+        return [scope_key(own, False), scope_key(own, True)] + [scope_key(f, True) for f in friends]
+
+    def _scoped_match(self, match, scope, limit, like=None):
+        """
+        Run an FTS5 MATCH built from _scope_keys(scope), best matches first. Returns file ids.
+        Each shard indexes its own users' files, so only the shards of the scope's users are asked.
+        'like' additionally requires the whole lowercased name to match that LIKE pattern.
+        """
+        own, friends = scope
+        rows = []
+        for shard_id in sorted({shard_of(own)} | {shard_of(f) for f in friends}):
+            rows += db.session.execute(text(
+                "SELECT rowid, rank FROM file_search WHERE file_search MATCH :match "
+                + ("AND filename LIKE :like ESCAPE '\\' " if like else "") +
+                "ORDER BY rank LIMIT :limit"
+            ), {'match': match, 'like': like, 'limit': limit}, bind_arguments=on_shard(shard_id)).all()
+        rows.sort(key=lambda r: r[1])
+        return [r[0] for r in rows[:limit]]
+
+    def _scoped_like(self, scope, pattern):
+        """ Names in scope matching a LIKE pattern, in name order (for queries too short for trigrams). """
+        own, friends = scope
+        records = File.query.filter(
+            db.or_(File.user_id == own, db.and_(File.user_id.in_(friends), File.permissions == 'public')),
+            File.original_filename.ilike(pattern, escape='\\')
+        ).order_by(File.original_filename).limit(self.limit).all()
+        # Each shard returns its own first 'limit' names; merge them
+        return sorted(records, key=lambda r: r.original_filename)[:self.limit]
+
+    def search(self, user, query):
+        """
+        Find files by name (and text content). Substring matches come first, names starting with the query
+        before the rest; if there are few of those, names sharing most of the query's trigrams (typos) follow.
+        """
+        query = query.strip()
+        if not query:
+            return []
+
+        scope = self.scope(user)
+        keys = self._scope_keys(scope)
+        lowered = query.lower()
+        # Only the part before the query's last dot can be matched against the indexed stems: if the query
+        # runs into a name's extension, that dot is the name's last one
+        name_part = lowered.rpartition('.')[0] if '.' in lowered else lowered
+        if len(name_part) < 3:
+            # Too short for trigrams: plain LIKE on names in scope (prefix, or substring for '.pdf' and the like)
+            pattern = like_pattern(query) if '.' in query else like_pattern(query)[1:]
+            return self._scoped_like(scope, pattern)
+
+        phrases = ' OR '.join(f'"{gram_tokens(k, name_part)}"' for k in keys)
+        ids = self._scoped_match(f"name : ({phrases})", scope, self.limit,
+                                 like_pattern(lowered) if name_part != lowered else None)
+        if SEARCH_FILE_CONTENTS and len(ids) < self.limit:
+            phrases = ' OR '.join(f'"{gram_tokens(k, lowered)}"' for k in keys)
+            ids += [i for i in self._scoped_match(f"content : ({phrases})", scope, self.limit) if i not in ids]
+        substring_ids = set(ids)
+
+        if len(ids) < self.limit and len(name_part) >= 4:
+            # Fuzzy: any of the query's trigrams, kept only if enough of them appear in the name
+            grams = trigrams(name_part)
+            tokens = ' OR '.join(f'"{gram_tokens(k, g)}"' for k in keys for g in sorted(grams))
+            ids += [i for i in self._scoped_match(f"name : ({tokens})", scope, self.limit * 10)
+                    if i not in substring_ids]
+
+        records = {f.id: f for f in File.query.filter(File.id.in_(ids)).all()} if ids else {}
+        exact, fuzzy = [], []
+        for file_id in ids:
+            rec = records.get(file_id)
+            if rec is None:
+                continue
+            if file_id in substring_ids:
+                exact.append(rec)
+                continue
+            similarity = len(trigrams(stem(rec.original_filename)) & trigrams(name_part)) / len(trigrams(name_part))
+            if similarity >= FUZZY_MIN_SIMILARITY:
+                fuzzy.append((similarity, rec))
+
+        # Names starting with the query first (stable, so FTS rank order is kept within each group)
+        exact.sort(key=lambda r: not r.original_filename.lower().startswith(lowered))
+        fuzzy.sort(key=lambda item: -item[0])
+        return (exact + [rec for _, rec in fuzzy])[:self.limit]
+
+
+search_index = SearchIndex()
+
+
+# --- incremental maintenance -------------------------------------------------------------
+# Index writes run on the flush's own connection, so they commit or roll back together with the File change.
+# Every path that changes files (uploads, deletes, permissions, applied sync events, anti-entropy repairs) is covered.
+
+# Set once the index table is known to exist (it is created in every shard at startup, possibly by another process)
+index_ready = False
+
+
+def _index_ready(connection):
+    global index_ready
+    if not index_ready:
+        index_ready = connection.execute(text(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'file_search'"
+        )).first() is not None
+    return index_ready
+
+
+@event.listens_for(File, 'after_insert')
+def _file_inserted(mapper, connection, target):
+    if _index_ready(connection):
+        search_index._insert(connection, target)
+
+
+@event.listens_for(File, 'after_update')
+def _file_updated(mapper, connection, target):
+    if _index_ready(connection):
+        search_index._update(connection, target)
+
+
+@event.listens_for(File, 'after_delete')
+def _file_deleted(mapper, connection, target):
+    if _index_ready(connection):
+        search_index._delete(connection, target.id)
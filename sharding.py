@@ -0,0 +1,169 @@
+# sharding.py
+import os
+import zlib
+import threading
+from contextlib import ExitStack, contextmanager
+
+from sqlalchemy import text
+from sqlalchemy.ext.horizontal_shard import ShardedSession
+from sqlalchemy.schema import CreateIndex
+from sqlalchemy.sql import operators
+from sqlalchemy.sql.elements import BinaryExpression, BindParameter, BooleanClauseList
+
+from config import SHARD_COUNT, basedir
+from ids import next_id
+
+# Shard ids as used by SQLAlchemy's horizontal sharding. Shard '0' is the original database.db.
+SHARD_IDS = [str(i) for i in range(SHARD_COUNT)]
+
+# The column each table is partitioned by. Rows of one user live together, so single-user queries hit one file;
+# blob facts have no owner column and are spread by their stored filename.
+SHARD_KEYS = {
+    'user':           'id',
+    'file':           'user_id',
+    'friend_request': 'from_user_id',
+    'friendship':     'user_id',
+    'home_user':      'user_id',
+    'file_tombstone': 'user_id',
+    'blob_info':      'stored_filename',
+    'blob_encoding':  'stored_filename',
+    'job':            'user_id',
+}
+
+
+def shard_of(value):
+    """ Shard holding a shard-key value (a user id or a stored filename). Hashed, so snowflake ids spread evenly. """
+    return str(zlib.crc32(str(value).encode('utf-8')) % SHARD_COUNT)
+
+
+def shard_binds():
+    """ SQLALCHEMY_BINDS entries for shards 1..N-1 (shard 0 is the default database). """
+    return {f"shard{i}": f"sqlite:///{os.path.join(basedir, f'database-shard{i}.db')}" for i in range(1, SHARD_COUNT)}
+
+
+def engine_key(shard_id):
+    """ Flask-SQLAlchemy engine key of a shard. """
+    return None if shard_id == '0' else f"shard{shard_id}"
+
+
+def shard_engines(db):
+    """ Every shard's engine, by shard id. Needs an application context. """
+    return {shard_id: db.engines[engine_key(shard_id)] for shard_id in SHARD_IDS}
+
+
+def create_all(db):
+    """ Create missing tables in every shard, and indexes added to existing tables later. """
+    for engine in shard_engines(db).values():
+        db.metadata.create_all(bind=engine)
+        # IF NOT EXISTS instead of checkfirst: reflection does not report expression indexes (see anti_entropy.py)
+        with engine.begin() as conn:
+            for table in db.metadata.sorted_tables:
+                for index in table.indexes:
+                    conn.execute(CreateIndex(index, if_not_exists=True))
+
+
+def on_shard(shard_id):
+    """ bind_arguments for running a statement (e.g. raw SQL) on one shard. Harmless without sharding. """
+    return {'shard_id': shard_id}
+
+
+def lock_shard(session, shard_id='0'):
+    """
+    Hold SQLite's write lock of a shard until 'session' commits or rolls back, in every process. Unique columns
+    are only enforced within one shard file, so a check across all shards followed by an insert runs under the
+    lock of shard 0. Commits whatever the session had pending first.
+    """
+    session.commit()
+    session.execute(text("BEGIN IMMEDIATE"), bind_arguments=on_shard(shard_id))
+
+
+# --- routing -------------------------------------------------------------------------------
+
+def choose_shard(mapper, instance, clause=None, **kw):
+    """ Shard of a row being written, from its shard key. Statements without a mapped row go to shard 0. """
+    if mapper is None or instance is None:
+        return '0'
+    key = SHARD_KEYS[mapper.local_table.name]
+    value = getattr(instance, key)
+    if value is None and key == 'id':
+        # The id default only runs at INSERT time, after the shard is chosen, so hand it out now
+        value = next_id()
+        setattr(instance, key, value)
+    return shard_of(value)
+
+
+def choose_identity(mapper, primary_key, **kw):
+    """ Shards a primary-key lookup must visit: one when the key is the shard key, otherwise all (tried in turn). """
+    if SHARD_KEYS[mapper.local_table.name] == mapper.primary_key[0].key:
+        return [shard_of(primary_key[0])]
+    return SHARD_IDS
+
+
+def _routed_shards(clause, column, params):
+    """
+    Shards a WHERE clause restricts 'column' to, or None if it does not. Only comparisons that every
+    matching row must satisfy count (top-level AND terms, or ORs made purely of such comparisons).
+    'params' are the statement's execution parameters (primary-key loads pass their values there).
+    """
+    if isinstance(clause, BooleanClauseList):
+        parts = [_routed_shards(c, column, params) for c in clause.clauses]
+        if clause.operator is operators.and_:
+            known = [p for p in parts if p is not None]
+            return set.intersection(*known) if known else None
+        if clause.operator is operators.or_:
+            return None if any(p is None for p in parts) else set().union(*parts)
+        return None
+
+    if isinstance(clause, BinaryExpression) and isinstance(clause.right, BindParameter) \
+            and hasattr(clause.left, 'shares_lineage') and clause.left.shares_lineage(column):
+        value = params.get(clause.right.key, clause.right.effective_value)
+        if value is None:
+            return None
+        if clause.operator is operators.eq:
+            return {shard_of(value)}
+        if clause.operator is operators.in_op:
+            return {shard_of(v) for v in value}
+    return None
+
+
+def choose_execute(orm_context):
+    """ Shards a query runs on: routed by its shard key when the WHERE clause pins it, otherwise scatter-gather over all. """
+    mapper = orm_context.bind_mapper
+    statement = orm_context.statement
+    if mapper is None or mapper.local_table.name not in SHARD_KEYS or getattr(statement, 'whereclause', None) is None:
+        return SHARD_IDS
+    column = mapper.local_table.c[SHARD_KEYS[mapper.local_table.name]]
+    params = orm_context.parameters if isinstance(orm_context.parameters, dict) else {}
+    shards = _routed_shards(statement.whereclause, column, params)
+    if shards is None:
+        return SHARD_IDS
+    # An empty IN () matches nothing; any single shard gives the (empty) answer
+    return sorted(shards) or SHARD_IDS[:1]
+
+
+class RoutedSession(ShardedSession):
+    #Flask-SQLAlchemy session over all shards: writes go to the row's shard, reads are routed or scattered.
+
+    def __init__(self, db, **kwargs):
+        """ Created per application context by Flask-SQLAlchemy, so the shard engines are available. """
+        super().__init__(
+            shard_chooser=choose_shard,
+            identity_chooser=choose_identity,
+            execute_chooser=choose_execute,
+            shards=shard_engines(db),
+            **kwargs
+        )
+
+
+# --- write locks ---------------------------------------------------------------------------
+# SQLite has one writer per file, so the sync applier serializes writes per shard instead of globally.
+shard_locks = {shard_id: threading.Lock() for shard_id in SHARD_IDS}
+
+
+@contextmanager
+def write_lock(shards=None):
+    """ Hold the write locks of the given shards (all shards when None), always taken in the same order. """
+    with ExitStack() as stack:
+        for shard_id in sorted(SHARD_IDS if shards is None else set(shards)):
+            stack.enter_context(shard_locks[shard_id])
+        yield
@@ -0,0 +1,118 @@
+// live.js
+// Applies the deltas of /live/stream to the open page (dashboard, friend requests) without reloading it.
+// Anything the page cannot apply in place (first file of an empty list, dropped deltas) falls back to a reload.
+(function () {
+  if (!window.EventSource) {
+    return;
+  }
+  var script = document.currentScript;
+  var source = new EventSource(script.dataset.stream);
+
+  // URLs of the row templates end in "/0" (rendered for id 0)
+  function withId(url, id) {
+    return url.replace(/\/0$/, '/' + id);
+  }
+
+  function fillFields(el, values) {
+    el.querySelectorAll('[data-field]').forEach(function (field) {
+      if (field.dataset.field in values) {
+        field.textContent = values[field.dataset.field];
+      }
+    });
+  }
+
+  function cloneTemplate(id, objectId) {
+    var el = document.getElementById(id).content.firstElementChild.cloneNode(true);
+    el.querySelectorAll('[href], [action], [src]').forEach(function (node) {
+      ['href', 'action', 'src'].forEach(function (attr) {
+        if (node.hasAttribute(attr)) {
+          node.setAttribute(attr, withId(node.getAttribute(attr), objectId));
+        }
+      });
+    });
+    return el;
+  }
+
+  function fileRow(id) {
+    return document.querySelector('#file-rows tr[data-file-id="' + id + '"]');
+  }
+
+  function setStatus(row, status) {
+    var badge = row.querySelector('.job-status');
+    if (!status) {
+      if (badge) badge.remove();
+      return;
+    }
+    if (!badge) {
+      badge = document.createElement('span');
+      row.querySelector('[data-field="name"]').after(badge);
+    }
+    badge.className = status === 'failed' ? 'job-status job-failed' : 'job-status';
+    badge.textContent = status === 'failed' ? 'processing failed' : 'processing…';
+  }
+
+  function gigabytes(bytes) {
+    return (Math.round(bytes / (1024 * 1024 * 1024) * 100) / 100) + ' GB';
+  }
+
+  var handlers = {
+    file_added: function (delta) {
+      var rows = document.getElementById('file-rows');
+      if (!rows) {
+        if (document.querySelector('.files-section')) location.reload();
+        return;
+      }
+      if (fileRow(delta.file.id)) return;
+      var row = cloneTemplate('file-row-template', delta.file.id);
+      row.dataset.fileId = delta.file.id;
+      row.querySelector('input[name="file_ids"]').value = delta.file.id;
+      if (!delta.file.preview) row.querySelector('img.thumb').remove();
+      rows.prepend(row);
+      handlers.file_updated(delta);
+    },
+    file_updated: function (delta) {
+      var row = fileRow(delta.file.id);
+      if (!row) return;
+      fillFields(row, delta.file);
+      row.querySelector('select[name="permissions"]').value = delta.file.permissions;
+    },
+    file_removed: function (delta) {
+      var row = fileRow(delta.id);
+      if (row) row.remove();
+    },
+    file_status: function (delta) {
+      var row = fileRow(delta.id);
+      if (row) setStatus(row, delta.status);
+    },
+    storage: function (delta) {
+      var usage = document.querySelector('.storage-usage');
+      if (usage) fillFields(usage, {used: gigabytes(delta.used), quota: gigabytes(delta.quota)});
+    },
+    friend_request: function (delta) {
+      if (!document.getElementById('request-card-template')) return;
+      var grid = document.getElementById('incoming-requests');
+      if (!grid) {
+        location.reload();
+        return;
+      }
+      if (grid.querySelector('[data-request-id="' + delta.request_id + '"]')) return;
+      var card = cloneTemplate('request-card-template', delta.request_id);
+      card.dataset.requestId = delta.request_id;
+      fillFields(card, delta);
+      grid.prepend(card);
+    },
+    friend_request_closed: function (delta) {
+      var card = document.querySelector('#incoming-requests [data-request-id="' + delta.request_id + '"]');
+      if (card) card.remove();
+    },
+    reload: function () {
+      location.reload();
+    }
+  };
+
+  Object.keys(handlers).forEach(function (type) {
+    source.addEventListener(type, function (message) {
+      handlers[type](JSON.parse(message.data));
+    });
+  });
+})();
@@ -0,0 +1,372 @@
+# storage.py
+# Where blob bytes live. Everything that reads or writes a stored file goes through 'blob_store', so the bytes can sit
+# in the local upload folder or in an S3-compatible object store (SYNCSPHERE_STORAGE) without the callers knowing.
+# Blobs are named by their stored_filename; names starting with QUARANTINE belong to the garbage collector.
+import io
+import os
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from config import (STORAGE_BACKEND, UPLOAD_FOLDER, S3_BUCKET, S3_PREFIX, S3_ENDPOINT_URL, S3_REGION, S3_PART_BYTES,
+                    S3_UPLOAD_CONCURRENCY, S3_READ_BYTES)
+
+# boto3 is optional: it is only needed for the object-store backend
+try:
+    import boto3
+    from botocore.config import Config as BotoConfig
+    from botocore.exceptions import ClientError
+except ImportError:
+    boto3 = None
+
+# Read/write size when copying blobs
+CHUNK_SIZE = 256 * 1024
+
+# Quarantined blobs are kept under this name prefix (see garbage_collector.py)
+QUARANTINE = 'quarantine/'
+
+# S3 allows at most this many parts per multipart upload
+S3_MAX_PARTS = 10000
+
+
+class BlobStore:
+    #What every backend provides. Readers are seekable binary files, so zipfile, gzip and Pillow can use them directly.
+
+    # Whether touch() is remembered, i.e. the modification time can order the blob cache by last access
+    tracks_access = False
+
+    def stat(self, name):
+        """ (size, modification time) of a blob, or None if it does not exist. """
+        raise NotImplementedError
+
+    def exists(self, name):
+        return self.stat(name) is not None
+
+    def open(self, name):
+        """ Open a blob for reading. Raises FileNotFoundError. """
+        raise NotImplementedError
+
+    def iter_range(self, name, start=0, end=None, chunk_size=CHUNK_SIZE):
+        """ Yield the bytes [start, end) of a blob (to its end when 'end' is None) chunk by chunk. """
+        with self.open(name) as f:
+            f.seek(start)
+            left = None if end is None else end - start
+            while left is None or left > 0:
+                chunk = f.read(chunk_size if left is None else min(chunk_size, left))
+                if not chunk:
+                    return
+                if left is not None:
+                    left -= len(chunk)
+                yield chunk
+
+    def put(self, name, fileobj):
+        """ Store everything read from 'fileobj' as blob 'name', replacing it atomically. Returns the number of bytes. """
+        raise NotImplementedError
+
+    def put_file(self, name, path):
+        """ Store a finished temporary file of the upload folder as blob 'name'. The temporary file is used up. Returns its size. """
+        raise NotImplementedError
+
+    def delete(self, name):
+        """ Delete a blob; a missing one is not an error. """
+        raise NotImplementedError
+
+    def move(self, src, dest):
+        """ Rename a blob (quarantine and restore). Raises FileNotFoundError if 'src' does not exist. """
+        raise NotImplementedError
+
+    def touch(self, name):
+        """ Mark a blob as just used (only where tracks_access is set). """
+
+    def scan(self, prefix=''):
+        """ Yield (name without the prefix, size, modification time) of the blobs directly under 'prefix'. """
+        raise NotImplementedError
+
+    def local_path(self, name):
+        """ Path of the blob on this host's disk, or None when it is not a local file. """
+        return None
+
+    def locator(self, name):
+        """ A string identifying the blob's location, for ETags. """
+        raise NotImplementedError
+
+
+class LocalStore(BlobStore):
+    #Blobs as files in a folder of this host (the upload folder); quarantine is a subfolder.
+
+    tracks_access = True
+
+    def __init__(self, folder):
+        self.folder = folder
+        os.makedirs(folder, exist_ok=True)
+
+    def path(self, name):
+        return os.path.join(self.folder, name)
+
+    def stat(self, name):
+        try:
+            st = os.stat(self.path(name))
+        except (FileNotFoundError, NotADirectoryError):
+            return None
+        return st.st_size, st.st_mtime
+
+    def open(self, name):
+        return open(self.path(name), 'rb')
+
+    def put(self, name, fileobj):
+        dest = self.path(name)
+        tmp = dest + '.part'
+        with open(tmp, 'wb') as f:
+            shutil.copyfileobj(fileobj, f, CHUNK_SIZE)
+            size = f.tell()
+        os.replace(tmp, dest)  # atomic, readers never see a partial blob
+        return size
+
+    def put_file(self, name, path):
+        size = os.path.getsize(path)
+        os.replace(path, self.path(name))
+        return size
+
+    def delete(self, name):
+        try:
+            os.remove(self.path(name))
+        except FileNotFoundError:
+            pass
+
+    def move(self, src, dest):
+        dest_path = self.path(dest)
+        os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+        os.replace(self.path(src), dest_path)
+
+    def touch(self, name):
+        try:
+            os.utime(self.path(name))
+        except OSError:
+            pass
+
+    def scan(self, prefix=''):
+        try:
+            entries = list(os.scandir(self.path(prefix)))
+        except FileNotFoundError:
+            return
+        for entry in entries:
+            if entry.is_file():
+                try:
+                    st = entry.stat()
+                except FileNotFoundError:
+                    continue
+                yield entry.name, st.st_size, st.st_mtime
+
+    def local_path(self, name):
+        return self.path(name)
+
+    def locator(self, name):
+        return os.path.abspath(self.path(name))
+
+
+class S3Store(BlobStore):
+    #Blobs as objects under 'prefix' in an S3-compatible bucket. Uploads over one part are sent as multipart uploads,
+    #several parts at a time; reads are streamed GETs starting wherever the reader seeks to, so nothing is buffered whole.
+
+    def __init__(self, bucket, prefix, endpoint_url, region, part_bytes, concurrency, read_bytes):
+        if boto3 is None:
+            raise RuntimeError("SYNCSPHERE_STORAGE=s3 needs boto3 (pip install boto3).")
+        self.bucket = bucket
+        self.prefix = prefix
+        self.part_bytes = part_bytes
+        self.concurrency = concurrency
+        self.read_bytes = read_bytes
+        # Enough pooled connections for the part uploads plus concurrent downloads
+        self.client = boto3.client('s3', endpoint_url=endpoint_url, region_name=region,
+                                   config=BotoConfig(max_pool_connections=max(10, 4 * concurrency)))
+        self.pool = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='s3-upload')
+
+    def key(self, name):
+        return self.prefix + name
+
+    def stat(self, name):
+        try:
+            head = self.client.head_object(Bucket=self.bucket, Key=self.key(name))
+        except ClientError as e:
+            if _not_found(e):
+                return None
+            raise
+        return head['ContentLength'], head['LastModified'].timestamp()
+
+    def open(self, name):
+        stat = self.stat(name)
+        if stat is None:
+            raise FileNotFoundError(name)
+        return io.BufferedReader(_ObjectReader(self, self.key(name), stat[0]), self.read_bytes)
+
+    def get_body(self, key, start, end=None):
+        """ Streaming body of the bytes [start, end) of an object. """
+        byte_range = f"bytes={start}-{'' if end is None else end - 1}"
+        try:
+            return self.client.get_object(Bucket=self.bucket, Key=key, Range=byte_range)['Body']
+        except ClientError as e:
+            if _not_found(e):
+                raise FileNotFoundError(key) from e
+            raise
+
+    def iter_range(self, name, start=0, end=None, chunk_size=CHUNK_SIZE):
+        # One ranged GET, read as it arrives
+        if end is not None and end <= start:
+            return
+        body = self.get_body(self.key(name), start, end)
+        try:
+            yield from body.iter_chunks(chunk_size)
+        finally:
+            body.close()
+
+    def put(self, name, fileobj, part_bytes=None):
+        part_bytes = part_bytes or self.part_bytes
+        key = self.key(name)
+        data = _read_full(fileobj, part_bytes)
+        if len(data) < part_bytes:
+            # Fits in one request
+            self.client.put_object(Bucket=self.bucket, Key=key, Body=data)
+            return len(data)
+
+        upload_id = self.client.create_multipart_upload(Bucket=self.bucket, Key=key)['UploadId']
+        # At most 'concurrency' parts of this upload are in memory (read ahead or in flight) at a time
+        slots = threading.Semaphore(self.concurrency)
+        futures = []
+        size = 0
+        try:
+            number = 1
+            while data:
+                slots.acquire()
+                if any(f.done() and f.exception() for f in futures):
+                    slots.release()
+                    break  # a part failed; result() below raises its error
+                future = self.pool.submit(self._put_part, key, upload_id, number, data)
+                future.add_done_callback(lambda f: slots.release())
+                futures.append(future)
+                size += len(data)
+                number += 1
+                data = _read_full(fileobj, part_bytes)
+            parts = [f.result() for f in futures]
+            self.client.complete_multipart_upload(Bucket=self.bucket, Key=key, UploadId=upload_id,
+                                                  MultipartUpload={'Parts': parts})
+        except BaseException:
+            for f in futures:
+                f.cancel()
+            try:
+                self.client.abort_multipart_upload(Bucket=self.bucket, Key=key, UploadId=upload_id)
+            except Exception as e:
+                print(f"[Storage] Could not abort the upload of {name}: {e}", flush=True)
+            raise
+        return size
+
+    def _put_part(self, key, upload_id, number, data):
+        response = self.client.upload_part(Bucket=self.bucket, Key=key, UploadId=upload_id, PartNumber=number, Body=data)
+        return {'PartNumber': number, 'ETag': response['ETag']}
+
+    def put_file(self, name, path):
+        # Larger parts for huge files, so they stay within the part limit
+        part_bytes = max(self.part_bytes, -(-os.path.getsize(path) // S3_MAX_PARTS))
+        with open(path, 'rb') as f:
+            size = self.put(name, f, part_bytes)
+        os.remove(path)
+        return size
+
+    def delete(self, name):
+        self.client.delete_object(Bucket=self.bucket, Key=self.key(name))
+
+    def move(self, src, dest):
+        # Managed copy: switches to a multipart copy for objects over 5 GB
+        try:
+            self.client.copy({'Bucket': self.bucket, 'Key': self.key(src)}, self.bucket, self.key(dest))
+        except ClientError as e:
+            if _not_found(e):
+                raise FileNotFoundError(src) from e
+            raise
+        self.delete(src)
+
+    def scan(self, prefix=''):
+        start = len(self.key(prefix))
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self.key(prefix), Delimiter='/'):
+            for obj in page.get('Contents', ()):
+                yield obj['Key'][start:], obj['Size'], obj['LastModified'].timestamp()
+
+    def locator(self, name):
+        return f"s3://{self.bucket}/{self.key(name)}"
+
+
+class _ObjectReader(io.RawIOBase):
+    #Seekable reader of one object. Sequential reads continue the open GET; a seek elsewhere starts a new ranged GET there.
+
+    def __init__(self, store, key, size):
+        self.store = store
+        self.key = key
+        self.size = size
+        self.pos = 0
+        self.body = None
+        self.body_pos = None  # offset the open body continues at
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self.pos, io.SEEK_END: self.size}[whence]
+        self.pos = max(0, base + offset)
+        return self.pos
+
+    def readinto(self, buffer):
+        if self.pos >= self.size:
+            return 0
+        if self.body is None or self.body_pos != self.pos:
+            self._close_body()
+            self.body = self.store.get_body(self.key, self.pos)
+            self.body_pos = self.pos
+        data = self.body.read(min(len(buffer), self.size - self.pos))
+        n = len(data)
+        buffer[:n] = data
+        self.pos += n
+        self.body_pos += n
+        return n
+
+    def _close_body(self):
+        if self.body is not None:
+            self.body.close()
+            self.body = None
+
+    def close(self):
+        self._close_body()
+        super().close()
+
+
+def _read_full(fileobj, size):
+    """ Read 'size' bytes, or fewer only at the end of the stream (streams may return short reads). """
+    chunks, left = [], size
+    while left > 0:
+        chunk = fileobj.read(left)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        left -= len(chunk)
+    return b''.join(chunks)
+
+
+def _not_found(error):
+    return error.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound')
+
+
+def make_store():
+    """ The backend selected by SYNCSPHERE_STORAGE. """
+    if STORAGE_BACKEND == 's3':
+        return S3Store(S3_BUCKET, S3_PREFIX, S3_ENDPOINT_URL, S3_REGION, S3_PART_BYTES, S3_UPLOAD_CONCURRENCY,
+                       S3_READ_BYTES)
+    return LocalStore(UPLOAD_FOLDER)
+
+
+# Blob storage of this regional
+blob_store = make_store()
@@ -1,31 +1,140 @@
+import io
 import os
 import socket
 import json
 import base64
 import time
 import ssl
-from datetime import datetime
+import threading
+import uuid
 from queue import Empty
 
-from config import GRAND_HOST, GRAND_PORT, changes_queue, UPLOAD_FOLDER
+from config import GRAND_HOST, GRAND_PORT, changes_queue, REGION_ID, SUBSCRIBE_FRIEND_FILES, FETCH_TIMEOUT, LAZY_BLOBS, SYNC_MODE
+from config import LARGE_FILE_BYTES, ANTI_ENTROPY_INTERVAL, BLOB_CACHE_RETRY
+from bulk import bulk_budget, Transfer, BulkLinks, BulkReceiver
+from blob_cache import blob_cache
+from storage import blob_store
+from compression import get_encoding, set_encoding
+from compaction import compact_events, get_stats
+from sync_apply import apply_batch
+from jobs import enqueue
+from search import indexes_contents
+from tracing import start_trace, stamp, trace_buffer
+import anti_entropy
+
+# The live connection to the Grand Server (None while disconnected)
+active_sock = None
+sock_lock = threading.Lock()  # request threads and the sync thread both write to the socket
+
+# Downloads waiting for a file to arrive from another regional: stored_filename -> (threading.Event, time asked).
+# Answers can be lost (disconnects), so an entry older than FETCH_TIMEOUT is asked again instead of waited on.
+pending_fetches = {}
+pending_lock = threading.Lock()
+
+# Holder queries waiting for their answer: request id -> (threading.Event, names confirmed by other regionals)
+pending_holders = {}
+
+# The last interest we registered with the Grand Server, so we only resend it when it changes
+last_interest = None
+
+# Events held back because the bulk budget ran out; they go out ahead of newer events next time
+deferred_events = []
+
+
+def send_packet(sock, packet):
+    """ Serialize a packet as one JSON line and write it to the socket while holding the socket lock. """
+    data = (json.dumps(packet) + '\n').encode('utf-8')
+    with sock_lock:
+        sock.sendall(data)
+
+
+def build_interest():
+    """ Describe which users this regional needs file bytes for: its home users and (optionally) their friends. """
+    from app import app
+    with app.app_context():
+        from models import HomeUser, Friendship
+
+        home = {h.user_id for h in HomeUser.query.all()}
+        friends = set()
+        if SUBSCRIBE_FRIEND_FILES and home:
+            rows = Friendship.query.filter(Friendship.user_id.in_(home)).all()
+            friends = {f.friend_id for f in rows} - home
+
+    return {
+        'type':    'subscribe',
+        'region':  REGION_ID,
+        'home':    sorted(home),
+        'friends': sorted(friends),
+        'lazy':    LAZY_BLOBS
+    }
+
+
+def send_interest(sock, force=False):
+    """ Register (or refresh) this regional's subscription with the Grand Server's routing index. """
+    global last_interest
+    interest = build_interest()
+    if not force and interest == last_interest:
+        return
+    send_packet(sock, interest)
+    last_interest = interest
 
 
 def send_changes(sock):
-    """ Drain the local changes_queue, encode file contents in Base64 when needed, and send a single 'changes' packet to the Grand Server over the socket."""
-    events = []
-    # Pull all pending events without blocking
-    while True:
-        try:
-            change = changes_queue.get_nowait()
-        except Empty:
-            break
+    """ Drain the local changes_queue and send it to the Grand Server. Events leave the sidecar's outbox only once sent; if sending fails they are all kept for the next attempt. """
+    # Held-back events come first so each file's events stay in order
+    held_back = list(deferred_events)
+    deferred_events.clear()
+    if SYNC_MODE == 'sidecar':
+        outbox_last, drained = changes_queue.peek()
+    else:
+        # Pull all pending events without blocking
+        outbox_last, drained = None, []
+        while True:
+            try:
+                drained.append(changes_queue.get_nowait())
+            except Empty:
+                break
+
+    try:
+        send_events(sock, held_back + drained)
+    except BaseException:
+        # The outbox still holds its events; in-memory ones are queued again
+        deferred_events[:] = held_back + (drained if outbox_last is None else [])
+        raise
+    if outbox_last:
+        changes_queue.ack(outbox_last)
+
+
+def send_events(sock, queued):
+    """ Compact queued events, attach file contents in Base64 when needed, and send a single 'changes' packet to the Grand Server over the socket. """
+    # Fold the burst into the minimal equivalent sequence before paying for any file bytes
+    compacted = compact_events(queued) if queued else []
+    if len(compacted) < len(queued):
+        stats = get_stats()
+        print(f"[Sync] Compacted {len(queued)} events into {len(compacted)} "
+              f"(total {stats['events_in']} -> {stats['events_out']}, {stats['bytes_saved']} bytes saved)", flush=True)
 
-        # If it's a new file upload, Base64-encode raw bytes for JSON transport
+    lanes_up = bulk_links.available()
+    if not lanes_up:
+        # Without bulk lanes, large uploads over the bulk budget wait for a later batch; small events are never held
+        compacted, held = split_bulk_budget(compacted)
+        if held:
+            deferred_events.extend(held)
+            print(f"[Sync] Bulk budget exhausted, deferring {len(held)} events", flush=True)
+
+    events = []
+    transfers = []
+    for change in compacted:
         if change['type'] == 'file_upload':
             payload_copy = change['payload'].copy()
-            raw = payload_copy.pop('content')  # remove binary data from payload
-            # encode bytes to UTF-8 string so it can be embedded in JSON
-            payload_copy['content'] = base64.b64encode(raw).decode('utf-8')
+            if lanes_up:
+                # The bytes follow on a bulk lane, so this batch is not stuck behind them
+                payload_copy['content'] = None
+                transfers.append(Transfer('upload', payload_copy['stored_filename'],
+                                          payload_copy['user_id'], payload_copy.get('encoding')))
+            else:
+                # Read the bytes now and Base64-encode them for JSON transport
+                payload_copy['content'] = read_content(payload_copy['stored_filename'])
             events.append({
                 'type': change['type'],
                 'payload': payload_copy,
@@ -35,106 +144,294 @@ def send_changes(sock):
             # other event types can be sent as-is
             events.append(change)
 
+    # Keep the Grand Server's routing index current (new logins, new friendships)
+    send_interest(sock)
+
     # If no events to send, do nothing
     if not events:
         return
 
+    # Every event carries its trace id and hop times, so the lag can be measured at the far end
+    sent = time.time()
+    for event in events:
+        start_trace(event)
+        stamp(event, 'sent', sent)
+
     # Build and send the JSON packet, ending with newline for framing
     packet = {'type': 'changes', 'events': events}
-    sock.sendall((json.dumps(packet) + '\n').encode('utf-8'))
+    send_packet(sock, packet)
+    trace_buffer.record('sent', events)
+
+    # Metadata first, then the bytes (receivers that get the metadata first fetch on demand if a lane drops)
+    for transfer in transfers:
+        bulk_links.submit(transfer)
+
+
+def event_file_ids(change):
+    """ File ids an event refers to (empty for user and friend events). """
+    if change['type'] == 'file_upload':
+        return {change['payload']['id']}
+    if 'file_ids' in change:
+        return set(change['file_ids'])
+    if 'file_id' in change:
+        return {change['file_id']}
+    return set()
+
+
+def split_bulk_budget(events):
+    """ Split a batch into (send now, hold back). Large uploads are charged to bulk_budget; once one is held, every later event on the same files is held too. """
+    send, held = [], []
+    held_files = set()
+    for change in events:
+        file_ids = event_file_ids(change)
+        if file_ids & held_files:
+            held.append(change)
+            held_files |= file_ids
+            continue
+
+        if change['type'] == 'file_upload':
+            size = change['payload'].get('file_size') or 0
+            if size >= LARGE_FILE_BYTES and bulk_budget.consume(size):
+                held.append(change)
+                held_files |= file_ids
+                continue
+        send.append(change)
+    return send, held
+
+
+def read_content(stored_filename):
+    """ Read a local file as a Base64 string, or None if its bytes are no longer here (peers then fetch on demand). """
+    try:
+        with blob_store.open(stored_filename) as f:
+            # encode bytes to UTF-8 string so it can be embedded in JSON
+            return base64.b64encode(f.read()).decode('utf-8')
+    except FileNotFoundError:
+        return None
 
 
 def receive_changes(message):
-    """ Apply incoming events from Grand Server inside a fresh Flask application context. This allows us to modify the database and file system safely."""
+    """ Apply incoming events from Grand Server. Events are partitioned by user and applied in parallel, keeping each user's order."""
+    events = message.get('events', [])
+    received = time.time()
+    for event in events:
+        stamp(event, 'received', received)
+    if events:
+        apply_batch(events)
+
+
+def serve_fetch(sock, message):
+    """ Answer another regional's on-demand fetch: reply with the file bytes (in their stored encoding) if we hold them, or None if we do not. """
+    stored_filename = os.path.basename(message.get('stored_filename', ''))
+    present = bool(stored_filename) and blob_store.exists(stored_filename)
+    encoding = None
+    if present:
+        from app import app
+        with app.app_context():
+            encoding = get_encoding(stored_filename)
+        # The bytes go out on a bulk lane, read chunk by chunk there; if the lane gives up on them, report a miss
+        miss = lambda: send_packet(sock, {'type': 'blob', 'stored_filename': stored_filename, 'content': None})
+        if bulk_links.submit(Transfer('blob', stored_filename, encoding=encoding, on_drop=miss)):
+            return
+    content = read_content(stored_filename) if present else None
+    send_packet(sock, {'type': 'blob', 'stored_filename': stored_filename, 'content': content, 'encoding': encoding})
+
+
+def store_blob(message):
+    """ Store a fetched file sent inline (on the control connection), or report a miss. """
+    stored_filename = os.path.basename(message.get('stored_filename', ''))
+    if message.get('content') is not None and stored_filename:
+        data = base64.b64decode(message['content'])
+        blob_store.put(stored_filename, io.BytesIO(data))  # atomic, so readers never see a half-written file
+        blob_arrived(stored_filename, len(data), message.get('encoding'))
+        return
+
+    print(f"[Sync] Fetch failed, no regional holds {stored_filename}", flush=True)
+    wake_fetch(stored_filename)
+
+
+def blob_arrived(stored_filename, size, encoding=None, owner_id=None):
+    """ Register bytes that were just stored (fetch answer or replicated upload) and wake up waiting downloads. """
     from app import app
+    from models import db, File, HomeUser
     with app.app_context():
-        from file_management import FileManager
-        from friend_management import FriendManager
-        from models import db, User, File
+        if encoding:
+            # Usually already known from the file_upload event, but rows repaired by anti-entropy arrive without it
+            set_encoding(stored_filename, encoding)
+        if indexes_contents(stored_filename):
+            # The file was indexed by name only while its bytes were elsewhere
+            for rec in File.query.filter_by(stored_filename=stored_filename).all():
+                enqueue('index_contents', rec.id, rec.user_id)
+        db.session.commit()
+        home = owner_id is not None and db.session.get(HomeUser, owner_id) is not None
+    if home:
+        blob_cache.pin(stored_filename)
+    else:
+        blob_cache.add(stored_filename, size)
+    wake_fetch(stored_filename)
 
-        file_manager = FileManager(upload_folder=UPLOAD_FOLDER)
-        friend_manager = FriendManager()
 
-        for sync_event in message.get('events', []):
-            event_type = sync_event.get('type')
-            try:
-                if event_type == 'file_upload':
-                    # Decode and write file bytes
-                    payload = sync_event['payload']
-                    data = base64.b64decode(payload['content'])
-                    dest = os.path.join(UPLOAD_FOLDER, payload['stored_filename'])
-                    os.makedirs(os.path.dirname(dest), exist_ok=True)
-                    with open(dest, 'wb') as f:
-                        f.write(data)
-
-                    # Merge into DB (insert or update existing record by ID)
-                    rec = File(
-                        id=payload['id'],
-                        user_id=payload['user_id'],
-                        stored_filename=payload['stored_filename'],
-                        original_filename=payload['original_filename'],
-                        file_size=payload['file_size'],
-                        permissions=payload['permissions'],
-                        upload_date=datetime.fromisoformat(payload['upload_date'])
-                    )
-                    db.session.merge(rec)
-                    db.session.commit()
-
-                elif event_type == 'file_delete':
-                    rec = file_manager.get_file_record(sync_event['file_id'])
-                    if not rec:
-                        print(f"[Sync] Warn: no file record for deletion ID {sync_event['file_id']}", flush=True)
-                        continue
-                    user = User.query.get(rec.user_id)
-                    file_manager.delete_file(rec, user, enqueue=False)
-
-                elif event_type == 'permission_change':
-                    rec = file_manager.get_file_record(sync_event['file_id'])
-                    if not rec:
-                        print(f"[Sync] Warn: no file for permission change ID {sync_event['file_id']}", flush=True)
-                        continue
-                    user = User.query.get(rec.user_id)
-                    file_manager.update_permissions(rec, sync_event['new_permissions'], user, enqueue=False)
-
-                elif event_type == 'user_create':
-                    # Merge new user record, preserves existing if present
-                    u = User(
-                        id=sync_event['user_id'],
-                        username=sync_event['username'],
-                        email=sync_event['email']
-                    )
-                    u.set_password(sync_event['password'])
-                    db.session.merge(u)
-                    db.session.commit()
-
-                elif event_type == 'friend_request':
-                    friend_manager.send_request(
-                        User.query.get(sync_event['from_user']),
-                        User.query.get(sync_event['to_user']),
-                        enqueue=False
-                    )
-
-                elif event_type == 'friend_added':
-                    friend_manager.respond_request(sync_event['request_id'], accept=True, enqueue=False)
-
-                elif event_type == 'friend_rejected':
-                    friend_manager.respond_request(sync_event['request_id'], accept=False, enqueue=False)
-
-                elif event_type == 'friend_removed':
-                    friend_manager.remove_friend(
-                        User.query.get(sync_event['user_id']),
-                        User.query.get(sync_event['friend_id']),
-                        enqueue=False
-                    )
-
-                else:
-                    # Unknown event type — log for debugging
-                    print(f"[Sync] Unknown event type: {event_type}", flush=True)
-
-            except Exception as e:
-                # Roll back any partial DB changes on error
-                db.session.rollback()
-                print(f"[Sync] Error applying '{event_type}' event: {e}", flush=True)
+def wake_fetch(stored_filename):
+    """ Wake up the downloads waiting for a file, whether it arrived or not. """
+    with pending_lock:
+        entry = pending_fetches.pop(stored_filename, None)
+    if entry:
+        entry[0].set()
+
+
+def drop_fetch(stored_filename, waiter):
+    """ Forget a fetch that got no answer in time, unless a newer request already replaced it. """
+    with pending_lock:
+        entry = pending_fetches.get(stored_filename)
+        if entry is not None and entry[0] is waiter:
+            del pending_fetches[stored_filename]
+
+
+def drop_all_fetches():
+    """ The connection changed: answers to earlier fetches will not come, so wake their downloads and forget them. """
+    with pending_lock:
+        entries = list(pending_fetches.values())
+        pending_fetches.clear()
+    for waiter, _ in entries:
+        waiter.set()
+
+
+# Chunked blobs arriving on the bulk lanes, and the lanes of the current link
+bulk_receiver = BulkReceiver(blob_arrived)
+bulk_links = BulkLinks(bulk_receiver)
+
+
+def request_blob(stored_filename):
+    """ Send a fetch request for a file unless one is already in flight. Returns the Event set when the answer arrives, or None. """
+    sock = active_sock
+    if sock is None:
+        return None
+
+    with pending_lock:
+        entry = pending_fetches.get(stored_filename)
+        first = entry is None or time.time() - entry[1] > FETCH_TIMEOUT
+        if first:
+            if entry is not None:
+                entry[0].set()  # its answer is lost; whoever still waits on it checks for the file and gives up
+            pending_fetches[stored_filename] = (threading.Event(), time.time())
+        waiter = pending_fetches[stored_filename][0]
+
+    # Only the first download for a file sends the request; the others just wait for the same answer
+    if first:
+        try:
+            send_packet(sock, {'type': 'fetch', 'stored_filename': stored_filename})
+        except Exception as e:
+            print(f"[Sync] Could not request {stored_filename}: {e}", flush=True)
+            drop_fetch(stored_filename, waiter)
+            return None
+    return waiter
+
+
+def fetch_blob(stored_filename, timeout=FETCH_TIMEOUT):
+    """ Ask the Grand Server for a file whose bytes are not on this regional. Returns True once the file is stored. """
+    return stored_filename in fetch_blobs([stored_filename], timeout)
+
+
+def fetch_blobs(stored_filenames, timeout=FETCH_TIMEOUT):
+    """ Fetch several files at once: every request goes out first, then they share one timeout. Returns the names now stored here. """
+    deadline = time.time() + timeout
+    if SYNC_MODE == 'sidecar' and active_sock is None:
+        # Web worker: the sidecar owns the connection, so hand it the requests and watch for the files
+        for stored_filename in stored_filenames:
+            changes_queue.request_fetch(stored_filename)
+        waiting = set(stored_filenames)
+        while waiting and time.time() < deadline:
+            waiting = {name for name in waiting if not blob_store.exists(name)}
+            if waiting:
+                time.sleep(0.1)
+    else:
+        waiters = [(name, request_blob(name)) for name in stored_filenames]
+        for name, waiter in waiters:
+            if waiter is not None and not waiter.wait(max(0, deadline - time.time())):
+                # No answer: let the next download ask again
+                drop_fetch(name, waiter)
+    return {name for name in stored_filenames if blob_store.exists(name)}
+
+
+def serve_fetch_requests():
+    """ Sidecar loop: pass fetch requests from the web workers to the Grand Server. """
+    while True:
+        try:
+            for stored_filename in changes_queue.take_fetch_requests():
+                if not blob_store.exists(stored_filename):
+                    request_blob(stored_filename)
+        except Exception as e:
+            print(f"[Sync] Fetch request error: {e}", flush=True)
+        time.sleep(0.1)
+
+
+def handle_prefetch(message):
+    """ Act on a Grand Server hint that a public file is hot: fetch it in the background if the cache has room. """
+    stored_filename = os.path.basename(message.get('stored_filename', ''))
+    if not stored_filename or blob_store.exists(stored_filename):
+        return
+    if blob_cache.has_room(message.get('file_size', 0)):
+        request_blob(stored_filename)
+
+
+def ask_holders(names, timeout=FETCH_TIMEOUT):
+    """ Ask the other regionals which of the given blobs they keep pinned. Returns the confirmed names (none while disconnected). """
+    sock = active_sock
+    if sock is None or not names:
+        return set()
+    request_id = uuid.uuid4().hex
+    waiter, held = threading.Event(), set()
+    with pending_lock:
+        pending_holders[request_id] = (waiter, held)
+    try:
+        send_packet(sock, {'type': 'holders', 'request': request_id, 'stored_filenames': sorted(names)})
+        answered = waiter.wait(timeout)
+    except Exception as e:
+        print(f"[Sync] Could not ask for holders: {e}", flush=True)
+        answered = False
+    finally:
+        with pending_lock:
+            pending_holders.pop(request_id, None)
+    return held if answered else set()
+
+
+def serve_holders(sock, message):
+    """ Tell another regional which of the named blobs we keep for good, so it may evict its replicas of them. """
+    names = [os.path.basename(n) for n in message.get('stored_filenames', [])]
+    held = blob_cache.held_here(names) if names else set()
+    send_packet(sock, {'type': 'holders_reply', 'request': message.get('request'), 'stored_filenames': sorted(held)})
+
+
+def holders_answered(message):
+    """ Hand the Grand Server's combined answer to the waiting ask_holders call. """
+    with pending_lock:
+        entry = pending_holders.get(message.get('request'))
+    if entry is not None:
+        entry[1].update(message.get('stored_filenames', []))
+        entry[0].set()
+
+
+def evict_loop():
+    """ Background loop: evict replicas while the blob cache is over budget, keeping those no other regional holds. """
+    while True:
+        blob_cache.wakeup.wait(BLOB_CACHE_RETRY)
+        blob_cache.wakeup.clear()
+        try:
+            blob_cache.evict(ask_holders)
+        except Exception as e:
+            print(f"[BlobCache] Eviction interrupted: {e}", flush=True)
+
+
+def anti_entropy_loop():
+    """ Background loop: periodically start an anti-entropy round over the current connection. """
+    while True:
+        time.sleep(ANTI_ENTROPY_INTERVAL)
+        sock = active_sock
+        if sock is None:
+            continue
+        try:
+            anti_entropy.start_round(sock)
+        except Exception as e:
+            print(f"[AntiEntropy] Could not start a round: {e}", flush=True)
 
 
 def sync_changes(sock):
@@ -151,16 +448,36 @@ def sync_changes(sock):
             send_changes(sock)
         elif message_type == 'receive':
             receive_changes(received_message)
+        elif message_type == 'fetch':
+            serve_fetch(sock, received_message)
+        elif message_type == 'blob':
+            store_blob(received_message)
+        elif message_type == 'chunk':
+            # Relayed on the control connection only when we have no bulk lane
+            bulk_receiver.receive(received_message)
+        elif message_type == 'prefetch':
+            handle_prefetch(received_message)
+        elif message_type == 'holders':
+            serve_holders(sock, received_message)
+        elif message_type == 'holders_reply':
+            holders_answered(received_message)
+        elif message_type == 'ae':
+            anti_entropy.answer(sock, received_message)
+        elif message_type == 'ae_reply':
+            anti_entropy.handle_reply(sock, received_message)
 
         time.sleep(0)  # yield to other threads
 
     # When connection closes, clean up
+    global active_sock
+    active_sock = None
+    drop_all_fetches()
     sock.close()
     print("[Sync] Connection closed", flush=True)
 
 
-def connect_to_server():
-    """ Establish a TLS-wrapped TCP connection to the Grand Server, then enter the sync loop."""
+def open_connection():
+    """ Open a TLS-wrapped TCP connection to the Grand Server. """
     # Create SSL context for client with no verification (dev only)
     context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
     context.check_hostname = False
@@ -168,7 +485,29 @@ def connect_to_server():
 
     raw_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     sock = context.wrap_socket(raw_sock, server_hostname=GRAND_HOST)
-
     sock.connect((GRAND_HOST, GRAND_PORT))
+    return sock
+
+
+def connect_to_server():
+    """ Connect the control connection and the bulk lanes to the Grand Server, then enter the sync loop."""
+    sock = open_connection()
     print("[Sync] Connected to grand server", flush=True)
-    sync_changes(sock)
+
+    # The link id lets the Grand Server attach our bulk lanes to this control connection
+    link_id = uuid.uuid4().hex
+    send_packet(sock, {'type': 'hello', 'lane': 'control', 'link': link_id, 'region': REGION_ID})
+
+    global active_sock
+    active_sock = sock
+    # Fetches sent on an earlier connection are answered on it or not at all
+    drop_all_fetches()
+    # Register our interest before any events are routed to us
+    send_interest(sock, force=True)
+    # Eviction waits for a connection to confirm other copies
+    blob_cache.wakeup.set()
+    bulk_links.open(link_id, open_connection)
+    try:
+        sync_changes(sock)
+    finally:
+        bulk_links.close()
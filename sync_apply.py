@@ -0,0 +1,250 @@
+# sync_apply.py
+import io
+import base64
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+from config import UPLOAD_FOLDER, SYNC_APPLY_WORKERS
+from blob_cache import blob_cache
+from storage import blob_store
+from compression import set_encoding
+from sharding import shard_of, write_lock
+from tracing import stamp, trace_buffer
+from jobs import enqueue
+from search import indexes_contents
+
+# Worker pool shared by every incoming batch
+apply_pool = ThreadPoolExecutor(max_workers=SYNC_APPLY_WORKERS, thread_name_prefix='sync-apply')
+
+# SQLite has a single writer per file, so the DB part of each event runs under the write locks of the
+# shards it touches (see event_shards). Decoding, blob writes and password hashing happen outside them
+# and overlap across partitions.
+
+
+def event_users(sync_event):
+    """ Return the ids of the users an event touches (its ordering key). Missing ids are resolved from the local DB. """
+    from models import File, FriendRequest
+
+    etype = sync_event.get('type')
+    if etype == 'file_upload':
+        return [sync_event['payload']['user_id']]
+    if etype in ('file_delete', 'permission_change'):
+        if 'user_id' in sync_event:
+            return [sync_event['user_id']]
+        rec = File.query.get(sync_event['file_id'])
+        return [rec.user_id] if rec else []
+    if etype in ('files_deleted', 'permissions_changed', 'user_create'):
+        return [sync_event['user_id']]
+    if etype in ('friend_request', 'friend_added', 'friend_rejected'):
+        if 'from_user' in sync_event:
+            return [sync_event['from_user'], sync_event['to_user']]
+        fr = FriendRequest.query.get(sync_event['request_id'])
+        return [fr.from_user_id, fr.to_user_id] if fr else []
+    if etype == 'friend_removed':
+        return [sync_event['user_id'], sync_event['friend_id']]
+    return []
+
+
+def event_shards(sync_event):
+    """ Return the metadata shards an event writes to, or None when it may write to any of them. """
+    etype = sync_event.get('type')
+    if etype in ('file_delete', 'files_deleted'):
+        # Deleting files also drops blob facts, which are spread by stored filename
+        return None
+    users = event_users(sync_event)
+    if not users:
+        return None
+    shards = {shard_of(u) for u in users}
+    if etype == 'file_upload':
+        shards.add(shard_of(sync_event['payload']['stored_filename']))
+    return shards
+
+
+def partition_events(events):
+    """
+    Split a batch into independent partitions. Events that share a user id end up in the
+    same partition (friend events join their two users), and each partition keeps batch order.
+    Must run inside an application context.
+    """
+    parent = {}
+
+    def find(key):
+        while parent[key] != key:
+            parent[key] = parent[parent[key]]  # path halving
+            key = parent[key]
+        return key
+
+    keys = []
+    for i, sync_event in enumerate(events):
+        users = event_users(sync_event)
+        # Events we cannot key are kept apart, they do not depend on anything else
+        nodes = [('user', u) for u in users] or [('event', i)]
+        for node in nodes:
+            parent.setdefault(node, node)
+        root = find(nodes[0])
+        for node in nodes[1:]:
+            other = find(node)
+            if other != root:
+                parent[other] = root
+        keys.append(nodes[0])
+
+    partitions = {}
+    for sync_event, key in zip(events, keys):
+        partitions.setdefault(find(key), []).append(sync_event)
+    return list(partitions.values())
+
+
+def prepare_event(sync_event):
+    """ Do the lock-free part of an event: store file bytes, hash passwords. Returns what apply_event needs. """
+    from models import User
+
+    etype = sync_event.get('type')
+    if etype == 'file_upload':
+        payload = sync_event['payload']
+        # Metadata-only events (owner not local here) carry no bytes; they are fetched on download
+        if payload.get('content') is None:
+            return None
+        data = base64.b64decode(payload['content'])
+        blob_store.put(payload['stored_filename'], io.BytesIO(data))
+        return len(data)
+
+    if etype == 'user_create':
+        u = User(
+            id=sync_event['user_id'],
+            username=sync_event['username'],
+            email=sync_event['email']
+        )
+        u.set_password(sync_event['password'])
+        return u
+
+    return None
+
+
+def apply_event(sync_event, prepared, file_manager, friend_manager):
+    """ Apply the DB part of one event. The caller holds the write locks of event_shards(sync_event). """
+    from models import db, User, File, HomeUser
+
+    event_type = sync_event.get('type')
+    if event_type == 'file_upload':
+        payload = sync_event['payload']
+        if prepared is not None:
+            # Home users' files are local data; everyone else's bytes are an evictable replica
+            if db.session.get(HomeUser, payload['user_id']) is not None:
+                blob_cache.pin(payload['stored_filename'])
+            else:
+                blob_cache.add(payload['stored_filename'], prepared)
+
+        # Merge into DB (insert or update existing record by ID)
+        rec = File(
+            id=payload['id'],
+            user_id=payload['user_id'],
+            stored_filename=payload['stored_filename'],
+            original_filename=payload['original_filename'],
+            file_size=payload['file_size'],
+            permissions=payload['permissions'],
+            upload_date=datetime.fromisoformat(payload['upload_date'])
+        )
+        db.session.merge(rec)
+        # The bytes travel in their stored form, so keep the origin's encoding with them
+        set_encoding(payload['stored_filename'], payload.get('encoding'))
+        if prepared is not None and indexes_contents(payload['stored_filename']):
+            enqueue('index_contents', payload['id'], payload['user_id'])
+        db.session.commit()
+
+    elif event_type == 'file_delete':
+        rec = file_manager.get_file_record(sync_event['file_id'])
+        if not rec:
+            print(f"[Sync] Warn: no file record for deletion ID {sync_event['file_id']}", flush=True)
+            return
+        user = User.query.get(rec.user_id)
+        file_manager.delete_file(rec, user, enqueue=False)
+
+    elif event_type == 'permission_change':
+        rec = file_manager.get_file_record(sync_event['file_id'])
+        if not rec:
+            print(f"[Sync] Warn: no file for permission change ID {sync_event['file_id']}", flush=True)
+            return
+        user = User.query.get(rec.user_id)
+        file_manager.update_permissions(rec, sync_event['new_permissions'], user, enqueue=False)
+
+    elif event_type == 'files_deleted':
+        records = [r for r in (file_manager.get_file_record(fid) for fid in sync_event['file_ids']) if r]
+        if records:
+            file_manager.delete_files(records, User.query.get(sync_event['user_id']), enqueue=False)
+
+    elif event_type == 'permissions_changed':
+        records = [r for r in (file_manager.get_file_record(fid) for fid in sync_event['file_ids']) if r]
+        if records:
+            file_manager.update_permissions_bulk(records, sync_event['new_permissions'],
+                                                 User.query.get(sync_event['user_id']), enqueue=False)
+
+    elif event_type == 'user_create':
+        # Merge new user record (password already hashed by prepare_event), preserves existing if present
+        db.session.merge(prepared)
+        db.session.commit()
+
+    elif event_type == 'friend_request':
+        friend_manager.send_request(
+            User.query.get(sync_event['from_user']),
+            User.query.get(sync_event['to_user']),
+            enqueue=False,
+            request_id=sync_event.get('request_id')  # same id everywhere, so later answers find it
+        )
+
+    elif event_type == 'friend_added':
+        if 'from_user' in sync_event:
+            friend_manager.accept_between(sync_event['from_user'], sync_event['to_user'])
+        else:
+            friend_manager.respond_request(sync_event['request_id'], accept=True, enqueue=False)
+
+    elif event_type == 'friend_rejected':
+        friend_manager.respond_request(sync_event['request_id'], accept=False, enqueue=False)
+
+    elif event_type == 'friend_removed':
+        friend_manager.remove_friend(
+            User.query.get(sync_event['user_id']),
+            User.query.get(sync_event['friend_id']),
+            enqueue=False
+        )
+
+    else:
+        # Unknown event type — log for debugging
+        print(f"[Sync] Unknown event type: {event_type}", flush=True)
+
+
+def apply_partition(events):
+    """ Apply one partition in order on a pool thread, inside its own application context. """
+    from app import app
+    with app.app_context():
+        from file_management import FileManager
+        from friend_management import FriendManager
+        from models import db
+
+        file_manager = FileManager(upload_folder=UPLOAD_FOLDER)
+        friend_manager = FriendManager()
+
+        for sync_event in events:
+            event_type = sync_event.get('type')
+            try:
+                prepared = prepare_event(sync_event)
+                with write_lock(event_shards(sync_event)):
+                    apply_event(sync_event, prepared, file_manager, friend_manager)
+                stamp(sync_event, 'applied')
+            except Exception as e:
+                # Roll back any partial DB changes on error
+                db.session.rollback()
+                print(f"[Sync] Error applying '{event_type}' event: {e}", flush=True)
+
+        # Failed events have no 'applied' hop and stay out of the lag figures
+        trace_buffer.record('applied', [e for e in events if 'applied' in e.get('trace', {}).get('hops', {})])
+
+
+def apply_batch(events):
+    """ Partition a batch by user, apply the partitions in parallel and wait until all of them are done. """
+    from app import app
+    with app.app_context():
+        partitions = partition_events(events)
+
+    futures = [apply_pool.submit(apply_partition, part) for part in partitions]
+    for future in futures:
+        future.result()
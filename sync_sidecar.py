@@ -0,0 +1,35 @@
+# sync_sidecar.py
+# The single sync process of a multi-worker regional (SYNCSPHERE_SYNC_MODE=sidecar).
+# It drains the shared outbox, applies incoming changes, serves fetch requests and runs the post-upload jobs for every web worker.
+import threading
+import time
+
+from app import prepare
+from sync import connect_to_server, serve_fetch_requests, anti_entropy_loop, evict_loop
+from garbage_collector import gc_loop
+from jobs import job_loop
+from profiler import install_signal_handler
+
+# Seconds to wait before reconnecting after the Grand Server connection drops
+RECONNECT_DELAY = 5
+
+
+def main():
+    prepare()
+    install_signal_handler('sidecar')
+    threading.Thread(target=serve_fetch_requests, daemon=True).start()
+    threading.Thread(target=anti_entropy_loop, daemon=True).start()
+    threading.Thread(target=gc_loop, daemon=True).start()
+    threading.Thread(target=evict_loop, daemon=True).start()
+    threading.Thread(target=job_loop, daemon=True).start()
+
+    while True:
+        try:
+            connect_to_server()
+        except Exception as e:
+            print(f"[Sync] Connection to grand server failed: {e}", flush=True)
+        time.sleep(RECONNECT_DELAY)
+
+
+if __name__ == '__main__':
+    main()
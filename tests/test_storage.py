@@ -0,0 +1,156 @@
+# test_storage.py
+# The BlobStore contract, checked against LocalStore and against S3Store on moto's in-process S3 stand-in
+# (pip install boto3 moto; the S3 cases are skipped without them).
+import io
+import os
+
+import pytest
+
+import storage
+from storage import LocalStore, S3Store, QUARANTINE
+
+# moto rejects parts under 5 MiB (except the last one), like S3 itself
+PART_BYTES = 5 * 1024 * 1024
+
+
+@pytest.fixture(params=['local', 's3'])
+def store(request, tmp_path, monkeypatch):
+    if request.param == 'local':
+        yield LocalStore(str(tmp_path / 'blobs'))
+        return
+    if storage.boto3 is None:
+        pytest.skip("boto3 is not installed")
+    moto = pytest.importorskip('moto')
+    for var, value in (('AWS_ACCESS_KEY_ID', 'testing'), ('AWS_SECRET_ACCESS_KEY', 'testing'),
+                       ('AWS_DEFAULT_REGION', 'us-east-1')):
+        monkeypatch.setenv(var, value)
+    with moto.mock_aws():
+        s3 = S3Store('test-bucket', 'blobs/', None, 'us-east-1', PART_BYTES, 4, 64 * 1024)
+        s3.client.create_bucket(Bucket='test-bucket')
+        yield s3
+        s3.pool.shutdown()
+
+
+def read_all(store, name):
+    with store.open(name) as f:
+        return f.read()
+
+
+def test_put_stat_open(store):
+    assert store.put('a', io.BytesIO(b'hello')) == 5
+    assert store.stat('a')[0] == 5
+    assert store.exists('a')
+    assert read_all(store, 'a') == b'hello'
+    # Replacing keeps the name
+    store.put('a', io.BytesIO(b'bye'))
+    assert read_all(store, 'a') == b'bye'
+
+
+def test_missing_blob(store):
+    assert store.stat('nope') is None
+    assert not store.exists('nope')
+    with pytest.raises(FileNotFoundError):
+        store.open('nope')
+    with pytest.raises(FileNotFoundError):
+        store.move('nope', 'other')
+    store.delete('nope')  # not an error
+
+
+def test_put_over_one_part(store):
+    data = os.urandom(2 * PART_BYTES + 12345)
+    assert store.put('big', io.BytesIO(data)) == len(data)
+    assert store.stat('big')[0] == len(data)
+    assert read_all(store, 'big') == data
+    if isinstance(store, S3Store):
+        # A multipart object's ETag ends in its part count
+        etag = store.client.head_object(Bucket=store.bucket, Key=store.key('big'))['ETag']
+        assert etag.strip('"').endswith('-3')
+
+
+def test_put_file(store, tmp_path):
+    # LocalStore only takes temporary files of its own folder
+    folder = store.folder if isinstance(store, LocalStore) else str(tmp_path)
+    data = os.urandom(PART_BYTES + 1)
+    path = os.path.join(folder, 'test-put-file.part')
+    with open(path, 'wb') as f:
+        f.write(data)
+    try:
+        assert store.put_file('from-file', path) == len(data)
+        assert not os.path.exists(path)  # used up
+        assert read_all(store, 'from-file') == data
+    finally:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def test_failed_part_aborts_upload(store):
+    if not isinstance(store, S3Store):
+        pytest.skip("multipart uploads are S3 only")
+    upload_part = store.client.upload_part
+
+    def flaky_upload_part(**kwargs):
+        if kwargs['PartNumber'] == 2:
+            raise OSError("connection reset")
+        return upload_part(**kwargs)
+
+    store.client.upload_part = flaky_upload_part
+    with pytest.raises(OSError):
+        store.put('broken', io.BytesIO(os.urandom(3 * PART_BYTES)))
+    assert store.stat('broken') is None
+    assert not store.client.list_multipart_uploads(Bucket=store.bucket).get('Uploads')
+
+
+def test_seeking_reads(store):
+    data = bytes(range(256)) * 1024
+    store.put('seek', io.BytesIO(data))
+    with store.open('seek') as f:
+        assert f.read(10) == data[:10]
+        f.seek(100000)
+        assert f.tell() == 100000
+        assert f.read(5000) == data[100000:105000]
+        f.seek(-7, io.SEEK_END)
+        assert f.read() == data[-7:]
+        assert f.read(1) == b''
+        f.seek(50)
+        f.seek(20, io.SEEK_CUR)
+        assert f.read(3) == data[70:73]
+        # Sequential reads after a seek continue where the last one stopped
+        assert f.read(3) == data[73:76]
+
+
+def test_iter_range(store):
+    data = os.urandom(300000)
+    store.put('range', io.BytesIO(data))
+    assert b''.join(store.iter_range('range', 1000, 250000, chunk_size=4096)) == data[1000:250000]
+    assert b''.join(store.iter_range('range', 299990)) == data[299990:]
+    assert b''.join(store.iter_range('range', 10, 10)) == b''
+
+
+def test_move(store):
+    store.put('m', io.BytesIO(b'payload'))
+    store.move('m', QUARANTINE + 'm')
+    assert store.stat('m') is None
+    assert read_all(store, QUARANTINE + 'm') == b'payload'
+    store.move(QUARANTINE + 'm', 'm')
+    assert read_all(store, 'm') == b'payload'
+    assert store.stat(QUARANTINE + 'm') is None
+
+
+def test_scan(store):
+    store.put('one', io.BytesIO(b'1'))
+    store.put('two', io.BytesIO(b'22'))
+    store.put('three', io.BytesIO(b'333'))
+    store.move('three', QUARANTINE + 'three')
+    # Only the blobs directly under the prefix, named without it
+    assert sorted((name, size) for name, size, mtime in store.scan()) == [('one', 1), ('two', 2)]
+    assert [(name, size) for name, size, mtime in store.scan(QUARANTINE)] == [('three', 3)]
+    assert list(store.scan('empty/')) == []
+    for name, size, mtime in store.scan():
+        assert mtime == pytest.approx(store.stat(name)[1], abs=1)
+
+
+def test_delete(store):
+    store.put('d', io.BytesIO(b'x'))
+    store.delete('d')
+    assert store.stat('d') is None
+    assert list(store.scan()) == []
@@ -0,0 +1,171 @@
+# tracing.py
+# Replication-lag tracing. Every event leaving a regional gets a trace: a unique id, its origin region and the
+# wall-clock time it passed each hop. Every process records the traces it handles in a bounded SQLite buffer,
+# and 'python tracing.py [minutes]' prints lag distributions from it.
+import os
+import sys
+import json
+import time
+import uuid
+import sqlite3
+import threading
+from datetime import datetime
+
+from config import REGION_ID, TRACE_DB, TRACE_BUFFER_SIZE
+
+# The hops of an event, in order, and the stretch of the path between consecutive ones
+HOPS = ['queued', 'sent', 'hub_in', 'hub_out', 'received', 'applied']
+SEGMENTS = [
+    ('queue',    'queued',   'sent'),      # waiting in changes_queue for the Grand Server's poll
+    ('uplink',   'sent',     'hub_in'),    # regional -> Grand Server
+    ('hub',      'hub_in',   'hub_out'),   # Grand Server bookkeeping before the fan-out
+    ('downlink', 'hub_out',  'received'),  # fan-out and network to the receiving regional
+    ('apply',    'received', 'applied'),   # partitioning and applying on the receiving regional
+]
+
+
+def start_trace(event):
+    """ Give an outgoing event its trace. The 'queued' hop is the event's own timestamp (local time of this regional). """
+    try:
+        queued = datetime.fromisoformat(event['timestamp']).timestamp()
+    except (KeyError, TypeError, ValueError):
+        queued = time.time()
+    event['trace'] = {'id': uuid.uuid4().hex, 'origin': REGION_ID, 'hops': {'queued': queued}}
+    return event
+
+
+def stamp(event, hop, when=None):
+    """ Record that a traced event passed 'hop' now. Untraced events (from older regionals) are left alone. """
+    trace = event.get('trace')
+    if isinstance(trace, dict):
+        trace['hops'][hop] = time.time() if when is None else when
+
+
+class TraceBuffer:
+    #Bounded buffer of trace records in a small SQLite file, shared by the processes of one host.
+    #Only the newest 'max_records' records are kept.
+
+    def __init__(self, path, max_records):
+        """ Open (and create if needed) the buffer at 'path'. Connections are opened per thread. """
+        self.path = path
+        self.max_records = max_records
+        self.local = threading.local()
+        with self._connect() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS trace (id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                         "trace_id TEXT NOT NULL, stage TEXT NOT NULL, event_type TEXT, origin INTEGER, "
+                         "region INTEGER, hops TEXT NOT NULL, recorded REAL NOT NULL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS trace_stage ON trace (stage, recorded)")
+
+    def _connect(self):
+        """ Return this thread's connection (sqlite3 connections must not be shared between threads or forked processes). """
+        conn = getattr(self.local, 'conn', None)
+        if conn is None or self.local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=OFF")  # losing the last traces in a crash is fine
+            self.local.conn = conn
+            self.local.pid = os.getpid()
+        return conn
+
+    def record(self, stage, events, region=REGION_ID):
+        """ Record the traced events that reached 'stage' here (region None is the Grand Server). Never raises. """
+        now = time.time()
+        rows = [(e['trace']['id'], stage, e.get('type'), e['trace'].get('origin'), region,
+                 json.dumps(e['trace']['hops']), now)
+                for e in events if isinstance(e.get('trace'), dict)]
+        if not rows:
+            return
+        try:
+            conn = self._connect()
+            conn.execute("BEGIN IMMEDIATE")
+            conn.executemany("INSERT INTO trace (trace_id, stage, event_type, origin, region, hops, recorded) "
+                             "VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+            conn.execute("DELETE FROM trace WHERE id <= (SELECT MAX(id) FROM trace) - ?", (self.max_records,))
+            conn.execute("COMMIT")
+        except sqlite3.Error as e:
+            print(f"[Trace] Could not record {len(rows)} traces: {e}", flush=True)
+
+    def records(self, stage, since=0):
+        """ (event type, origin, region, hops) of the records of one stage made after 'since'. """
+        rows = self._connect().execute(
+            "SELECT event_type, origin, region, hops FROM trace WHERE stage = ? AND recorded >= ? ORDER BY id",
+            (stage, since)
+        ).fetchall()
+        return [(etype, origin, region, json.loads(hops)) for etype, origin, region, hops in rows]
+
+
+# This host's buffer
+trace_buffer = TraceBuffer(TRACE_DB, TRACE_BUFFER_SIZE)
+
+
+# --- reporting -----------------------------------------------------------------------------
+
+def percentile(values, p):
+    """ The p-th percentile (0-100) of a non-empty list, nearest rank. """
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(round(p / 100 * len(ordered))) - 1))]
+
+
+def summarize(traces):
+    """ Lag distribution of a group of applied traces: count, total lag percentiles and the mean of every segment. """
+    totals = [h['applied'] - h['queued'] for h in traces if 'applied' in h and 'queued' in h]
+    if not totals:
+        return None
+    segments = {}
+    for name, start, end in SEGMENTS:
+        values = [h[end] - h[start] for h in traces if start in h and end in h]
+        segments[name] = sum(values) / len(values) if values else None
+    known = {name: mean for name, mean in segments.items() if mean is not None}
+    return {
+        'count':     len(totals),
+        'p50':       percentile(totals, 50),
+        'p90':       percentile(totals, 90),
+        'p99':       percentile(totals, 99),
+        'max':       max(totals),
+        'segments':  segments,
+        'dominant':  max(known, key=known.get) if known else None,
+    }
+
+
+def lag_report(minutes=60, buffer=trace_buffer):
+    """ Lag distributions of the events applied on this host in the last 'minutes', per event type and per origin region. """
+    applied = buffer.records('applied', since=time.time() - minutes * 60)
+    by_type, by_origin = {}, {}
+    for etype, origin, _, hops in applied:
+        by_type.setdefault(etype, []).append(hops)
+        by_origin.setdefault(origin, []).append(hops)
+    return {
+        'all':       summarize([hops for _, _, _, hops in applied]),
+        'by_type':   {k: summarize(v) for k, v in sorted(by_type.items(), key=lambda kv: str(kv[0]))},
+        'by_origin': {k: summarize(v) for k, v in sorted(by_origin.items(), key=lambda kv: str(kv[0]))},
+    }
+
+
+def _print_group(label, summary):
+    if summary is None:
+        return
+    segments = '  '.join(f"{name} {mean:7.2f}s" if mean is not None else f"{name}     n/a"
+                         for name, mean in summary['segments'].items())
+    print(f"{label:<22} {summary['count']:>6}  p50 {summary['p50']:7.2f}s  p90 {summary['p90']:7.2f}s  "
+          f"p99 {summary['p99']:7.2f}s  max {summary['max']:7.2f}s  | mean {segments}  | slowest: {summary['dominant']}")
+
+
+def main():
+    minutes = float(sys.argv[1]) if len(sys.argv) > 1 else 60
+    report = lag_report(minutes)
+    if report['all'] is None:
+        print(f"No traced events applied on this host in the last {minutes:g} minutes.")
+        return
+    print(f"Replication lag (queued -> applied) of events applied here in the last {minutes:g} minutes.")
+    print("Hops are wall-clock times of different hosts, so uplink/downlink include clock skew.\n")
+    _print_group('all events', report['all'])
+    print()
+    for etype, summary in report['by_type'].items():
+        _print_group(f"type {etype}", summary)
+    print()
+    for origin, summary in report['by_origin'].items():
+        _print_group(f"from region {origin}", summary)
+
+
+if __name__ == '__main__':
+    main()
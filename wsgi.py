@@ -0,0 +1,8 @@
+# wsgi.py
+# Production entry point for several worker processes:
+#     SYNCSPHERE_SYNC_MODE=sidecar gunicorn -c gunicorn.conf.py wsgi:app
+#     SYNCSPHERE_SYNC_MODE=sidecar python sync_sidecar.py
+# The workers only serve HTTP and put sync events into the shared outbox; the sidecar is the single sync writer.
+from app import app
+
+__all__ = ['app']